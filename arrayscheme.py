@@ -0,0 +1,334 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+
+import parametricscheme as ps
+import solargeometry as sg
+
+
+# NOTE Batched version of the scheme in parametricscheme.py
+#      Every site is a row and every function below works on all rows at once
+#      The equations, constants and order of operations follow parametricscheme.py
+#      so results match the scalar path to within floating point rounding
+#      Requires numpy, parametricscheme.py itself has no external dependencies
+
+
+# "Constants"
+SIGMA = 5.67 * 10**(-8)  # W m^-2 K^-4 - Stefan-Boltzmann constant
+S     = 1368             # W m^-2 - Solar irradiance
+C_G   = 1.4 * 10**5      # J m^-2 K^-1 - Soil heat capacity
+K     = 11               # J m^-2 K^-1 s^-1 - Thermal diffusivity of air
+RHO   = 1.225            # kg m^-3 - Density of air at sea level and 15 degrees C
+C_P   = 1004             # J K^-1 kg^-1 - Specific heat at constant pressure
+D_T   = 60               # s - Time step
+
+# Per-site parameters, excluding degrees which is handled separately
+FIELDS = ['latitude', 'longitude', 'day_of_year', 'ground_temp', 'surface_temp',
+          'percent_net_radiation', 'hour', 'minute', 'albedo', 'cloud_fraction',
+          'day_of_solstice', 'utc_offset', 'transmissivity', 'emissivity',
+          'precip_water', 'bowen_ratio', 'resistance',
+          'atmos_temp_constant', 'atmos_temp_adjust',
+          'cloud_temp_constant', 'cloud_temp_adjust', 'year']
+
+# Temperatures supplied in Celsius or Fahrenheit and converted to Kelvin
+TEMP_FIELDS = ['ground_temp', 'surface_temp',
+               'atmos_temp_constant', 'atmos_temp_adjust',
+               'cloud_temp_constant', 'cloud_temp_adjust']
+
+# Clock fields advanced every step
+CLOCK_FIELDS = ['day_of_year', 'hour', 'minute']
+
+# Solar geometry tables indexed by day of solstice - 172 then day of year
+EOT = np.array(sg.EOT)
+ELLIPTICAL_ORBIT_RATIO = np.array(sg.ELLIPTICAL_ORBIT_RATIO)
+SIN_DECLINATION = np.array([sg.SIN_DECLINATION[d_s] for d_s in sg.SOLSTICES])
+COS_DECLINATION = np.array([sg.COS_DECLINATION[d_s] for d_s in sg.SOLSTICES])
+
+
+def stack(records):
+    '''
+    Convert a list of per-site dicts or argparse Namespaces to a dict of lists
+    '''
+
+    records = [r if isinstance(r, dict) else vars(r) for r in records]
+    keys    = set(FIELDS + ['degrees']) & set().union(*records)
+
+    return dict((k, [r.get(k, ps.DEFAULTS.get(k)) for r in records]) for k in keys)
+
+
+def site_arrays(sites):
+    '''
+    Broadcast per-site parameters to arrays of equal length with temperatures in Kelvin
+
+    sites maps parameter names to scalars or sequences, missing optional
+    parameters take their command line defaults and None becomes NaN
+    '''
+
+    values = {}
+    for name in FIELDS:
+        if name in sites:
+            value = sites[name]
+        elif name in ps.DEFAULTS:
+            value = ps.DEFAULTS[name]
+        else:
+            raise KeyError("missing required site parameter %r" % name)
+
+        if np.ndim(value) == 0:
+            value = np.nan if value is None else value
+        else:
+            value = [np.nan if v is None else v for v in value]
+        values[name] = value
+
+    degrees = np.char.upper(np.atleast_1d(np.asarray(sites['degrees'], dtype=str)))
+    arrays  = np.broadcast_arrays(*([np.atleast_1d(np.asarray(values[n], dtype=float)) for n in FIELDS] + [degrees]))
+    p = dict((n, np.array(a)) for n, a in zip(FIELDS, arrays[:-1]))
+    p['degrees'] = np.array(arrays[-1])
+
+    if not np.all(np.isin(p['degrees'], ['C', 'F'])):
+        raise ValueError("degrees must be C or F")
+
+    # Same conversions as c_to_k and f_to_k
+    celsius = p['degrees'] == 'C'
+    for name in TEMP_FIELDS:
+        p[name] = np.where(celsius, p[name] + 273.15, (p[name] + 459.67) * 5 / 9)
+
+    for name in CLOCK_FIELDS + ['day_of_solstice']:
+        p[name] = p[name].astype(int)
+
+    # Site dependent solar geometry
+    p['sin_lat'], p['cos_lat'] = np.array([sg.latitude_terms(lat) for lat in p['latitude']]).reshape(-1, 2).T
+    p['solstice'] = p['day_of_solstice'] - sg.SOLSTICES[0]
+
+    return p
+
+
+def from_kelvin(p, k):
+    '''
+    Convert Kelvin back to each site's Celsius or Fahrenheit
+    '''
+
+    return np.where(p['degrees'] == 'C', k - 273.15, (k - 273.15) * 9 / 5 + 32)
+
+
+def downwelling_rad(p, T_s):
+    '''
+    Calculate downwelling longwave radiation for all sites
+    '''
+
+    b   = p['cloud_fraction']
+    e_g = p['emissivity']
+
+    # Atmospheric and cloud base temperature constant or adjustment or surface temperature
+    T_a = np.where(np.isnan(p['atmos_temp_constant']),
+                   np.where(np.isnan(p['atmos_temp_adjust']), T_s, T_s + p['atmos_temp_adjust']),
+                   p['atmos_temp_constant'])
+    T_c = np.where(np.isnan(p['cloud_temp_constant']),
+                   np.where(np.isnan(p['cloud_temp_adjust']), T_s, T_s + p['cloud_temp_adjust']),
+                   p['cloud_temp_constant'])
+
+    # Equation 2.7  Page 26
+    e_a = 0.725 + 0.17 * np.log10(p['precip_water'])
+
+    # Equation 2.8  Page 27
+    Q_Ld = e_g * e_a * SIGMA * T_a**4 + b * e_g * (1 - e_a) * SIGMA * T_c**4
+
+    return Q_Ld
+
+
+def upwelling_rad(p):
+    '''
+    Calculate upwelling longwave radiation for all sites
+    '''
+
+    # Equation 2.5  Page 25
+    Q_Lu = p['emissivity'] * SIGMA * p['ground_temp']**4
+
+    return Q_Lu
+
+
+def sensible_heat_flux(p, N_R, T_s):
+    '''
+    Calculate sensible heat flux using percent of net radiation or
+    resistance to heat flux for all sites
+    '''
+
+    pc_nr = p['percent_net_radiation']
+    r_H   = p['resistance']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Based on Question 6  Pages 60 and 61
+        # EXPERIMENTAL  Based on Equation 2.23  Page 31
+        Q_H = np.where(pc_nr != 0, pc_nr * N_R, RHO * C_P * (p['ground_temp'] - T_s) / r_H)
+
+    return Q_H
+
+
+def latent_heat_flux(p, Q_H):
+    '''
+    Calculate latent heat flux using Bowen ratio for all sites
+    '''
+
+    # Based on the definition on Page 22
+    Q_E = Q_H / p['bowen_ratio']
+
+    return Q_E
+
+
+def ground_heat_flux(p, T_s):
+    '''
+    Calculate ground heat flux for all sites
+    '''
+
+    # Based on last term in only equation in question 6  Page 61
+    Q_G = K * (T_s - p['ground_temp'])
+
+    return Q_G
+
+
+def zenith(p, day, hour, minute):
+    '''
+    Calculate cosine of zenith angle for all sites from the solar geometry tables
+    '''
+
+    # Same local hour of the sun approximation as local_hour
+    LSTM = 15 * p['utc_offset']
+    TC   = 4 * (p['longitude'] - LSTM) + EOT[day]
+    LST  = hour + minute / 60 + TC / 60
+    h    = np.radians(15 * (LST - 12))
+
+    # Equation 2.2  Page 22
+    return (p['sin_lat'] * SIN_DECLINATION[p['solstice'], day] +
+            p['cos_lat'] * COS_DECLINATION[p['solstice'], day] * np.cos(h))
+
+
+def solar_rad(p, day, hour, minute):
+    '''
+    Calculate incoming solar radiation for all sites
+    '''
+
+    eor = ELLIPTICAL_ORBIT_RATIO[day]
+    zen = zenith(p, day, hour, minute)
+
+    # Based on Equation 2.1  Page 23
+    Q_S = np.where(zen < 0, 0.0, S * eor**2 * (1 - p['albedo']) * zen * p['transmissivity'])
+
+    return Q_S
+
+
+def days_in_year(year):
+    '''
+    Number of days in each year, 365 when year is NaN
+    '''
+
+    # Year 1 is not a leap year, NaN is slow with %
+    year = np.where(np.isnan(year), 1, year).astype(int)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+
+    return np.where(leap, 366, 365)
+
+
+def inc_mins_hours_days(year, day, hour, minute):
+    '''
+    Increment minutes, hours, days and years for all sites
+    '''
+
+    # Same wrapping as the scalar inc_mins_hours_days
+    wrap_m = minute == 59
+    wrap_h = wrap_m & (hour == 23)
+    wrap_d = wrap_h
+    if wrap_h.any():
+        wrap_d = wrap_h & (day == days_in_year(year))
+
+    minute = np.where(wrap_m, 0, minute + 1)
+    hour   = np.where(wrap_h, 0, np.where(wrap_m, hour + 1, hour))
+    day    = np.where(wrap_d, 1, np.where(wrap_h, day + 1, day))
+    year   = np.where(wrap_d, year + 1, year)
+
+    return year, day, hour, minute
+
+
+def step(p, T_s, day, hour, minute, Q_S=None):
+    '''
+    Calculate all fluxes and the change in surface temperature over one time step
+    Q_S is calculated from the clock unless given, see sweep.py
+    '''
+
+    if Q_S is None:
+        Q_S = solar_rad(p, day, hour, minute)  # Incoming solar radiation
+    Q_Ld = downwelling_rad(p, T_s)          # Downwelling longwave radiation
+    Q_Lu = upwelling_rad(p)                 # Upwelling longwave radiation
+    N_R  = Q_S + Q_Ld - Q_Lu                # Net radiation
+    Q_H  = sensible_heat_flux(p, N_R, T_s)  # Sensible heat flux
+    Q_E  = latent_heat_flux(p, Q_H)         # Latent heat flux
+    Q_G  = ground_heat_flux(p, T_s)         # Ground heat flux
+
+    # Based on only equation in question 6  Page 61
+    d_T_s = (Q_S + Q_Ld - Q_Lu - Q_H - Q_E - Q_G) * D_T / C_G
+
+    return Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, d_T_s
+
+
+def iter_forecast(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+                  report_period=ps.DEFAULTS['report_period'], forcing=None):
+    '''
+    Calculate surface temperature for many sites at once
+
+    Runs the same per-minute scheme as parametricscheme.iter_forecast for
+    every site and lazily yields a dict mapping each of parametricscheme.COLUMNS
+    to an array with one value per site every report period plus the final values
+    Memory use does not depend on forecast_minutes
+
+    forcing is an optional iterator yielding one dict per step mapping site
+    parameters to per-site arrays, in Kelvin for temperatures, which replace
+    the site parameters from that step on, see forcing.py
+    '''
+
+    p = site_arrays(sites)
+    n = len(p['latitude'])
+
+    T_s  = p['surface_temp'].copy()
+    year = p['year']
+    day  = p['day_of_year']
+    hour = p['hour']
+    mins = p['minute']
+    sum_d_T_s = np.zeros(n)
+
+    def report(fluxes):
+        row = dict(zip(ps.COLUMNS[3:10], fluxes[:6] + (sum_d_T_s,)))
+        row['Day']    = day
+        row['Hour']   = hour
+        row['Minute'] = mins
+        row['T_s']    = from_kelvin(p, T_s)
+        return row
+
+    for i in range(0, forecast_minutes):
+        if forcing is not None:
+            p.update(next(forcing))
+
+        fluxes = step(p, T_s, day, hour, mins)
+        sum_d_T_s = sum_d_T_s + fluxes[6]
+        T_s = T_s + fluxes[6]
+
+        year, day, hour, mins = inc_mins_hours_days(year, day, hour, mins)
+
+        if i % report_period == 0:
+            yield report(fluxes)
+            sum_d_T_s = np.zeros(n)
+
+    yield report(fluxes)
+
+
+def forecast(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+             report_period=ps.DEFAULTS['report_period'], forcing=None):
+    '''
+    Calculate surface temperature for many sites at once
+
+    Returns a dict mapping each of parametricscheme.COLUMNS to an (N, T)
+    array, where T is the number of rows parametricscheme.main would write
+    '''
+
+    rows = list(iter_forecast(sites, forecast_minutes, report_period, forcing))
+
+    return dict((c, np.stack([row[c] for row in rows], axis=1)) for c in ps.COLUMNS)
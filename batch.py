@@ -0,0 +1,267 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import sys
+import csv
+import json
+import argparse
+import itertools
+
+import parametricscheme as ps
+
+try:
+    import arrayscheme
+except ImportError:
+    arrayscheme = None
+
+
+# NOTE Run many scenarios from one file, one scenario per row
+#      Columns or JSON keys are the long command line option names plus an optional id
+#      The file is read twice, first to validate every row and report errors,
+#      then to run the valid rows in chunks, so memory use does not depend on file size
+#      Chunks run as arrayscheme batches when numpy is installed
+
+
+# Scenario fields converted to int or str, all others are float
+INTEGER_FIELDS = ['day_of_year', 'hour', 'minute', 'day_of_solstice', 'utc_offset',
+                  'report_period', 'forecast_minutes', 'year']
+STRING_FIELDS  = ['id', 'degrees', 'integrator']
+
+# Output columns
+COLUMNS = ['id'] + ps.COLUMNS
+
+
+def read_scenarios(filename):
+    '''
+    Lazily read scenarios from a JSON lines file (.jsonl) or a comma or tab separated file
+    Yields (row number, dict of raw values), or the undecoded line of a JSON
+    lines file so a bad line is reported by validate like any other row error
+    '''
+
+    with io.open(filename, newline='') as f:
+        if filename.lower().endswith('.jsonl'):
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield number, line
+        else:
+            header = f.readline()
+            delimiter = '\t' if '\t' in header else ','
+            names = next(csv.reader([header], delimiter=delimiter))
+            for number, values in enumerate(csv.reader(f, delimiter=delimiter), 1):
+                yield number, dict(zip(names, values))
+
+
+def decode(record):
+    '''
+    Dict of raw values from a JSON line, records already decoded are returned as they are
+    Raises ValueError for invalid JSON and TypeError for JSON which is not an object
+    '''
+
+    if isinstance(record, dict):
+        return record
+
+    value = json.loads(record)
+    if not isinstance(value, dict):
+        raise TypeError("scenario must be a JSON object not %s" % type(value).__name__)
+
+    return value
+
+
+def integer(name, value):
+    '''
+    Whole number value of an integer field, 13 or 13.0 but not 13.7
+    Raises ValueError for anything else
+    '''
+
+    try:
+        whole = float(value).is_integer()
+    except ValueError:
+        whole = False
+
+    if not whole:
+        raise ValueError("'%s' must be a whole number not %r" % (name, value))
+
+    return int(float(value))
+
+
+def parse(number, record):
+    '''
+    Convert raw scenario values to a scenario id and ForecastConfig
+    Missing id defaults to the row number
+    Raises ValueError or TypeError for bad values or unknown fields
+    '''
+
+    params = {}
+
+    for name, value in record.items():
+        if value is None or value == '':
+            continue
+        elif name == 'aggregates':
+            raise ValueError("'aggregates' are not supported in batch scenarios, "
+                             "use parametricscheme.py --aggregates")
+        elif name in STRING_FIELDS:
+            params[name] = str(value)
+        elif name in INTEGER_FIELDS:
+            params[name] = integer(name, value)
+        else:
+            params[name] = float(value)
+
+    scenario_id = params.pop('id', str(number))
+
+    return scenario_id, ps.ForecastConfig(**params)
+
+
+def validate(number, record, integer_ids=False):
+    '''
+    Check one scenario, with integer_ids the id must be a whole number as for .npy output
+    Returns (scenario id, ForecastConfig or None, list of error messages)
+    '''
+
+    scenario_id = str(number)
+
+    try:
+        record      = decode(record)
+        scenario_id = record.get('id') or scenario_id
+        scenario_id, config = parse(number, record)
+    except (ValueError, TypeError) as e:
+        return scenario_id, None, [str(e)]
+
+    errors = config.errors()
+    if integer_ids:
+        try:
+            integer('id', scenario_id)
+        except ValueError as e:
+            errors.append(str(e))
+
+    return scenario_id, (None if errors else config), errors
+
+
+def check(filename, integer_ids=False):
+    '''
+    Validate every scenario without running any
+    Lazily yields (row number, scenario id, errors) for each invalid row
+    '''
+
+    for number, record in read_scenarios(filename):
+        scenario_id, config, errors = validate(number, record, integer_ids)
+        if errors:
+            yield number, scenario_id, errors
+
+
+def run_chunk(chunk):
+    '''
+    Forecast a list of (scenario id, ForecastConfig)
+    Lazily yields rows of COLUMNS values, every row of each scenario together
+    in the order of chunk
+
+    Euler scenarios with the same forecast_minutes and report_period run as one
+    arrayscheme batch, anything else runs one at a time with parametricscheme
+    '''
+
+    groups = {}
+    for i, (scenario_id, config) in enumerate(chunk):
+        if arrayscheme is not None and config.integrator == 'euler':
+            key = (config.forecast_minutes, config.report_period)
+        else:
+            key = None
+        groups.setdefault(key, []).append((i, config))
+
+    # Rows of each scenario by position in chunk, batches are calculated a report at a time
+    rows = [[] for item in chunk]
+    for key, group in groups.items():
+        if key is None:
+            for i, config in group:
+                rows[i].extend(ps.iter_forecast(config))
+        else:
+            sites = arrayscheme.stack([config for i, config in group])
+            for report in arrayscheme.iter_forecast(sites, *key):
+                values = [report[c].tolist() for c in ps.COLUMNS]
+                for (i, config), row in zip(group, zip(*values)):
+                    rows[i].append(row)
+
+    for (scenario_id, config), scenario_rows in zip(chunk, rows):
+        for row in scenario_rows:
+            yield (scenario_id,) + row
+
+
+def run(filename, chunk_size=10000, integer_ids=False):
+    '''
+    Forecast every valid scenario in chunks of chunk_size rows, invalid rows are left out
+    Lazily yields rows of COLUMNS values, every row of a scenario together in file order
+    '''
+
+    def valid():
+        for number, record in read_scenarios(filename):
+            scenario_id, config, errors = validate(number, record, integer_ids)
+            if config is not None:
+                yield scenario_id, config
+
+    scenarios = valid()
+
+    while True:
+        chunk = list(itertools.islice(scenarios, chunk_size))
+        if not chunk:
+            break
+        for row in run_chunk(chunk):
+            yield row
+
+
+def main(args):
+    '''
+    Validate all scenarios, report errors, then run the valid ones
+    '''
+
+    errors_file = sys.stderr if args.errors is None else open(args.errors, 'w')
+    integer_ids = args.filename.lower().endswith('.npy')
+
+    invalid = 0
+    try:
+        for number, scenario_id, errors in check(args.scenarios, integer_ids):
+            invalid += 1
+            for error in errors:
+                errors_file.write("ERROR: row %d id %s: %s\n" % (number, scenario_id, error))
+    finally:
+        if errors_file is not sys.stderr:
+            errors_file.close()
+
+    print("Invalid scenarios:\t", invalid)
+
+    if args.check_only:
+        return 1 if invalid else 0
+
+    n = 0
+    with ps.open_writer(args.filename, COLUMNS) as writer:
+        for row in run(args.scenarios, args.chunk, integer_ids):
+            if integer_ids:
+                row = (integer('id', row[0]),) + row[1:]
+            writer.write(row)
+            n += 1
+
+    print("Rows written:\t", n)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Forecast every scenario in a file https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('scenarios',
+            help='Comma or tab separated file or JSON lines file (.jsonl) with one scenario per row, '
+                 'using the long command line option names and an optional id')
+    parser.add_argument('-fn', '--filename',
+            help='File name for CSV output or binary output if ending in .npy (integer ids required)',
+            required=True, type=str)
+    parser.add_argument('-ch', '--chunk',
+            help='Scenarios run together - default=%(default)s',
+            default=10000, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-er', '--errors',
+            help='File name for per-row errors - default standard error',
+            default=None, type=str)
+    parser.add_argument('-co', '--check_only',
+            help='Only validate the scenarios',
+            action="store_true")
+
+    sys.exit(main(parser.parse_args()))
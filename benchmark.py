@@ -0,0 +1,290 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import tempfile
+
+import parametricscheme as ps
+
+
+# NOTE Benchmarks for parametricscheme.py and the modules built on it
+#      Results are saved to a JSON baseline and later runs are compared with it
+#      The Madaus scenario from the README, which created data/data.csv,
+#      is checked for correctness before anything is timed, as is a batch.py to
+#      verify.py round trip of two scenarios
+#      Timings depend on the machine so save a baseline on the machine used for checks
+
+
+# Madaus comparison parameters from the README
+SCENARIO = {
+    'latitude':              47.6928,
+    'longitude':             -122.3038,
+    'day_of_year':           229,
+    'hour':                  13,
+    'ground_temp':           54,
+    'surface_temp':          72,
+    'utc_offset':            -8,
+    'precip_water':          1.27,
+    'albedo':                0.1866694,
+    'emissivity':            0.8110634,
+    'transmissivity':        0.6351528,
+    'percent_net_radiation': 0.3305529,
+    'atmos_temp_constant':   -46.5617064,
+    'degrees':               'F',
+    'forecast_minutes':      1440,
+    'report_period':         60,
+}
+
+BASELINE  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'benchmark.json')
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'data.csv')
+
+HORIZONS = [1, 60, 1440]
+SITES    = [1, 10, 100, 1000]
+
+
+def config(**overrides):
+    '''
+    ForecastConfig for the Madaus scenario with optional changes
+    '''
+
+    params = dict(SCENARIO)
+    params.update(overrides)
+
+    return ps.ForecastConfig(**params)
+
+
+def check_reference(tolerance=1e-6):
+    '''
+    Compare the Madaus scenario with data/data.csv
+    Returns the largest absolute difference, raises AssertionError above tolerance
+    '''
+
+    result = ps.run_forecast(config())
+
+    with open(REFERENCE) as f:
+        header = f.readline().split()
+        rows = [[float(v) for v in line.split()] for line in f]
+
+    assert header == ps.COLUMNS, "unexpected columns in %s" % REFERENCE
+    assert len(rows) == len(result['T_s']), "expected %d rows not %d" % (len(rows), len(result['T_s']))
+
+    diff = max(abs(row[i] - result[c][j]) for j, row in enumerate(rows) for i, c in enumerate(ps.COLUMNS))
+    assert diff <= tolerance, "forecast differs from %s by %g" % (REFERENCE, diff)
+
+    return diff
+
+
+def check_round_trip():
+    '''
+    Forecast two Madaus scenarios with batch.py and verify the output against itself
+    Returns the number of pairs, raises AssertionError unless every report time
+    of each scenario is paired once with zero error
+    '''
+
+    import batch
+    import verify
+
+    directory = tempfile.mkdtemp()
+    scenarios = os.path.join(directory, 'scenarios.jsonl')
+    output    = os.path.join(directory, 'output.csv')
+
+    with open(scenarios, 'w') as f:
+        for i, hour in enumerate((13, 1), 1):
+            f.write(json.dumps(dict(SCENARIO, id=str(i), hour=hour, forecast_minutes=121)) + '\n')
+
+    with ps.open_writer(output, batch.COLUMNS) as writer:
+        for row in batch.run(scenarios):
+            writer.write(row)
+
+    reports = len(set(ps.report_minutes(config(forecast_minutes=121))))
+    scores  = verify.verify([output], [output])['all']
+
+    for name in (scenarios, output):
+        os.remove(name)
+    os.rmdir(directory)
+
+    assert scores.count == 2 * reports, "expected %d pairs not %d" % (2 * reports, scores.count)
+    assert scores.mae == 0, "batch output differs from itself by %g" % scores.mae
+
+    return scores.count
+
+
+def per_call(func, repeat):
+    '''
+    Best time of repeat runs in seconds per call of func
+    '''
+
+    timer  = timeit.Timer(func)
+    number = timer.autorange()[0]
+
+    return min(timer.repeat(repeat, number)) / number
+
+
+def bench_main(repeat):
+    '''
+    Simulated minutes per second of the forecast loop for each horizon
+    '''
+
+    results = {}
+
+    for minutes in HORIZONS:
+        c = config(forecast_minutes=minutes, report_period=min(60, minutes))
+        results['main_%d_minutes' % minutes] = (minutes / per_call(lambda: ps.run_forecast(c), repeat),
+                                                'steps/s', True)
+
+    return results
+
+
+def bench_functions(repeat):
+    '''
+    Microseconds per call of the most expensive flux functions
+    '''
+
+    args = config().to_state()
+
+    return dict(('%s_call' % f.__name__, (per_call(lambda: f(args), repeat) * 1e6, 'us', False))
+                for f in (ps.solar_rad, ps.zenith, ps.downwelling_rad))
+
+
+def bench_output(repeat):
+    '''
+    Microseconds per report row written with --filename for CSV and .npy output
+    '''
+
+    results = {}
+    result = ps.run_forecast(config(forecast_minutes=1440, report_period=1))
+    rows = list(zip(*[result[c] for c in ps.COLUMNS]))
+
+    for ext in ('csv', 'npy'):
+        with tempfile.NamedTemporaryFile(suffix='.' + ext) as tmp:
+            def run():
+                os.truncate(tmp.name, 0)
+                with ps.open_writer(tmp.name) as writer:
+                    for row in rows:
+                        writer.write(row)
+
+            results['%s_output_row' % ext] = (per_call(run, repeat) / len(rows) * 1e6, 'us', False)
+
+    return results
+
+
+def bench_sites(repeat):
+    '''
+    Site-minutes per second of the numpy engine for increasing numbers of sites
+    '''
+
+    try:
+        import arrayscheme
+    except ImportError:
+        return {}
+
+    results = {}
+
+    for n in SITES:
+        sites = dict(SCENARIO)
+        sites['latitude'] = [SCENARIO['latitude'] + i * 1e-3 for i in range(n)]
+
+        minutes = 60
+        t = per_call(lambda: arrayscheme.forecast(sites, minutes, 60), repeat)
+        results['arrayscheme_%d_sites' % n] = (n * minutes / t, 'site-steps/s', True)
+
+    return results
+
+
+def run(repeat=5):
+    '''
+    Run every benchmark
+    Returns a dict mapping benchmark names to (value, unit, higher_is_better)
+    '''
+
+    results = {}
+    for bench in (bench_main, bench_functions, bench_output, bench_sites):
+        results.update(bench(repeat))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare results with a baseline
+    Returns a list of benchmarks slower than the baseline by more than threshold
+    '''
+
+    regressions = []
+
+    for name, (value, unit, higher) in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        ratio = baseline[name]['value'] / value if higher else value / baseline[name]['value']
+        if ratio > threshold:
+            regressions.append((name, baseline[name]['value'], value, unit, ratio))
+
+    return regressions
+
+
+def main(args):
+    '''
+    Check correctness, run benchmarks, then optionally save or check a baseline
+    '''
+
+    print("Reference:\t max difference from %s %g" % (REFERENCE, check_reference()))
+    print("Round trip:\t %d batch.py rows verified" % check_round_trip())
+
+    results = run(args.repeat)
+
+    for name, (value, unit, higher) in sorted(results.items()):
+        print("%-28s %14.3f %s" % (name, value, unit))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python':   platform.python_version(),
+                       'platform': platform.platform(),
+                       'machine':  platform.machine(),
+                       'results':  dict((n, {'value': v, 'unit': u, 'higher_is_better': h})
+                                        for n, (v, u, h) in results.items())},
+                      f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+
+        for name, old, new, unit, ratio in regressions:
+            print("REGRESSION: %s %.3f -> %.3f %s (%.2fx slower)" % (name, old, new, unit, ratio))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Benchmark the parametric scheme https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-r', '--repeat',
+            help='Repeats of each timing, the best is used - default=%(default)s',
+            default=5, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-b', '--baseline',
+            help='Baseline JSON file - default=%(default)s',
+            default=BASELINE, type=str)
+    parser.add_argument('-s', '--save',
+            help='Save results as the new baseline',
+            action="store_true")
+    parser.add_argument('-c', '--check',
+            help='Exit with status 1 if any benchmark is slower than the baseline by more than threshold',
+            action="store_true")
+    parser.add_argument('-t', '--threshold',
+            help='Slowdown ratio counted as a regression - default=%(default)s',
+            default=1.5, type=ps.float_range(1.0, None), metavar="[1.0, None]")
+
+    sys.exit(main(parser.parse_args()))
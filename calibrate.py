@@ -0,0 +1,253 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import csv
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+
+
+# NOTE Fit parameters to observed surface temperature and optionally fluxes
+#      Differential evolution (DE/rand/1/bin) with every candidate in a generation
+#      evaluated as one site of a single arrayscheme batch
+#      Each report is compared with the observations as soon as it is calculated
+#      https://en.wikipedia.org/wiki/Differential_evolution
+
+
+# Parameters fitted by default, those used for the Madaus comparison in the README
+PARAMETERS = ['albedo', 'emissivity', 'transmissivity', 'percent_net_radiation',
+              'atmos_temp_constant']
+
+# Short command line options used when printing fitted parameters
+OPTIONS = {
+    'albedo':                '-al',
+    'emissivity':            '-em',
+    'transmissivity':        '-tr',
+    'percent_net_radiation': '-pr',
+    'precip_water':          '-pw',
+    'cloud_fraction':        '-cf',
+    'bowen_ratio':           '-br',
+    'atmos_temp_constant':   '-at',
+    'atmos_temp_adjust':     '-ta',
+    'cloud_temp_constant':   '-ct',
+    'cloud_temp_adjust':     '-tc',
+    'ground_temp':           '-gt',
+    'surface_temp':          '-st',
+}
+
+# Temperature ranges from temp_errors
+TEMP_BOUNDS = {
+    'C': (-100.0, 66.0),
+    'F': (-150.0, 150.0),
+}
+
+
+def default_bounds(name, degrees):
+    '''
+    Search range for a parameter, the command line range or temperature range
+    '''
+
+    if name in arrayscheme.TEMP_FIELDS:
+        return TEMP_BOUNDS[degrees.upper()]
+
+    lo, hi = ps.RANGES[name]
+
+    # Avoid log10(0) precipitable water and no sensible heat flux
+    if name in ('precip_water', 'percent_net_radiation') and lo == 0:
+        lo = 0.01
+
+    return lo, hi
+
+
+def read_observations(filename):
+    '''
+    Read tab separated observations with Day, Hour and Minute columns
+    and any of the CSV output variables such as T_s
+    Returns a dict mapping (day, hour, minute) to a dict of observed values
+    '''
+
+    observations = {}
+
+    with open(filename) as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            key = (int(row.pop('Day')), int(row.pop('Hour')), int(row.pop('Minute')))
+            observations[key] = dict((k, float(v)) for k, v in row.items() if v not in ('', None))
+
+    return observations
+
+
+def objective(site, candidates, observations, weights, forecast_minutes):
+    '''
+    Weighted sum over variables of the RMSE between each candidate and the observations
+
+    candidates maps fitted parameter names to one value per candidate
+    weights maps CSV variables such as T_s or Q_H to their weight
+    Returns an array with one value per candidate
+    '''
+
+    sites = dict(site)
+    sites.update(candidates)
+
+    n     = len(next(iter(candidates.values())))
+    sq    = dict((v, np.zeros(n)) for v in weights)
+    count = dict((v, 0) for v in weights)
+    last  = None
+
+    # Report every minute so every observation time is matched
+    for row in arrayscheme.iter_forecast(sites, forecast_minutes, 1):
+        key = (int(row['Day'][0]), int(row['Hour'][0]), int(row['Minute'][0]))
+
+        # The final row repeats the last report
+        if key == last:
+            continue
+        last = key
+
+        for v in weights:
+            if key in observations and v in observations[key]:
+                sq[v] += (row[v] - observations[key][v])**2
+                count[v] += 1
+
+    total = np.zeros(n)
+    for v, w in weights.items():
+        if count[v] == 0:
+            raise ValueError("no %s observations during the forecast" % v)
+        total += w * np.sqrt(sq[v] / count[v])
+
+    # Unstable candidates are never selected
+    return np.where(np.isfinite(total), total, np.inf)
+
+
+def calibrate(site, observations, parameters=PARAMETERS, bounds=None, weights=None,
+              forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+              population=None, generations=100, mutation=0.7, crossover=0.9,
+              tol=1e-6, seed=None):
+    '''
+    Fit parameters to observations using differential evolution
+
+    site is a dict of ForecastConfig parameters, fitted parameters are replaced
+    observations is a dict as returned by read_observations
+    bounds maps parameters to (min, max) search ranges, defaults to default_bounds
+    weights maps CSV variables to objective weights, defaults to T_s only
+    population defaults to 10 candidates per fitted parameter
+    Stops after generations or when the objective spread is below tol
+
+    Returns a dict with the best parameters, their objective value, the
+    number of generations and the best objective value of each generation
+    '''
+
+    if weights is None:
+        weights = {'T_s': 1.0}
+    if bounds is None:
+        bounds = {}
+    if population is None:
+        population = 10 * len(parameters)
+
+    lo, hi = np.array([bounds.get(p, default_bounds(p, site['degrees'])) for p in parameters], dtype=float).T
+
+    # Only the fitted parameters vary, so check everything else once
+    middle = dict(site)
+    middle.update(zip(parameters, (lo + hi) / 2))
+    ps.ForecastConfig(forecast_minutes=forecast_minutes, report_period=1, **middle).validate()
+
+    rng = np.random.default_rng(seed)
+
+    def evaluate(x):
+        return objective(site, dict(zip(parameters, x.T)), observations, weights, forecast_minutes)
+
+    x = lo + rng.random((population, len(parameters))) * (hi - lo)
+    f = evaluate(x)
+    history = [f.min()]
+
+    # With no generations the best of the initial population is returned
+    generation = 0
+    for generation in range(1, generations + 1):
+        # Three distinct other candidates for each candidate
+        others = np.array([rng.choice(np.delete(np.arange(population), i), 3, replace=False)
+                           for i in range(population)])
+        a, b, c = x[others[:, 0]], x[others[:, 1]], x[others[:, 2]]
+        mutant = np.clip(a + mutation * (b - c), lo, hi)
+
+        # At least one parameter always comes from the mutant
+        cross = rng.random(x.shape) < crossover
+        cross[np.arange(population), rng.integers(0, len(parameters), population)] = True
+        trial = np.where(cross, mutant, x)
+
+        f_trial = evaluate(trial)
+        better  = f_trial <= f
+        x[better] = trial[better]
+        f[better] = f_trial[better]
+        history.append(f.min())
+
+        if np.std(f) < tol:
+            break
+
+    best = np.argmin(f)
+
+    return {'parameters':  dict(zip(parameters, x[best].tolist())),
+            'objective':   float(f[best]),
+            'generations': generation,
+            'history':     history}
+
+
+def main(args):
+    '''
+    Fit parameters for the command line site and print them as command line options
+    '''
+
+    site = dict((n, v) for n, v in vars(ps.ForecastConfig.from_args(args)).items()
+                if n not in ('forecast_minutes', 'report_period', 'integrator', 'tolerance'))
+
+    weights = {}
+    for weight in args.weights.split(','):
+        v, w = weight.split('=')
+        weights[v.strip()] = float(w)
+
+    # Fitted parameters may not be set on the command line
+    for p in args.parameters.split(','):
+        site.pop(p, None)
+
+    result = calibrate(site, read_observations(args.observations),
+                       args.parameters.split(','), weights=weights,
+                       forecast_minutes=args.forecast_minutes,
+                       population=args.population, generations=args.generations,
+                       seed=args.seed)
+
+    print("Objective:\t", result['objective'])
+    print("Generations:\t", result['generations'])
+    print(" ".join("%s %.7f" % (OPTIONS.get(p, '--' + p), v)
+                   for p, v in sorted(result['parameters'].items())))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Fit parameters to observed surface temperature at latitude and longitude")
+
+    cal = parser.add_argument_group('calibration arguments')
+    cal.add_argument('-ob', '--observations',
+            help='Tab separated observations file with Day, Hour, Minute and T_s or other CSV output columns',
+            required=True, type=str)
+    cal.add_argument('-pa', '--parameters',
+            help='Comma separated parameters to fit - default=%(default)s',
+            default=','.join(PARAMETERS), type=str)
+    cal.add_argument('-we', '--weights',
+            help='Comma separated objective weights for observed variables - default=%(default)s',
+            default='T_s=1', type=str)
+    cal.add_argument('-po', '--population',
+            help='Candidates per generation - default 10 per fitted parameter',
+            default=None, type=ps.int_range(4, None), metavar="[4, None]")
+    cal.add_argument('-ge', '--generations',
+            help='Maximum number of generations - default=%(default)s',
+            default=100, type=ps.int_range(1, None), metavar="[1, None]")
+    cal.add_argument('-se', '--seed',
+            help='Random seed - default=%(default)s',
+            default=None, type=int)
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,255 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import json
+import hashlib
+import tempfile
+
+import parametricscheme as ps
+
+
+# NOTE Extend forecasts from saved state instead of recomputing them
+#      Euler forecasts with the same parameters follow the same trajectory whatever
+#      forecast_minutes is, so a 1440 minute forecast can start from the end of an
+#      earlier 720 minute forecast
+#      Checkpoints are stored under a hash of the parameters other than forecast_minutes
+#      Each holds the state after some number of steps plus the report rows since
+#      the checkpoint it resumed from
+#      Floats are stored as JSON which round trips exactly, so resumed forecasts
+#      are bit-identical to uninterrupted ones
+#      Adaptive rk23 steps depend on the report times so those forecasts are never cached,
+#      nor are forecasts with aggregates as the checkpoints hold no period statistics
+
+
+# Change when the equations change so old checkpoints are not used
+VERSION = 1
+
+# Parameters which do not change the trajectory or report rows
+IGNORED = ('forecast_minutes', 'tolerance')
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'parametricscheme')
+
+
+def digest(config):
+    '''
+    Content address of the checkpoints for a ForecastConfig
+    '''
+
+    params = dict((n, v) for n, v in vars(config).items() if n not in IGNORED)
+    params['degrees'] = str(params['degrees']).upper()
+    params['version'] = VERSION
+
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CheckpointCache(object):
+    '''
+    On disk checkpoints in directory, one subdirectory per parameter hash
+    and one JSON file per checkpoint named after its step
+    '''
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def path(self, key, step=None):
+        if step is None:
+            return os.path.join(self.directory, key[:2], key)
+        return os.path.join(self.directory, key[:2], key, '%010d.json' % step)
+
+    def steps(self, key):
+        '''
+        Steps with a saved checkpoint, longest first
+        '''
+
+        try:
+            names = os.listdir(self.path(key))
+        except OSError:
+            return []
+
+        return sorted((int(n[:-5]) for n in names if n.endswith('.json') and n[:-5].isdigit()),
+                      reverse=True)
+
+    def load(self, key, step):
+        '''
+        Checkpoint after step steps and every report row before it
+        Returns (state, rows) or None if any checkpoint in the chain is missing
+        '''
+
+        rows  = []
+        state = None
+
+        while step is not None:
+            try:
+                with open(self.path(key, step)) as f:
+                    checkpoint = json.load(f)
+            except (OSError, ValueError):
+                return None
+
+            if state is None:
+                state = checkpoint['state']
+            rows[:0] = [tuple(row) for row in checkpoint['rows']]
+            step = checkpoint['previous']
+
+        return state, rows
+
+    def save(self, key, params, step, previous, state, rows):
+        '''
+        Save the state after step steps and the report rows since previous
+        '''
+
+        directory = self.path(key)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        checkpoint = {'parameters': params, 'step': step, 'previous': previous,
+                      'state': state, 'rows': rows}
+
+        # Write then rename so a checkpoint is never read half written
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, self.path(key, step))
+
+
+def get_state(args, step, sum_d_T_s, Q):
+    '''
+    Serialisable euler_reports state after step steps
+    '''
+
+    return {'step':         step,
+            'surface_temp': args.surface_temp,
+            'year':         args.year,
+            'day_of_year':  args.day_of_year,
+            'hour':         args.hour,
+            'minute':       args.minute,
+            'sum_d_T_s':    sum_d_T_s,
+            'Q':            list(Q)}
+
+
+def set_state(args, state):
+    '''
+    Restore the clock and surface temperature saved by get_state
+    Returns keyword arguments for euler_reports
+    '''
+
+    for name in ('surface_temp', 'year', 'day_of_year', 'hour', 'minute'):
+        setattr(args, name, state[name])
+
+    return {'start': state['step'], 'sum_d_T_s': state['sum_d_T_s'], 'Q': tuple(state['Q'])}
+
+
+def iter_forecast(config, cache=None, every=None):
+    '''
+    Same rows as parametricscheme.iter_forecast, resuming from the longest
+    saved checkpoint of a forecast with the same parameters
+
+    Saves a checkpoint at the end of the forecast and, if every is set, at the
+    first report at least every minutes after the previous checkpoint
+    '''
+
+    if cache is None:
+        cache = CheckpointCache()
+
+    config.validate()
+
+    if config.integrator != 'euler' or config.aggregates:
+        for row in ps.iter_forecast(config):
+            yield row
+        return
+
+    args   = config.to_state()
+    key    = digest(config)
+    params = dict((n, v) for n, v in vars(config).items() if n not in IGNORED)
+
+    previous, resume = None, {}
+    for step in cache.steps(key):
+        if step <= config.forecast_minutes:
+            loaded = cache.load(key, step)
+            if loaded is not None:
+                state, rows = loaded
+                for row in rows:
+                    yield row
+                previous, resume = step, set_state(args, state)
+                break
+
+    # Reports are yielded after these steps, the last one by the final yield
+    report_steps = iter(ps.report_minutes(args)[:-1])
+    next_report  = next(report_steps, None)
+    while next_report is not None and previous is not None and next_report <= previous:
+        next_report = next(report_steps, None)
+
+    rows = []
+    for Q, d_T_s, T_s in ps.euler_reports(args, **resume):
+        row = (args.day_of_year, args.hour, args.minute) + Q + (d_T_s, ps.from_kelvin(args, T_s))
+
+        if next_report is None:
+            # Final values after every step
+            if previous != config.forecast_minutes:
+                cache.save(key, params, config.forecast_minutes, previous,
+                           get_state(args, config.forecast_minutes, d_T_s, Q), rows)
+        else:
+            rows.append(row)
+
+            if every is not None and next_report - (previous or 0) >= every:
+                cache.save(key, params, next_report, previous,
+                           get_state(args, next_report, 0, Q), rows)
+                previous, rows = next_report, []
+
+            next_report = next(report_steps, None)
+
+        yield row
+
+
+def run_forecast(config, cache=None, every=None):
+    '''
+    Same dict of column lists as parametricscheme.run_forecast using checkpoints
+    '''
+
+    rows    = list(iter_forecast(config, cache, every))
+    columns = ps.COLUMNS + ps.aggregate_columns(config.aggregates)
+
+    return dict((c, [row[i] for row in rows]) for i, c in enumerate(columns))
+
+
+def main(args):
+    '''
+    Calculate surface temperature resuming from checkpoints
+    Optionally write to CSV or .npy file every args.report_period minutes
+    '''
+
+    writer = None
+    if args.filename is not None:
+        writer = ps.open_writer(args.filename, ps.COLUMNS + ps.aggregate_columns(args.aggregates))
+
+    try:
+        for row in iter_forecast(ps.ForecastConfig.from_args(args),
+                                 CheckpointCache(args.cache_dir), args.every):
+            if writer is not None:
+                writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print("T_s:\t", row[len(ps.COLUMNS) - 1])
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature at latitude and longitude reusing earlier forecasts")
+
+    cp = parser.add_argument_group('checkpoint arguments')
+    cp.add_argument('-cd', '--cache_dir',
+            help='Checkpoint directory - default=%(default)s',
+            default=CACHE_DIR, type=str)
+    cp.add_argument('-ev', '--every',
+            help='Also save a checkpoint every this many minutes - default only at the end',
+            default=None, type=ps.int_range(1, None), metavar="[1, None]")
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,305 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import math
+import cmath
+import argparse
+
+import parametricscheme as ps
+
+
+# NOTE Forecasts without a step per minute when the surface temperature equation is linear
+#      With a constant atmospheric temperature and no clouds Q_Ld and Q_Lu do not depend
+#      on T_s, and with percent net radiation neither do Q_H and Q_E, so each step is
+#          T_s' - T_g = r (T_s - T_g) + c (H (Q_Ld - Q_Lu) + H Q_S)
+#      with r = 1 - K d_t / c_g, c = d_t / c_g and H = 1 - pc_nr - pc_nr / bowen_ratio
+#      Q_S is a cosine of the hour angle during daylight, so the sum of the
+#      geometrically weighted solar forcing between reports has a closed form
+#      One report costs one closed form per day it spans instead of one step per minute
+#      The euler solution is the Euler recurrence itself, equal to stepping to within
+#      rounding, the ode solution is the exact solution of the continuous equation
+#      Forecasts which do not qualify fall back to parametricscheme.iter_forecast
+
+
+# "Constants"
+S     = 1368                 # W m^-2 - Solar irradiance, same as solar_rad
+K     = 11                   # J m^-2 K^-1 s^-1 - Thermal diffusivity of air, same as ground_heat_flux
+D_T   = 60                   # s - Time step
+OMEGA = math.radians(0.25)   # Hour angle change per minute
+
+# Solutions selectable with --solution
+SOLUTIONS = ['euler', 'ode']
+
+
+def reasons(config):
+    '''
+    Reasons a ForecastConfig can not use the closed form, empty if it can
+    '''
+
+    reasons = []
+
+    if config.atmos_temp_constant is None:
+        reasons.append("'atmos_temp_constant' is not set")
+    if config.cloud_fraction != 0:
+        reasons.append("'cloud_fraction' is not zero")
+    if config.percent_net_radiation == 0:
+        reasons.append("'percent_net_radiation' is zero so Q_H depends on T_s")
+    if config.integrator != 'euler':
+        reasons.append("'integrator' is not euler")
+    if config.aggregates:
+        reasons.append("'aggregates' need every step")
+
+    return reasons
+
+
+class LinearModel(object):
+    '''
+    Closed form of the linear surface temperature equation for a state from
+    ForecastConfig.to_state, in minutes after the start of the forecast
+    '''
+
+    def __init__(self, args, discrete=True):
+        self.args     = args
+        self.discrete = discrete
+        self.start    = (args.year, args.day_of_year, args.hour, args.minute)
+        self.scratch  = argparse.Namespace(**vars(args))
+
+        pc_nr = args.percent_net_radiation
+        self.H = 1 - pc_nr - pc_nr / args.bowen_ratio
+        self.G = self.H * (ps.downwelling_rad(args) - ps.upwelling_rad(args))
+        self.c = D_T / ps.C_G
+        self.r = 1 - K * D_T / ps.C_G   # Euler decay per step
+        self.k = K * D_T / ps.C_G       # Continuous decay rate per minute
+
+        self.minute_of_day = args.hour * 60 + args.minute
+
+    def clock(self, minutes):
+        '''
+        Scratch state with the clock minutes after the start
+        '''
+
+        ps.set_clock(self.scratch, self.start, minutes)
+
+        return self.scratch
+
+    def decay(self, n):
+        '''
+        Weight of the surface temperature n minutes earlier
+        '''
+
+        return self.r**n if self.discrete else math.exp(-self.k * n)
+
+    def sums(self, b, p, q, alpha):
+        '''
+        Weighted sums, or integrals, of 1 and cos(hour angle) over steps p to q
+        weighted by the decay to b, alpha is the hour angle at p
+        '''
+
+        if self.discrete:
+            # Steps p to q inclusive
+            n = q - p + 1
+            w = self.r**(b - 1 - q)
+            z = self.r * cmath.exp(-1j * OMEGA)
+            ones   = w * (1 - self.r**n) / (1 - self.r)
+            cosine = w * cmath.exp(1j * (alpha + OMEGA * (q - p))) * (1 - z**n) / (1 - z)
+        else:
+            # Times p to q
+            w_p, w_q = math.exp(-self.k * (b - p)), math.exp(-self.k * (b - q))
+            ones   = (w_q - w_p) / self.k
+            cosine = (w_q * cmath.exp(1j * (alpha + OMEGA * (q - p))) - w_p * cmath.exp(1j * alpha)) / (self.k + 1j * OMEGA)
+
+        return ones, cosine.real
+
+    def daylight(self, lo, hi, alpha, threshold):
+        '''
+        (first, last) daylight intervals between lo and hi where cos(hour angle)
+        is at least threshold, alpha is the hour angle at lo
+        Steps are checked with zenith so they match the stepped forecast exactly
+        '''
+
+        if threshold <= -1:
+            intervals = [(lo, hi)]
+        elif threshold > 1:
+            intervals = []
+        else:
+            theta = math.acos(threshold)
+            first = int(math.floor((alpha - theta) / (2 * math.pi)))
+            last  = int(math.ceil((alpha + OMEGA * (hi - lo) + theta) / (2 * math.pi)))
+            intervals = []
+            for j in range(first, last + 1):
+                a = max(lo, lo + (2 * math.pi * j - theta - alpha) / OMEGA)
+                b = min(hi, lo + (2 * math.pi * j + theta - alpha) / OMEGA)
+                if a <= b:
+                    intervals.append((a, b))
+
+        if not self.discrete:
+            return intervals
+
+        def is_day(i):
+            return ps.zenith(self.clock(i)) >= 0
+
+        steps = []
+        for a, b in intervals:
+            a, b = int(math.ceil(a)), int(math.floor(b))
+            while a > lo and is_day(a - 1):
+                a -= 1
+            while a <= b and not is_day(a):
+                a += 1
+            while b < hi and is_day(b + 1):
+                b += 1
+            while b >= a and not is_day(b):
+                b -= 1
+            if a <= b:
+                if steps and a <= steps[-1][1] + 1:
+                    steps[-1] = (steps[-1][0], max(b, steps[-1][1]))
+                else:
+                    steps.append((a, b))
+
+        return steps
+
+    def solar(self, a, b):
+        '''
+        Sum, or integral, of Q_S weighted by the decay to b from a to b
+        One closed form per day
+        '''
+
+        args  = self.args
+        total = 0
+        s = a
+        while s < b:
+            # Days end at midnight, steps s to e - 1 share the day terms
+            e = min(b, s + 1440 - (self.minute_of_day + s) % 1440)
+
+            day   = self.clock(s)
+            alpha = math.radians(ps.local_hour(day))
+            dec   = math.radians(ps.declination(day))
+            lat   = math.radians(args.latitude)
+            z_sin = math.sin(lat) * math.sin(dec)
+            z_cos = math.cos(lat) * math.cos(dec)
+            A     = S * ps.elliptical_orbit_ratio(day)**2 * (1 - args.albedo) * args.transmissivity
+
+            # Based on Equations 2.1 and 2.2  Pages 22 and 23
+            threshold = -z_sin / z_cos if z_cos > 0 else (-math.inf if z_sin >= 0 else math.inf)
+            last      = e - 1 if self.discrete else e
+            for p, q in self.daylight(s, last, alpha, threshold):
+                ones, cosine = self.sums(b, p, q, alpha + OMEGA * (p - s))
+                total += A * (z_sin * ones + z_cos * cosine)
+
+            s = e
+
+        return total
+
+    def advance(self, u, a, b):
+        '''
+        T_s - T_g at b from T_s - T_g at a
+        '''
+
+        if b == a:
+            return u
+
+        if self.discrete:
+            ones = (1 - self.r**(b - a)) / (1 - self.r)
+        else:
+            ones = (1 - math.exp(-self.k * (b - a))) / self.k
+
+        return self.decay(b - a) * u + self.c * (self.G * ones + self.H * self.solar(a, b))
+
+
+def closed_reports(args, discrete=True):
+    '''
+    Same reports as euler_reports using the closed form between reports
+    args must satisfy reasons, the fluxes of each report are from the last step
+    '''
+
+    model = LinearModel(args, discrete)
+    T_g   = args.ground_temp
+    u     = args.surface_temp - T_g
+    done  = 0
+    Q     = None
+
+    for report in ps.report_minutes(args):
+        if report == done:
+            yield Q, 0, T_g + u
+            continue
+
+        # Up to the last step, then the fluxes of the last step
+        u_last = model.advance(u, done, report - 1)
+        state  = model.clock(report - 1)
+        state.surface_temp = T_g + u_last
+        Q = ps.fluxes(state)
+
+        if discrete:
+            # Based on only equation in question 6  Page 61
+            T_s = state.surface_temp + (Q[0] + Q[1] - Q[2] - Q[3] - Q[4] - Q[5]) * D_T / ps.C_G
+        else:
+            T_s = T_g + model.advance(u_last, report - 1, report)
+
+        d_T_s = T_s - (T_g + u)
+        u, done = T_s - T_g, report
+
+        ps.set_clock(args, model.start, report)
+        args.surface_temp = T_s
+
+        yield Q, d_T_s, T_s
+
+
+def iter_forecast(config, solution='euler'):
+    '''
+    Same rows as parametricscheme.iter_forecast using the closed form when reasons
+    is empty, otherwise parametricscheme.iter_forecast itself
+    solution is euler for the Euler recurrence or ode for the continuous solution
+    '''
+
+    if reasons(config):
+        for row in ps.iter_forecast(config):
+            yield row
+        return
+
+    config.validate()
+    args = config.to_state()
+
+    for Q, d_T_s, T_s in closed_reports(args, solution == 'euler'):
+        yield (args.day_of_year, args.hour, args.minute) + Q + (d_T_s, ps.from_kelvin(args, T_s))
+
+
+def main(args):
+    '''
+    Calculate surface temperature using the closed form where possible
+    Optionally write to CSV or .npy file every args.report_period minutes
+    '''
+
+    config = ps.ForecastConfig.from_args(args)
+
+    writer = None
+    if args.filename is not None:
+        writer = ps.open_writer(args.filename, ps.COLUMNS + ps.aggregate_columns(config.aggregates))
+
+    try:
+        for row in iter_forecast(config, args.solution):
+            if writer is not None:
+                writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print("T_s:\t", row[len(ps.COLUMNS) - 1])
+    for reason in reasons(config):
+        print("Stepped:\t", reason)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature at latitude and longitude in closed form")
+
+    cf = parser.add_argument_group('closed form arguments')
+    cf.add_argument('-so', '--solution',
+            help='Solution of the linear equation, the Euler recurrence or the continuous equation - default=%(default)s',
+            default='euler', choices=SOLUTIONS)
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,327 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+import grid
+
+
+# NOTE Precomputed surface temperature for instant approximate forecasts
+#      The T_s of every report is forecast once for every node of a regular grid
+#      over the parameters below and saved to a memory mapped .npy table
+#      Forecasts between nodes are multilinear interpolations of the 2^8 surrounding
+#      nodes, only those rows of the table are read from disk
+#      Errors are measured against full forecasts at random points when the table
+#      is built and saved with it in the emulator.json sidecar
+
+
+# Parameters varied across the table, in table axis order
+PARAMETERS = ['latitude', 'day_of_year', 'albedo', 'emissivity', 'transmissivity',
+              'percent_net_radiation', 'surface_temp', 'ground_temp']
+
+# ForecastConfig parameters without defaults, those not in PARAMETERS must be fixed
+REQUIRED = ['latitude', 'longitude', 'day_of_year', 'ground_temp', 'surface_temp',
+            'degrees', 'percent_net_radiation']
+
+# (lowest, highest, nodes) of each parameter
+AXES = {
+    'latitude':              (-90.0, 90.0, 7),
+    'day_of_year':           (1, 365, 7),
+    'albedo':                (0.0, 1.0, 3),
+    'emissivity':            (0.7, 0.99, 3),
+    'transmissivity':        (0.0, 1.0, 3),
+    'percent_net_radiation': (0.1, 0.6, 3),
+}
+
+# (lowest, highest, nodes) of surface and ground temperature in each degrees
+TEMP_AXES = {
+    'C': (-10.0, 40.0, 3),
+    'F': (14.0, 104.0, 3),
+}
+
+# Names of the table and metadata sidecar in the emulator directory
+TABLE    = 'T_s.npy'
+METADATA = 'emulator.json'
+
+
+def default_axes(degrees):
+    '''
+    AXES with the surface and ground temperature axes for degrees
+    '''
+
+    axes = dict(AXES)
+    axes['surface_temp'] = axes['ground_temp'] = TEMP_AXES[degrees.upper()]
+
+    return axes
+
+
+def nodes(lo, hi, n, name):
+    '''
+    Node values of one axis, whole days for day_of_year
+    '''
+
+    values = np.linspace(lo, hi, n)
+    if name == 'day_of_year':
+        values = np.unique(np.round(values))
+
+    if len(values) < 2:
+        raise ValueError("axis '%s' needs at least two different nodes" % name)
+
+    return values
+
+
+def check_axes(axes, degrees, fixed, forecast_minutes, report_period):
+    '''
+    Raise ValueError for axes outside the command line ranges or invalid fixed parameters
+    '''
+
+    for name in PARAMETERS:
+        lo, hi, n = axes[name]
+        if name in ('surface_temp', 'ground_temp'):
+            errors = ps.temp_errors(lo, degrees) + ps.temp_errors(hi, degrees)
+            if errors:
+                raise ValueError("axis '%s': %s" % (name, "; ".join(errors)))
+        else:
+            min, max = ps.RANGES[name]
+            if (min is not None and lo < min) or (max is not None and hi > max):
+                raise ValueError("axis '%s' [%r, %r] not in range [%r, %r]" % (name, lo, hi, min, max))
+
+    for name in fixed:
+        if name in PARAMETERS or name in ('degrees', 'forecast_minutes', 'report_period'):
+            raise ValueError("'%s' can not be a fixed parameter" % name)
+
+    # Check everything else once using the lowest corner
+    corner = dict(fixed, degrees=degrees)
+    for name in PARAMETERS:
+        corner[name] = axes[name][0]
+
+    missing = [name for name in REQUIRED if name not in corner]
+    if missing:
+        raise ValueError("missing fixed parameters: %s" % ", ".join(missing))
+
+    try:
+        config = ps.ForecastConfig(forecast_minutes=forecast_minutes, report_period=report_period, **corner)
+    except TypeError as e:
+        raise ValueError(str(e))
+    config.validate()
+
+
+class Emulator(object):
+    '''
+    Emulator table in directory, memory mapped so only interpolated rows are read
+    '''
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, METADATA)) as f:
+            self.metadata = json.load(f)
+
+        self.table  = np.load(os.path.join(directory, TABLE), mmap_mode='r')
+        self.nodes  = [np.array(self.metadata['nodes'][name]) for name in PARAMETERS]
+        self.shape  = tuple(len(v) for v in self.nodes)
+        self.rows   = self.table.reshape(-1, self.table.shape[-1])
+        self.error  = np.array(self.metadata.get('error_max', np.full(self.table.shape[-1], np.nan)))
+
+        # Offsets of the 2^8 surrounding nodes, and row strides of each axis
+        self.corners = (np.arange(2**len(PARAMETERS))[:, None] >> np.arange(len(PARAMETERS))[::-1]) & 1
+        self.strides = np.array([int(np.prod(self.shape[j + 1:])) for j in range(len(PARAMETERS))])
+
+    def predict(self, **params):
+        '''
+        Interpolated T_s of every report in the forecast degrees
+
+        params maps each of PARAMETERS to a scalar or per-forecast values
+        Returns (T_s, error), T_s shaped (reports,) for scalars or
+        (forecasts, reports), and error the largest absolute difference from
+        full forecasts at each report measured when the table was built
+        Raises ValueError outside the table
+        '''
+
+        missing = set(PARAMETERS) - set(params)
+        if missing:
+            raise ValueError("missing parameters: %s" % ", ".join(sorted(missing)))
+
+        scalar = all(np.ndim(params[name]) == 0 for name in PARAMETERS)
+        x = np.column_stack(np.broadcast_arrays(*[np.atleast_1d(np.asarray(params[name], dtype=float))
+                                                  for name in PARAMETERS]))
+
+        index  = np.empty(x.shape, dtype=np.intp)
+        weight = np.empty(x.shape)
+        for j, (name, values) in enumerate(zip(PARAMETERS, self.nodes)):
+            if np.any(x[:, j] < values[0]) or np.any(x[:, j] > values[-1]):
+                raise ValueError("'%s' outside the emulator range [%r, %r]" % (name, values[0], values[-1]))
+            i = np.clip(np.searchsorted(values, x[:, j], side='right') - 1, 0, len(values) - 2)
+            index[:, j]  = i
+            weight[:, j] = (x[:, j] - values[i]) / (values[i + 1] - values[i])
+
+        rows = (index[:, None, :] + self.corners[None]) @ self.strides
+        w    = np.prod(np.where(self.corners[None], weight[:, None, :], 1 - weight[:, None, :]), axis=2)
+        T_s  = np.einsum('nc,ncr->nr', w, self.rows[rows])
+
+        return (T_s[0] if scalar else T_s), self.error
+
+
+def node_sites(axis_nodes, shape, start, stop, fixed, degrees):
+    '''
+    arrayscheme sites for table rows start to stop
+    '''
+
+    sites = dict(fixed, degrees=degrees)
+    for name, values, i in zip(PARAMETERS, axis_nodes, np.unravel_index(np.arange(start, stop), shape)):
+        sites[name] = values[i]
+
+    return sites
+
+
+def build(output, degrees, axes=None, fixed=None,
+          forecast_minutes=1440, report_period=60,
+          validate=1000, chunk=20000, seed=0, dtype='float32'):
+    '''
+    Forecast every node of the table and measure errors at validate random points
+
+    axes maps PARAMETERS to (lowest, highest, nodes), missing ones use default_axes
+    fixed maps other ForecastConfig parameters to values used for every forecast
+    Returns the metadata also written to output/emulator.json
+    '''
+
+    fixed = dict(fixed or {})
+    axes  = dict(default_axes(degrees), **(axes or {}))
+    check_axes(axes, degrees, fixed, forecast_minutes, report_period)
+
+    axis_nodes = [nodes(axes[name][0], axes[name][1], axes[name][2], name) for name in PARAMETERS]
+    shape      = tuple(len(v) for v in axis_nodes)
+    reports    = len(ps.report_minutes(argparse.Namespace(forecast_minutes=forecast_minutes,
+                                                         report_period=report_period)))
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    table = np.lib.format.open_memmap(os.path.join(output, TABLE), mode='w+',
+                                      dtype=dtype, shape=shape + (reports,))
+    rows  = table.reshape(-1, reports)
+
+    for start in range(0, rows.shape[0], chunk):
+        stop  = min(start + chunk, rows.shape[0])
+        sites = node_sites(axis_nodes, shape, start, stop, fixed, degrees)
+        rows[start:stop] = arrayscheme.forecast(sites, forecast_minutes, report_period)['T_s']
+    table.flush()
+    del table, rows
+
+    metadata = {'degrees':          degrees.upper(),
+                'parameters':       PARAMETERS,
+                'nodes':            dict((n, v.tolist()) for n, v in zip(PARAMETERS, axis_nodes)),
+                'fixed':            fixed,
+                'forecast_minutes': forecast_minutes,
+                'report_period':    report_period,
+                'report_minutes':   ps.report_minutes(argparse.Namespace(forecast_minutes=forecast_minutes,
+                                                                         report_period=report_period))}
+    grid.write_metadata(output, metadata, METADATA)
+
+    if validate:
+        rng    = np.random.default_rng(seed)
+        points = dict((name, rng.uniform(v[0], v[-1], validate)) for name, v in zip(PARAMETERS, axis_nodes))
+        points['day_of_year'] = np.round(points['day_of_year'])
+
+        expected = arrayscheme.forecast(dict(fixed, degrees=degrees, **points),
+                                        forecast_minutes, report_period)['T_s']
+        predicted = Emulator(output).predict(**points)[0]
+        error     = np.abs(predicted - expected)
+
+        metadata['validation_points'] = validate
+        metadata['error_max'] = error.max(axis=0).tolist()
+        metadata['error_rms'] = np.sqrt(np.mean(error**2, axis=0)).tolist()
+        grid.write_metadata(output, metadata, METADATA)
+
+    return metadata
+
+
+def axis(value):
+    '''
+    LO,HI,N command line axis
+    '''
+
+    lo, hi, n = value.split(',')
+
+    return float(lo), float(hi), int(n)
+
+
+def main(args):
+    '''
+    Build the emulator and print its size, errors and query time
+    '''
+
+    axes = grid.pairs(args.axis, axis)
+    for name in axes:
+        if name not in PARAMETERS:
+            raise ValueError("unknown axis '%s', must be one of %s" % (name, ", ".join(PARAMETERS)))
+
+    start    = time.perf_counter()
+    metadata = build(args.output, args.degrees, axes, grid.pairs(args.set, grid.number),
+                     args.forecast_minutes, args.report_period, args.validate,
+                     args.chunk, args.seed, args.dtype)
+    built    = time.perf_counter() - start
+
+    emulator = Emulator(args.output)
+    centre   = dict((name, (v[0] + v[-1]) / 2) for name, v in zip(PARAMETERS, emulator.nodes))
+    repeats  = 1000
+    start    = time.perf_counter()
+    for i in range(repeats):
+        emulator.predict(**centre)
+    query    = (time.perf_counter() - start) / repeats
+
+    print("Table:\t\t", " x ".join(str(n) for n in emulator.table.shape),
+          "(%.1f MB)" % (emulator.table.nbytes / 2**20))
+    print("Build:\t\t %.1f s" % built)
+    print("Query:\t\t %.1f us" % (query * 1e6))
+    if 'error_max' in metadata:
+        print("Max error:\t %.4g" % max(metadata['error_max']))
+        print("RMS error:\t %.4g" % float(np.sqrt(np.mean(np.square(metadata['error_rms'])))))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Build an emulator of surface temperature for instant approximate forecasts "
+                        "https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-ou', '--output',
+            help='Output directory for the table and emulator.json',
+            required=True, type=str)
+    parser.add_argument('-de', '--degrees',
+            help='Fahrenheit or Celsius',
+            required=True, choices=['C', 'F', 'c', 'f'])
+    parser.add_argument('-ax', '--axis',
+            help='Range and nodes of a parameter, for example albedo=0.1,0.4,4 - defaults are in emulator.AXES',
+            action='append', metavar='NAME=LO,HI,N')
+    parser.add_argument('-se', '--set',
+            help='Parameter used for every forecast using the long option name, for example hour=13',
+            action='append', metavar='NAME=VALUE')
+    parser.add_argument('-fm', '--forecast_minutes',
+            help='Number of minutes to forecast - default=%(default)s',
+            default=1440, type=ps.int_range(*ps.RANGES['forecast_minutes']), metavar="[1, None]")
+    parser.add_argument('-rp', '--report_period',
+            help='Report period in minutes - default=%(default)s',
+            default=60, type=ps.int_range(*ps.RANGES['report_period']), metavar="[1, None]")
+    parser.add_argument('-va', '--validate',
+            help='Random forecasts used to measure errors - default=%(default)s',
+            default=1000, type=ps.int_range(0, None), metavar="[0, None]")
+    parser.add_argument('-ch', '--chunk',
+            help='Forecasts run at a time while building - default=%(default)s',
+            default=20000, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-sd', '--seed',
+            help='Random seed for the validation forecasts - default=%(default)s',
+            default=0, type=int)
+    parser.add_argument('-dt', '--dtype',
+            help='Table data type - default=%(default)s',
+            default='float32', choices=['float32', 'float64'])
+
+    sys.exit(main(parser.parse_args()))
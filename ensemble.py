@@ -0,0 +1,185 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+
+
+# NOTE Perturbed parameter ensembles
+#      Many albedo, emissivity, transmissivity etc combinations fit the Madaus
+#      predictions about equally well, so a single forecast understates uncertainty
+#      Every member is a site in one arrayscheme batch and each report is
+#      summarised as soon as it is calculated, member trajectories are never stored
+
+
+# Default standard deviation of the normal perturbation for each parameter
+SPREAD = {
+    'albedo':                0.05,
+    'emissivity':            0.03,
+    'transmissivity':        0.05,
+    'percent_net_radiation': 0.05,
+    'precip_water':          0.25,
+    'cloud_fraction':        0.1,
+    'bowen_ratio':           0.2,
+}
+
+# Lower limits used instead of RANGES where the range minimum breaks the equations
+# log10(0) precipitable water and no sensible heat flux without resistance
+LIMITS = {
+    'precip_water':          (0.01, ps.RANGES['precip_water'][1]),
+    'percent_net_radiation': (0.01, ps.RANGES['percent_net_radiation'][1]),
+}
+
+# Smallest magnitude of parameters which are divided by, Q_E = Q_H / bowen_ratio
+MIN_MAGNITUDE = {
+    'bowen_ratio': 0.01,
+}
+
+# Percentiles included in each summary
+PERCENTILES = (10, 50, 90)
+
+# Summarised columns
+VARIABLES = ps.COLUMNS[3:]
+
+# Summary statistics added to the name of each variable
+STATISTICS = ['mean', 'std'] + ['p%d' % q for q in PERCENTILES]
+
+# Columns of each summary
+SUMMARY_COLUMNS = ps.COLUMNS[:3] + ['members'] + ['%s_%s' % (v, s) for v in VARIABLES for s in STATISTICS]
+
+
+def sample(site, members, spread=None, seed=None):
+    '''
+    Draw parameter sets for each member around the site parameters
+
+    site is a dict of ForecastConfig parameters
+    spread maps perturbed parameters to standard deviations, defaults to SPREAD
+    Perturbed values are clipped to the command line ranges, or LIMITS and
+    MIN_MAGNITUDE where the range includes values the equations can not use
+    Returns a dict of arrayscheme site parameters with one value per member
+    '''
+
+    if spread is None:
+        spread = SPREAD
+
+    rng   = np.random.default_rng(seed)
+    sites = dict(site)
+
+    for name, sd in sorted(spread.items()):
+        value = site.get(name, ps.DEFAULTS.get(name))
+        lo, hi = LIMITS.get(name, ps.RANGES[name])
+
+        # Percent net radiation can be 0 when the resistance sets Q_H instead
+        if name == 'percent_net_radiation' and site.get('resistance', ps.DEFAULTS['resistance']):
+            lo, hi = ps.RANGES[name]
+
+        sites[name] = np.clip(value + sd * rng.standard_normal(members), lo, hi)
+
+        if name in MIN_MAGNITUDE:
+            m = MIN_MAGNITUDE[name]
+            sites[name] = np.where(np.abs(sites[name]) < m, np.where(sites[name] < 0, -m, m), sites[name])
+
+    return sites
+
+
+def summarise(row):
+    '''
+    Summarise one report of every member
+    Returns a tuple of SUMMARY_COLUMNS values
+
+    Members with a non-finite T_s are left out of every summary and
+    counted out of the members column
+    '''
+
+    finite = np.isfinite(row['T_s'])
+    values = np.array([row[v][finite] for v in VARIABLES])
+    if finite.any():
+        pcs   = np.percentile(values, PERCENTILES, axis=1)
+        stats = np.column_stack([values.mean(axis=1), values.std(axis=1)] + list(pcs))
+    else:
+        stats = np.full((len(VARIABLES), len(STATISTICS)), np.nan)
+
+    # Every member has the same clock
+    clock = tuple(int(row[c][0]) for c in ps.COLUMNS[:3])
+
+    return clock + (int(finite.sum()),) + tuple(stats.ravel())
+
+
+def iter_ensemble(site, members=50, spread=None, seed=None,
+                  forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+                  report_period=ps.DEFAULTS['report_period']):
+    '''
+    Forecast a perturbed parameter ensemble for one site
+
+    Lazily yields a tuple of SUMMARY_COLUMNS values, the mean, standard deviation
+    and percentiles of every member, each report period plus the final values
+    '''
+
+    config = ps.ForecastConfig(forecast_minutes=forecast_minutes,
+                               report_period=report_period, **site)
+    config.validate()
+
+    sites = sample(site, members, spread, seed)
+
+    for row in arrayscheme.iter_forecast(sites, forecast_minutes, report_period):
+        yield summarise(row)
+
+
+def main(args):
+    '''
+    Forecast an ensemble for the command line site
+    Optionally write summaries to CSV or .npy file every args.report_period minutes
+    '''
+
+    site = dict((n, v) for n, v in vars(ps.ForecastConfig.from_args(args)).items()
+                if n not in ('forecast_minutes', 'report_period', 'integrator', 'tolerance'))
+    spread = dict((n, sd * args.spread_scale) for n, sd in SPREAD.items())
+
+    writer = None
+    if args.filename is not None:
+        writer = ps.open_writer(args.filename, SUMMARY_COLUMNS)
+
+    try:
+        for summary in iter_ensemble(site, args.members, spread, args.seed,
+                                     args.forecast_minutes, args.report_period):
+            if writer is not None:
+                writer.write(summary)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    summary = dict(zip(SUMMARY_COLUMNS, summary))
+    print("T_s:\t", " ".join("%s %s" % (s, summary['T_s_' + s]) for s in STATISTICS))
+    if summary['members'] < args.members:
+        print("Non-finite members:\t", args.members - summary['members'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate perturbed parameter ensemble surface temperature at latitude and longitude")
+
+    ens = parser.add_argument_group('ensemble arguments')
+    ens.add_argument('-me', '--members',
+            help='Number of ensemble members - default=%(default)s',
+            default=50, type=ps.int_range(2, None), metavar="[2, None]")
+    ens.add_argument('-ss', '--spread_scale',
+            help='Multiply the default perturbation standard deviations - default=%(default)s',
+            default=1.0, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+    ens.add_argument('-se', '--seed',
+            help='Random seed - default=%(default)s',
+            default=None, type=int)
+
+    args = parser.parse_args()
+
+    if args.integrator != 'euler':
+        parser.error("ensembles only support the euler integrator")
+    if args.aggregates:
+        parser.error("--aggregates is not supported for ensembles")
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
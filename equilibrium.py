@@ -0,0 +1,155 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import math
+
+import parametricscheme as ps
+
+
+# NOTE Periodic diurnal surface temperature found directly instead of by spin-up
+#      With fixed parameters every day maps the initial surface temperature to the
+#      temperature one period later, the periodic solution is the fixed point of that map
+#      Shooting with secant (quasi-Newton) steps on the map finds it in a few one day
+#      forecasts, where spin-up needs one forecast per day until the start is forgotten
+#      Solar geometry still follows the day of year so the cycle is periodic to
+#      within the change in solar geometry over one period
+
+
+# Largest change in surface temperature over one period at the solution in K
+RESIDUAL = 1e-6
+
+# Give up after this many one period forecasts
+MAX_EVALUATIONS = 20
+
+
+def period_map(config, T_s, period):
+    '''
+    Surface temperature in K after period minutes starting from T_s in K
+    '''
+
+    state = config.to_state()
+    state.surface_temp     = T_s
+    state.forecast_minutes = period
+    state.report_period    = period
+
+    for report in ps.INTEGRATORS[state.integrator](state):
+        pass
+
+    return state.surface_temp
+
+
+def solve(config, period=1440, residual=RESIDUAL, max_evaluations=MAX_EVALUATIONS):
+    '''
+    Initial surface temperature of the periodic solution for a ForecastConfig
+    config.surface_temp is the first guess
+
+    Returns a dict with the initial surface_temp in the forecast degrees, the
+    residual change over one period in K, the number of one period forecasts
+    (evaluations), the multiplier d T_s(period) / d T_s(0) if more than one
+    forecast was needed and spinup_days, an estimate of the periods of spin-up
+    needed for the same residual
+    Raises ValueError if the residual is not reached
+    '''
+
+    config.validate()
+
+    x0 = config.to_state().surface_temp
+    g0 = period_map(config, x0, period) - x0
+    x1 = x0 + g0
+    evaluations = 1
+    first = abs(g0)
+    slope = 0
+
+    while not abs(g0) <= residual:
+        if evaluations >= max_evaluations or g0 != g0:
+            raise ValueError("no periodic solution within %g K after %d evaluations" %
+                             (residual, evaluations))
+
+        g1 = period_map(config, x1, period) - x1
+        evaluations += 1
+
+        # Secant slope of g(T) = map(T) - T
+        if g1 != g0:
+            slope = (g1 - g0) / (x1 - x0)
+        x0, g0 = x1, g1
+        x1     = x1 - g1 / slope if slope else x1 + g1
+
+    # Spin-up shrinks the residual by the multiplier every period
+    multiplier = slope + 1 if slope else None
+    if first <= residual:
+        spinup = 0
+    elif multiplier is not None and 0 < abs(multiplier) < 1:
+        spinup = int(math.ceil(math.log(residual / first) / math.log(abs(multiplier))))
+    else:
+        spinup = None
+
+    return {'surface_temp': ps.from_kelvin(config, x0),
+            'residual':     abs(g0),
+            'evaluations':  evaluations,
+            'multiplier':   multiplier,
+            'spinup_days':  spinup}
+
+
+def cycle(config, period=1440, residual=RESIDUAL, max_evaluations=MAX_EVALUATIONS):
+    '''
+    Periodic solution for a ForecastConfig
+
+    Returns (solution, forecast), solution as returned by solve and forecast
+    the run_forecast dict of one period starting from the periodic surface temperature
+    '''
+
+    solution = solve(config, period, residual, max_evaluations)
+
+    params = dict(vars(config), surface_temp=solution['surface_temp'], forecast_minutes=period)
+    params['report_period'] = min(params['report_period'], period)
+
+    return solution, ps.run_forecast(ps.ForecastConfig(**params))
+
+
+def main(args):
+    '''
+    Find the periodic solution for the command line site
+    Optionally write one period to CSV or .npy file every args.report_period minutes
+    '''
+
+    config = ps.ForecastConfig.from_args(args)
+    solution, forecast = cycle(config, args.period, args.residual, args.max_evaluations)
+
+    if args.filename is not None:
+        columns = ps.COLUMNS + ps.aggregate_columns(config.aggregates)
+        with ps.open_writer(args.filename, columns) as writer:
+            for row in zip(*[forecast[c] for c in columns]):
+                writer.write(row)
+
+    print("Periodic T_s:\t", solution['surface_temp'])
+    print("Residual (K):\t", solution['residual'])
+    print("Evaluations:\t", solution['evaluations'])
+    print("Multiplier:\t", solution['multiplier'])
+    print("Spin-up days:\t", solution['spinup_days'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate the periodic diurnal surface temperature at latitude and longitude")
+
+    eq = parser.add_argument_group('equilibrium arguments')
+    eq.add_argument('-pe', '--period',
+            help='Period of the solution in minutes - default=%(default)s',
+            default=1440, type=ps.int_range(1, None), metavar="[1, None]")
+    eq.add_argument('-rs', '--residual',
+            help='Largest change in surface temperature over one period in K - default=%(default)s',
+            default=RESIDUAL, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+    eq.add_argument('-me', '--max_evaluations',
+            help='Largest number of one period forecasts - default=%(default)s',
+            default=MAX_EVALUATIONS, type=ps.int_range(2, None), metavar="[2, None]")
+
+    args = parser.parse_args()
+
+    # One period is forecast, so check the report period against it
+    args.forecast_minutes = args.period
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
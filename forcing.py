@@ -0,0 +1,333 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import itertools
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+import ensemble
+
+
+# NOTE Time-varying cloud fraction, precipitable water, transmissivity and
+#      atmospheric and cloud base temperatures read from a forcing file
+#      The file is read twice, first only the times to precompute the interpolation
+#      index and weight of every step, then the values chunk by chunk while the
+#      forecast runs, so only two samples per site are held in memory at a time
+#      Values are interpolated linearly in time and held constant before the
+#      first and after the last sample
+
+
+# Parameters which can be forced
+VARIABLES = ['cloud_fraction', 'precip_water', 'transmissivity',
+             'atmos_temp_constant', 'cloud_temp_constant']
+
+# Temperatures in the forecast degrees
+TEMP_VARIABLES = ['atmos_temp_constant', 'cloud_temp_constant']
+
+# Time columns, Year is optional
+TIME_COLUMNS = ['Day', 'Hour', 'Minute']
+
+# Rows parsed at a time
+CHUNK_ROWS = 100000
+
+
+def read_header(f):
+    '''
+    Column names and delimiter, tab if the header contains one otherwise comma
+    '''
+
+    header    = f.readline()
+    delimiter = '\t' if '\t' in header else ','
+
+    return [c.strip() for c in header.split(delimiter)], delimiter
+
+
+def read_chunks(filename, chunk_rows=CHUNK_ROWS):
+    '''
+    Lazily yields (column names, array of up to chunk_rows rows) from a
+    comma or tab separated forcing file
+    '''
+
+    with io.open(filename) as f:
+        columns, delimiter = read_header(f)
+
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            yield columns, np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+
+
+def elapsed_minutes(start, year, day, hour, minute):
+    '''
+    Minutes after start (year, day, hour, minute) for arrays of sample times
+    Without a year the day of year is counted from the start day within one year
+    '''
+
+    start_year, start_day, start_hour, start_minute = start
+
+    days = day - start_day
+    if year is not None:
+        # Days from the start of the start year to the start of each sample year
+        offsets = {}
+        for Y in np.unique(year).astype(int):
+            lo, hi = sorted((start_year, Y))
+            offsets[Y] = (1 if Y >= start_year else -1) * sum(ps.days_in_year(y) for y in range(lo, hi))
+        days = days + np.array([offsets[Y] for Y in year.astype(int)])
+
+    return days * 1440 + (hour - start_hour) * 60 + (minute - start_minute)
+
+
+class Forcing(object):
+    '''
+    Forcing file for a forecast starting at start (year, day, hour, minute)
+
+    Columns are Day, Hour, Minute, optionally Year and Site, and any of VARIABLES
+    Site is the index of the site in the forecast, without it every row applies
+    to every site, with it there is one row per site for every sample time
+    Rows must be in time order
+    '''
+
+    def __init__(self, filename, start, sites=1, chunk_rows=CHUNK_ROWS):
+        self.filename   = filename
+        self.start      = start
+        self.sites      = sites
+        self.chunk_rows = chunk_rows
+
+        with io.open(filename) as f:
+            self.columns, self.delimiter = read_header(f)
+
+        for c in TIME_COLUMNS:
+            if c not in self.columns:
+                raise ValueError("forcing file %s has no %s column" % (filename, c))
+
+        self.variables = [v for v in VARIABLES if v in self.columns]
+        unknown = set(self.columns) - set(VARIABLES + TIME_COLUMNS + ['Year', 'Site'])
+        if unknown:
+            raise ValueError("unknown forcing columns: %s" % ", ".join(sorted(unknown)))
+
+        self.times = self.read_times()
+        if len(self.times) > 1 and np.any(np.diff(self.times) <= 0):
+            raise ValueError("forcing file %s is not in time order" % filename)
+
+    def iter_chunks(self):
+        '''
+        Lazily yields (column names, elapsed minutes of each row, rows) chunk by chunk
+
+        Without a Year column the day of year wraps to 1 after the last day of
+        the year like inc_mins_hours_days, so the days of the year are added
+        whenever the day goes back, counting years from the forecast year
+        '''
+
+        wraps, last_day = 0, None
+        year = self.start[0]
+
+        for columns, block in read_chunks(self.filename, self.chunk_rows):
+            col = dict((c, block[:, columns.index(c)]) for c in columns)
+
+            if 'Year' in col:
+                if self.start[0] is None:
+                    raise ValueError("forcing file has a Year column but the forecast has no year")
+                times = elapsed_minutes(self.start, col['Year'], col['Day'], col['Hour'], col['Minute'])
+            else:
+                day = col['Day']
+                previous = np.concatenate([[day[0] if last_day is None else last_day], day[:-1]])
+                row_wraps = wraps + np.cumsum(day < previous)
+                wraps, last_day = row_wraps[-1], day[-1]
+                # Days in the years before each row, from the start of the forecast year
+                offsets = np.cumsum([0] + [ps.days_in_year(None if year is None else year + w)
+                                           for w in range(int(wraps))])
+                times = (elapsed_minutes(self.start, None, day, col['Hour'], col['Minute']) +
+                         offsets[row_wraps] * 1440)
+
+            yield columns, times, block
+
+    def read_times(self):
+        '''
+        Elapsed minutes of every sample time, reading only a chunk at a time
+        Site rows of the same time are dropped chunk by chunk so memory only
+        grows with the number of sample times, not rows
+        '''
+
+        times, last = [], None
+
+        for columns, t, block in self.iter_chunks():
+            # One sample time per group of site rows, continuing the previous chunk
+            keep = np.concatenate([[last is None or t[0] != last], np.diff(t) != 0])
+            times.append(t[keep])
+            last = t[-1]
+
+        if last is None:
+            raise ValueError("forcing file %s has no rows" % self.filename)
+
+        return np.concatenate(times)
+
+    def weights(self, forecast_minutes):
+        '''
+        Index of the earlier sample and weight of the later sample for every step
+        Precomputed once per forecast
+        '''
+
+        steps = np.arange(forecast_minutes)
+
+        if len(self.times) == 1:
+            return np.zeros(forecast_minutes, dtype=int), np.zeros(forecast_minutes)
+
+        index  = np.clip(np.searchsorted(self.times, steps, side='right') - 1, 0, len(self.times) - 2)
+        weight = np.clip((steps - self.times[index]) / (self.times[index + 1] - self.times[index]), 0, 1)
+
+        return index, weight
+
+    def samples(self):
+        '''
+        Lazily yields a dict mapping VARIABLES in the file to an array with one
+        value per site for every sample time
+        '''
+
+        has_site = 'Site' in self.columns
+        current, values, seen = None, None, None
+
+        for columns, times, block in self.iter_chunks():
+            # Rows of each sample time within the chunk
+            bounds = np.flatnonzero(np.concatenate([[True], np.diff(times) != 0, [True]]))
+
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                if times[a] != current:
+                    if values is not None:
+                        yield self.complete(values, seen)
+                    current = times[a]
+                    values  = dict((v, np.full(self.sites, np.nan)) for v in self.variables)
+                    seen    = np.zeros(self.sites, dtype=bool)
+
+                if has_site:
+                    site, rows = block[a:b, columns.index('Site')].astype(int), block[a:b]
+                else:
+                    site, rows = slice(None), block[b - 1]
+                for v in self.variables:
+                    values[v][site] = rows[..., columns.index(v)]
+                seen[site] = True
+
+        yield self.complete(values, seen)
+
+    def complete(self, values, seen):
+        '''
+        Check every site has a value in range for a sample time, using
+        ensemble.LIMITS where the command line range includes values the
+        equations can not use
+        '''
+
+        if not seen.all():
+            raise ValueError("forcing sample is missing sites %s" % np.flatnonzero(~seen).tolist())
+
+        for v in self.variables:
+            lo, hi = ensemble.LIMITS.get(v, ps.RANGES.get(v, (None, None)))
+            if (lo is not None and np.any(values[v] < lo)) or (hi is not None and np.any(values[v] > hi)):
+                raise ValueError("forcing %s values not in range [%r, %r]" % (v, lo, hi))
+
+        return values
+
+    def steps(self, forecast_minutes, degrees):
+        '''
+        Lazily yields a dict of per-site parameter arrays for every step,
+        with temperatures in Kelvin, for arrayscheme.iter_forecast
+        '''
+
+        index, weight = self.weights(forecast_minutes)
+        celsius = np.char.upper(np.asarray(degrees, dtype=str)) == 'C'
+
+        samples = self.samples()
+        k = 0
+        earlier = next(samples)
+        later   = next(samples, earlier)
+
+        for i in range(forecast_minutes):
+            while k < index[i]:
+                earlier, later = later, next(samples, later)
+                k += 1
+
+            w = weight[i]
+            values = dict((v, (1 - w) * earlier[v] + w * later[v]) for v in self.variables)
+
+            # Same conversions as c_to_k and f_to_k
+            for v in TEMP_VARIABLES:
+                if v in values:
+                    values[v] = np.where(celsius, values[v] + 273.15, (values[v] + 459.67) * 5 / 9)
+
+            yield values
+
+
+def iter_forecast(sites, filename, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+                  report_period=ps.DEFAULTS['report_period'], chunk_rows=CHUNK_ROWS):
+    '''
+    arrayscheme.iter_forecast with parameters from a forcing file
+    '''
+
+    p = arrayscheme.site_arrays(sites)
+    year = None if np.isnan(p['year'][0]) else int(p['year'][0])
+    start = (year, int(p['day_of_year'][0]), int(p['hour'][0]), int(p['minute'][0]))
+
+    if np.any(p['day_of_year'] != start[1]) or np.any(p['hour'] != start[2]) or np.any(p['minute'] != start[3]):
+        raise ValueError("all sites must start at the same time to share a forcing file")
+
+    forcing = Forcing(filename, start, len(p['latitude']), chunk_rows)
+
+    return arrayscheme.iter_forecast(sites, forecast_minutes, report_period,
+                                     forcing.steps(forecast_minutes, p['degrees']))
+
+
+def main(args):
+    '''
+    Calculate surface temperature with forcing for the command line site
+    Optionally write to CSV or .npy file every args.report_period minutes
+    '''
+
+    config = ps.ForecastConfig.from_args(args)
+    config.validate()
+
+    site = dict((n, v) for n, v in vars(config).items()
+                if n not in ('forecast_minutes', 'report_period', 'integrator', 'tolerance'))
+
+    writer = None
+    if args.filename is not None:
+        writer = ps.open_writer(args.filename)
+
+    try:
+        for report in iter_forecast(site, args.forcing, args.forecast_minutes,
+                                    args.report_period, args.chunk):
+            row = tuple(report[c][0].item() for c in ps.COLUMNS)
+            if writer is not None:
+                writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print("T_s:\t", row[-1])
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature at latitude and longitude with time-varying forcing")
+
+    frc = parser.add_argument_group('forcing arguments')
+    frc.add_argument('-fo', '--forcing',
+            help='Comma or tab separated file with Day, Hour, Minute and any of ' + ', '.join(VARIABLES),
+            required=True, type=str)
+    frc.add_argument('-ch', '--chunk',
+            help='Forcing file rows read at a time - default=%(default)s',
+            default=CHUNK_ROWS, type=ps.int_range(1, None), metavar="[1, None]")
+
+    args = parser.parse_args()
+
+    if args.integrator != 'euler':
+        parser.error("forcing only supports the euler integrator")
+    if args.aggregates:
+        parser.error("--aggregates is not supported for forcing")
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,357 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+
+
+# NOTE Forecasts for every cell of a regular latitude and longitude grid
+#      Each variable is written to its own .npy file shaped (time, lat, lon) which is
+#      preallocated and memory mapped, so results never have to fit in memory
+#      Cells are run as arrayscheme batches one tile at a time, tiles are sized to a
+#      memory budget and finished tiles are recorded in the grid.json sidecar
+#      so an interrupted run carries on from the first unfinished tile
+#      Rows run south to north and columns west to east
+
+
+# Variables written, one file each
+VARIABLES = ps.COLUMNS[3:]
+
+# Name of the metadata sidecar in the output directory
+METADATA = 'grid.json'
+
+# Rough bytes of arrayscheme working arrays per cell
+BYTES_PER_CELL = 1000
+
+# Parameters which must be the same for every cell
+SCALARS = ('degrees', 'day_of_year', 'hour', 'minute', 'year', 'day_of_solstice')
+
+# Parameters in the forecast degrees, checked with temp_errors
+TEMPERATURES = ('ground_temp', 'surface_temp', 'atmos_temp_constant',
+                'atmos_temp_adjust', 'cloud_temp_constant', 'cloud_temp_adjust')
+
+
+def axes(bbox, resolution):
+    '''
+    Cell centre latitudes and longitudes for bbox (south, north, west, east)
+    '''
+
+    south, north, west, east = bbox
+    for name, lo, hi in (('latitude', south, north), ('longitude', west, east)):
+        min, max = ps.RANGES[name]
+        if lo < min or hi > max:
+            raise ValueError("bounding box %s [%r, %r] not in range [%r, %r]" % (name, lo, hi, min, max))
+
+    n_lat = int(round((north - south) / resolution))
+    n_lon = int(round((east - west) / resolution))
+
+    if n_lat < 1 or n_lon < 1:
+        raise ValueError("bounding box %r is smaller than resolution %r" % (bbox, resolution))
+
+    lats = south + (np.arange(n_lat) + 0.5) * resolution
+    lons = west + (np.arange(n_lon) + 0.5) * resolution
+
+    return lats, lons
+
+
+def tile_shape(shape, memory):
+    '''
+    Tile (rows, columns) with whole rows where possible, for a memory budget in bytes
+    '''
+
+    cells  = max(1, int(memory // BYTES_PER_CELL))
+    n_lon  = min(shape[1], cells)
+    n_lat  = max(1, min(shape[0], cells // n_lon))
+
+    return n_lat, n_lon
+
+
+def tiles(shape, tile):
+    '''
+    Lazily yields (row slice, column slice) of every tile in row major order
+    '''
+
+    for i in range(0, shape[0], tile[0]):
+        for j in range(0, shape[1], tile[1]):
+            yield slice(i, min(i + tile[0], shape[0])), slice(j, min(j + tile[1], shape[1]))
+
+
+def report_times(params, forecast_minutes, report_period):
+    '''
+    (day, hour, minute) of every report, the same for every cell
+    '''
+
+    args  = argparse.Namespace()
+    start = (params.get('year'), params['day_of_year'],
+             params.get('hour', ps.DEFAULTS['hour']), params.get('minute', ps.DEFAULTS['minute']))
+    times = []
+
+    for minutes in ps.report_minutes(argparse.Namespace(forecast_minutes=forecast_minutes,
+                                                        report_period=report_period)):
+        ps.set_clock(args, start, minutes)
+        times.append((args.day_of_year, args.hour, args.minute))
+
+    return times
+
+
+def check_ranges(name, values, degrees):
+    '''
+    Raise ValueError if any raster value is outside the command line range,
+    or the range of degrees for temperatures
+    '''
+
+    min, max = ps.RANGES.get(name, (None, None))
+    values = values[~np.isnan(values)]
+
+    if values.size == 0:
+        return
+    if (min is not None and values.min() < min) or (max is not None and values.max() > max):
+        raise ValueError("raster '%s' values [%r, %r] not in range [%r, %r]" %
+                         (name, values.min(), values.max(), min, max))
+
+    if name in TEMPERATURES:
+        errors = ps.temp_errors(values.min(), degrees) + ps.temp_errors(values.max(), degrees)
+        if errors:
+            raise ValueError("raster '%s': %s" % (name, "; ".join(errors)))
+
+
+def check_cells(cells):
+    '''
+    Raise ValueError for cells failing the checks between parameters of ForecastConfig.errors
+    cells maps parameters to values or arrays of cell values
+    '''
+
+    percent = np.asarray(cells['percent_net_radiation'])
+    resistance = np.asarray(cells.get('resistance', ps.DEFAULTS['resistance']))
+
+    zero = np.count_nonzero((percent == 0) & (resistance == 0))
+    if zero:
+        raise ValueError("%d cells have 'percent net radiation' and 'resistance to heat flux' "
+                         "both zero." % zero)
+
+
+def check_rasters(rasters, params, shape, tile):
+    '''
+    Check every cell of the rasters a tile at a time before anything runs
+    '''
+
+    for rows, cols in tiles(shape, tile):
+        cells = dict(params)
+        for name, raster in rasters.items():
+            values = np.asarray(raster[rows, cols], dtype=float).ravel()
+            check_ranges(name, values, params['degrees'])
+            cells[name] = values
+        check_cells(cells)
+
+
+def read_metadata(output):
+    try:
+        with open(os.path.join(output, METADATA)) as f:
+            return json.load(f)
+    except (OSError, IOError):
+        return None
+
+
+def write_metadata(output, metadata, name=METADATA):
+    '''
+    Write the sidecar then rename so it is never read half written
+    '''
+
+    fd, tmp = tempfile.mkstemp(dir=output, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(tmp, os.path.join(output, name))
+
+
+def run_grid(output, bbox, resolution, params, rasters=None,
+             forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+             report_period=ps.DEFAULTS['report_period'],
+             memory=256 * 2**20, dtype='float64'):
+    '''
+    Forecast every cell of a grid and write each variable to output/<variable>.npy
+
+    params maps ForecastConfig parameters to values used for every cell,
+    except latitude and longitude which come from the grid
+    rasters maps parameters to .npy files or arrays shaped (lat, lon)
+    Tiles are sized so working arrays use about memory bytes
+    A run with the same arguments resumes from the first unfinished tile
+
+    Returns the metadata also written to output/grid.json
+    '''
+
+    if rasters is None:
+        rasters = {}
+
+    lats, lons = axes(bbox, resolution)
+    shape = (len(lats), len(lons))
+
+    for name in rasters:
+        if name in SCALARS or name in ('latitude', 'longitude'):
+            raise ValueError("'%s' can not vary across the grid" % name)
+
+    # Rasters are memory mapped so only one tile is read at a time
+    rasters = dict((n, np.load(r, mmap_mode='r') if isinstance(r, str) else np.asarray(r))
+                   for n, r in rasters.items())
+    for name, raster in rasters.items():
+        if raster.shape != shape:
+            raise ValueError("raster '%s' shape %r is not the grid shape %r" % (name, raster.shape, shape))
+
+    # Check everything except the rasters once using the grid centre
+    centre = dict(params, latitude=float(lats[len(lats) // 2]), longitude=float(lons[len(lons) // 2]))
+    for name, raster in rasters.items():
+        centre[name] = raster[shape[0] // 2, shape[1] // 2].item()
+    ps.ForecastConfig(forecast_minutes=forecast_minutes, report_period=report_period, **centre).validate()
+
+    times = report_times(params, forecast_minutes, report_period)
+    tile  = tile_shape(shape, memory)
+    if rasters:
+        check_rasters(rasters, params, shape, tile)
+
+    run = {'bbox':             list(bbox),
+           'resolution':       resolution,
+           'shape':            [len(times)] + list(shape),
+           'dtype':            np.dtype(dtype).name,
+           'parameters':       params,
+           'rasters':          sorted(rasters),
+           'forecast_minutes': forecast_minutes,
+           'report_period':    report_period}
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    metadata = read_metadata(output)
+    if metadata is not None and dict((k, metadata.get(k)) for k in run) != json.loads(json.dumps(run)):
+        raise ValueError("%s holds a different grid, use another output directory" % output)
+
+    # Resumed runs keep their original tiles whatever the memory budget
+    if metadata is None:
+        metadata = dict(run, tile=list(tile), completed=[], variables=VARIABLES,
+                        latitudes=lats.tolist(), longitudes=lons.tolist(), times=times)
+        mode = 'w+'
+    else:
+        tile = tuple(metadata['tile'])
+        mode = 'r+'
+
+    out = dict((v, np.lib.format.open_memmap(os.path.join(output, v + '.npy'), mode=mode,
+                                             dtype=dtype, shape=tuple(run['shape'])))
+               for v in VARIABLES)
+    write_metadata(output, metadata)
+
+    completed = set(metadata['completed'])
+    lat_grid, lon_grid = lats[:, None], lons[None, :]
+
+    for number, (rows, cols) in enumerate(tiles(shape, tile)):
+        if number in completed:
+            continue
+
+        n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+        sites = dict(params)
+        sites['latitude']  = np.broadcast_to(lat_grid[rows], (n_rows, n_cols)).ravel()
+        sites['longitude'] = np.broadcast_to(lon_grid[:, cols], (n_rows, n_cols)).ravel()
+        for name, raster in rasters.items():
+            sites[name] = np.asarray(raster[rows, cols], dtype=float).ravel()
+
+        for t, report in enumerate(arrayscheme.iter_forecast(sites, forecast_minutes, report_period)):
+            for v in VARIABLES:
+                out[v][t, rows, cols] = report[v].reshape(n_rows, n_cols)
+
+        # Results must be on disk before the tile is recorded as finished
+        for v in VARIABLES:
+            out[v].flush()
+        metadata['completed'].append(number)
+        write_metadata(output, metadata)
+
+    return metadata
+
+
+def pairs(values, convert):
+    '''
+    Convert name=value command line strings to a dict
+    '''
+
+    result = {}
+    for item in values or []:
+        name, value = item.split('=', 1)
+        result[name.strip()] = convert(value)
+
+    return result
+
+
+def number(value):
+    '''
+    int, float or str command line parameter value
+    '''
+
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def main(args):
+    '''
+    Forecast the command line grid and print progress information
+    '''
+
+    params = pairs(args.set, number)
+    params['degrees'] = args.degrees
+
+    metadata = run_grid(args.output, args.bbox, args.resolution, params,
+                        pairs(args.raster, str), args.forecast_minutes, args.report_period,
+                        args.memory * 2**20, args.dtype)
+
+    print("Grid:\t\t", " x ".join(str(n) for n in metadata['shape']))
+    print("Tiles:\t\t", len(metadata['completed']), "of", len(list(tiles(metadata['shape'][1:], metadata['tile']))))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Calculate surface temperature over a latitude and longitude grid "
+                        "https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-bb', '--bbox',
+            help='Bounding box south north west east in degrees',
+            required=True, type=float, nargs=4, metavar=('SOUTH', 'NORTH', 'WEST', 'EAST'))
+    parser.add_argument('-re', '--resolution',
+            help='Cell size in degrees',
+            required=True, type=ps.float_range(1e-6, 180.0), metavar="[1e-06, 180.0]")
+    parser.add_argument('-ou', '--output',
+            help='Output directory for one .npy file per variable and grid.json',
+            required=True, type=str)
+    parser.add_argument('-de', '--degrees',
+            help='Fahrenheit or Celsius',
+            required=True, choices=['C', 'F', 'c', 'f'])
+    parser.add_argument('-se', '--set',
+            help='Parameter used for every cell using the long option name, for example ground_temp=54',
+            action='append', metavar='NAME=VALUE')
+    parser.add_argument('-ra', '--raster',
+            help='Per-cell parameter from a .npy file shaped (lat, lon), for example albedo=albedo.npy',
+            action='append', metavar='NAME=FILE')
+    parser.add_argument('-fm', '--forecast_minutes',
+            help='Number of minutes to forecast - default=%(default)s',
+            default=1440, type=ps.int_range(*ps.RANGES['forecast_minutes']), metavar="[1, None]")
+    parser.add_argument('-rp', '--report_period',
+            help='Report period in minutes - default=%(default)s',
+            default=60, type=ps.int_range(*ps.RANGES['report_period']), metavar="[1, None]")
+    parser.add_argument('-me', '--memory',
+            help='Memory budget for each tile in MB - default=%(default)s',
+            default=256, type=ps.float_range(1.0, None), metavar="[1.0, None]")
+    parser.add_argument('-dt', '--dtype',
+            help='Output data type - default=%(default)s',
+            default='float64', choices=['float32', 'float64'])
+
+    sys.exit(main(parser.parse_args()))
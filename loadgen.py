@@ -0,0 +1,191 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import parametricscheme as ps
+import benchmark
+import server
+
+
+# NOTE Load generator for server.py
+#      Without --host or --socket a server is started in the same process on a
+#      temporary Unix socket, so no network is needed
+#      Each client sends requests one after another over one connection,
+#      a fraction of requests repeat an earlier scenario to exercise the cache
+
+
+async def request(reader, writer, method, path, params=None):
+    '''
+    Send one HTTP request on an open connection
+    Returns (status, decoded JSON response)
+    '''
+
+    body = b'' if params is None else json.dumps(params).encode('utf-8')
+
+    writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\n"
+                  "Content-Type: application/json\r\nContent-Length: %d\r\n\r\n" %
+                  (method, path, len(body))).encode('latin-1') + body)
+    await writer.drain()
+
+    status  = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    response = await reader.readexactly(int(headers['content-length']))
+
+    return status, json.loads(response.decode('utf-8'))
+
+
+async def connect(host, port, socket):
+    if socket is not None:
+        return await asyncio.open_unix_connection(socket)
+    return await asyncio.open_connection(host, port)
+
+
+def scenarios(n, repeat, forecast_minutes, seed):
+    '''
+    Madaus scenario with a different latitude for each request
+    A fraction repeat of requests reuse an earlier latitude
+    '''
+
+    rng  = random.Random(seed)
+    seen = []
+
+    for i in range(n):
+        if seen and rng.random() < repeat:
+            latitude = rng.choice(seen)
+        else:
+            latitude = round(rng.uniform(-60, 60), 4)
+            seen.append(latitude)
+
+        params = dict(benchmark.SCENARIO, latitude=latitude,
+                      forecast_minutes=forecast_minutes, report_period=min(60, forecast_minutes))
+        yield params
+
+
+async def client(host, port, socket, queue, latencies, statuses):
+    reader, writer = await connect(host, port, socket)
+
+    try:
+        while not queue.empty():
+            params = queue.get_nowait()
+            start  = time.perf_counter()
+            status, response = await request(reader, writer, 'POST', '/forecast', params)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def run(args):
+    '''
+    Send args.requests requests from args.clients concurrent clients
+    Returns (seconds, client latencies, status counts, server metrics)
+    '''
+
+    host, port, socket = args.host, args.port, args.socket
+    local = None
+
+    if host is None and socket is None:
+        socket  = os.path.join(tempfile.mkdtemp(), 'forecast.sock')
+        service = server.ForecastService(args.cache_size, args.window / 1000, args.max_batch)
+        local   = await server.start(service, socket=socket)
+
+    queue = asyncio.Queue()
+    for params in scenarios(args.requests, args.repeat, args.forecast_minutes, args.seed):
+        queue.put_nowait(params)
+
+    latencies, statuses = [], {}
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, socket, queue, latencies, statuses)
+                           for i in range(args.clients)])
+    seconds = time.perf_counter() - start
+
+    reader, writer = await connect(host, port, socket)
+    status, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    await writer.wait_closed()
+
+    if local is not None:
+        local.close()
+        await local.wait_closed()
+        os.remove(socket)
+
+    return seconds, latencies, statuses, metrics
+
+
+def main(args):
+    '''
+    Generate load and print client and server metrics
+    '''
+
+    seconds, latencies, statuses, metrics = asyncio.run(run(args))
+    latencies.sort()
+
+    print("Requests:\t", len(latencies), "in %.3f s" % seconds)
+    print("Throughput:\t %.1f requests/s" % (len(latencies) / seconds))
+    print("Statuses:\t", " ".join("%s %d" % s for s in sorted(statuses.items())))
+    print("Latency ms:\t", " ".join("p%d %.2f" % (q, 1e3 * latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))])
+                                    for q in (50, 90, 99)))
+    print("Server:\t\t", json.dumps(metrics, sort_keys=True))
+
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Generate load for server.py https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-ho', '--host',
+            help='Host of a running server - default start a server in this process',
+            default=None, type=str)
+    parser.add_argument('-po', '--port',
+            help='TCP port of a running server - default=%(default)s',
+            default=8080, type=ps.int_range(0, 65535), metavar="[0, 65535]")
+    parser.add_argument('-so', '--socket',
+            help='Unix socket of a running server',
+            default=None, type=str)
+    parser.add_argument('-rq', '--requests',
+            help='Total number of requests - default=%(default)s',
+            default=1000, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-cl', '--clients',
+            help='Concurrent clients - default=%(default)s',
+            default=50, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-re', '--repeat',
+            help='Fraction of requests repeating an earlier scenario - default=%(default)s',
+            default=0.5, type=ps.float_range(0.0, 1.0), metavar="[0.0, 1.0]")
+    parser.add_argument('-fm', '--forecast_minutes',
+            help='Minutes forecast by each request - default=%(default)s',
+            default=60, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-se', '--seed',
+            help='Random seed - default=%(default)s',
+            default=1, type=int)
+
+    local = parser.add_argument_group('in process server arguments')
+    local.add_argument('-cs', '--cache_size',
+            help='Forecasts kept in the cache - default=%(default)s',
+            default=1024, type=ps.int_range(0, None), metavar="[0, None]")
+    local.add_argument('-wi', '--window',
+            help='Milliseconds to wait for other requests to batch with - default=%(default)s',
+            default=5.0, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+    local.add_argument('-mb', '--max_batch',
+            help='Forecasts run together at most - default=%(default)s',
+            default=1000, type=ps.int_range(1, None), metavar="[1, None]")
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,254 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import time
+import argparse
+
+import parametricscheme as ps
+import verify
+
+
+# NOTE Forecasts updated as observations arrive instead of rerun from the start
+#      A Nowcast keeps the euler_reports state, surface temperature, clock, change in
+#      surface temperature since the last report and the last fluxes, so it can resume
+#      from any step as checkpoints.py does
+#      Each observation steps the state from the previous observation to its time, then
+#      nudges the surface temperature toward it by relaxation or a scalar Kalman update
+#      Only the steps after the last observation are forecast again, and only when the
+#      forecast is asked for, so an update costs the steps since the previous one
+#      Without observations the rows are bit-identical to parametricscheme.iter_forecast
+
+
+# Methods selectable with --method
+METHODS = ['relaxation', 'kalman']
+
+# Fraction of the observation minus forecast added by relaxation
+WEIGHT = 0.5
+
+# Standard deviation in K of observation errors and of forecast errors added per hour
+OBSERVATION_ERROR = 0.5
+MODEL_ERROR       = 0.5
+
+
+def to_kelvin(state, value):
+    '''
+    Convert the forecast Celsius or Fahrenheit to Kelvin
+    '''
+
+    if state.degrees.upper() == 'C':
+        return ps.c_to_k(value)
+    elif state.degrees.upper() == 'F':
+        return ps.f_to_k(value)
+
+
+def report_row(args, Q, d_T_s, T_s):
+    '''
+    Row of COLUMNS values as written by parametricscheme.main
+    '''
+
+    return (args.day_of_year, args.hour, args.minute) + Q + (d_T_s, ps.from_kelvin(args, T_s))
+
+
+class Nowcast(object):
+    '''
+    In-flight euler forecast for a ForecastConfig which assimilates observations
+
+    method is relaxation, adding weight times observed - forecast, or kalman,
+    weighting by forecast and observation error variances.  The forecast
+    error variance starts at 0 and grows by model_error**2 per hour between
+    observations, errors are standard deviations in K
+    '''
+
+    def __init__(self, config, method='relaxation', weight=WEIGHT,
+                 observation_error=OBSERVATION_ERROR, model_error=MODEL_ERROR):
+        config.validate()
+        if config.integrator != 'euler' or config.aggregates:
+            raise ValueError("nowcasts need the euler integrator without aggregates")
+        if method not in METHODS:
+            raise ValueError("'method' must be one of %s not %r" % (", ".join(METHODS), method))
+
+        self.config            = config
+        self.method            = method
+        self.weight            = weight
+        self.observation_error = observation_error
+        self.model_error       = model_error
+
+        self.args      = config.to_state()
+        self.step      = 0     # Minutes after the start of the forecast
+        self.sum_d_T_s = 0     # Change in T_s since the last report
+        self.Q         = None  # Fluxes of the last step
+        self.variance  = 0.0   # Forecast error variance at step in K^2
+        self.history   = []    # Report rows up to step
+        self.updates   = []
+        self._forecast = None
+
+    def lead(self, day, hour, minute, year=None):
+        '''
+        Minutes after the start of the forecast of a clock, negative before it
+        year defaults to the year of the start, counting from 0 without one,
+        as verify.read_rows numbers them
+        '''
+
+        config = self.config
+        start  = config.year or 0
+        year   = start if year is None else year
+
+        days = day - config.day_of_year
+        for y in range(min(start, year), max(start, year)):
+            days += (1 if year > start else -1) * ps.days_in_year(None if config.year is None else y)
+
+        return days * 1440 + (hour - config.hour) * 60 + minute - config.minute
+
+    def advance(self, minutes):
+        '''
+        Step the state to minutes after the start, keeping the report rows on the way
+        '''
+
+        if minutes < self.step:
+            raise ValueError("minute %s is before the current step %d" % (minutes, self.step))
+        if minutes > self.config.forecast_minutes:
+            raise ValueError("minute %s is after the end of the forecast" % (minutes,))
+        if minutes == self.step:
+            return
+
+        # Every yield but the last is a report, the last is the state at minutes
+        args = self.args
+        args.forecast_minutes = minutes
+        rows = [(report, report_row(args, *report))
+                for report in ps.euler_reports(args, self.step, self.sum_d_T_s, self.Q)]
+        args.forecast_minutes = self.config.forecast_minutes
+
+        self.history.extend(row for report, row in rows[:-1])
+        report = rows[-1][0]
+
+        self.Q, self.sum_d_T_s, T_s = report
+        self.variance += self.model_error**2 * (minutes - self.step) / 60
+        self.step      = minutes
+        self._forecast = None
+
+    def update(self, value, minutes=None, day=None, hour=None, minute=None, year=None):
+        '''
+        Assimilate an observed surface temperature in the forecast degrees at
+        minutes after the start, or at day, hour, minute and optionally year,
+        no earlier than the previous observation
+
+        Returns a dict with the minutes, forecast (background) and analysis
+        surface temperatures in the forecast degrees, gain and seconds taken
+        '''
+
+        begin = time.perf_counter()
+        if minutes is None:
+            minutes = self.lead(day, hour, minute, year)
+
+        self.advance(minutes)
+
+        args       = self.args
+        background = args.surface_temp
+        if self.method == 'relaxation':
+            gain = self.weight
+        else:
+            # Scalar Kalman update, a perfect observation of a perfect forecast is taken as is
+            denominator = self.variance + self.observation_error**2
+            gain = self.variance / denominator if denominator > 0 else 1.0
+            self.variance *= 1 - gain
+
+        increment = gain * (to_kelvin(args, value) - background)
+        args.surface_temp = background + increment
+        self.sum_d_T_s   += increment  # d_T_s still adds up to the change in T_s
+        self._forecast    = None
+
+        update = {'minutes':    minutes,
+                  'observed':   value,
+                  'background': ps.from_kelvin(args, background),
+                  'analysis':   ps.from_kelvin(args, args.surface_temp),
+                  'gain':       gain,
+                  'seconds':    time.perf_counter() - begin}
+        self.updates.append(update)
+
+        return update
+
+    def forecast(self):
+        '''
+        Report rows after the current step to the end of the forecast
+        Calculated once after each update, from the current step only
+        '''
+
+        if self._forecast is None:
+            args = argparse.Namespace(**vars(self.args))
+            self._forecast = [report_row(args, *report)
+                              for report in ps.euler_reports(args, self.step, self.sum_d_T_s, self.Q)]
+
+        return self._forecast
+
+    def rows(self):
+        '''
+        Every report row, as parametricscheme.iter_forecast, analysed up to the
+        current step and forecast after it
+        '''
+
+        return self.history + self.forecast()
+
+
+def main(args):
+    '''
+    Assimilate an observation file into a forecast one row at a time
+    Optionally write the analysed and forecast rows to CSV or .npy file
+    '''
+
+    config  = ps.ForecastConfig.from_args(args)
+    nowcast = Nowcast(config, args.method, args.weight, args.observation_error, args.model_error)
+    columns = ps.COLUMNS
+
+    print("Day\tHour\tMinute\tObserved\tForecast\tAnalysis\tForecast T_s\tSeconds")
+    for key, site, lead, value in verify.read_rows(args.observations, 'T_s', year=config.year):
+        year, day, hour, minute = key[1:]
+        minutes = nowcast.lead(day, hour, minute, year)
+        if minutes < nowcast.step:
+            continue
+        if minutes > config.forecast_minutes:
+            break
+
+        begin  = time.perf_counter()
+        update = nowcast.update(value, minutes)
+        final  = nowcast.forecast()[-1][len(columns) - 1]
+        print("%d\t%d\t%d\t%.3f\t%.3f\t%.3f\t%.3f\t%.4f" %
+              (day, hour, minute, value, update['background'], update['analysis'], final,
+               time.perf_counter() - begin))
+
+    if args.filename is not None:
+        with ps.open_writer(args.filename, columns) as writer:
+            for row in nowcast.rows():
+                writer.write(row)
+
+    print("T_s:\t", nowcast.rows()[-1][len(columns) - 1])
+    print("Updates:\t", len(nowcast.updates))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature at latitude and longitude assimilating observations")
+
+    nc = parser.add_argument_group('nowcast arguments')
+    nc.add_argument('-ob', '--observations',
+            help='Observation file with Day, Hour, Minute and T_s columns in time order',
+            required=True, type=str)
+    nc.add_argument('-nm', '--method',
+            help='Nudge by a fixed weight or a scalar Kalman gain - default=%(default)s',
+            default='relaxation', choices=METHODS)
+    nc.add_argument('-wt', '--weight',
+            help='Relaxation weight of each observation - default=%(default)s',
+            default=WEIGHT, type=ps.float_range(0.0, 1.0), metavar="[0.0, 1.0]")
+    nc.add_argument('-oe', '--observation_error',
+            help='Kalman observation error standard deviation in K - default=%(default)s',
+            default=OBSERVATION_ERROR, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+    nc.add_argument('-mo', '--model_error',
+            help='Kalman forecast error standard deviation added per hour in K - default=%(default)s',
+            default=MODEL_ERROR, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,272 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import time
+import queue
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+import ensemble
+
+
+# NOTE Many sites or ensemble members forecast on every core
+#      Sites are split into shards which worker processes take from a shared queue as
+#      they finish earlier ones, so slow shards do not hold up the other workers
+#      Workers write results straight into one shared memory block shaped
+#      (columns, sites, reports) at the rows of their shard, so nothing is pickled
+#      back and the order of the results never depends on which worker ran a shard
+#      Each site is forecast exactly as arrayscheme.forecast would
+
+
+# Shards per worker, smaller shards balance better but cost more queue round trips
+SHARDS_PER_WORKER = 8
+
+# Fewest sites in a default shard, every shard pays the per step cost of arrayscheme
+MIN_SHARD_SIZE = 1000
+
+# Seconds between checks that the workers are still running
+POLL = 1.0
+
+# Integer columns, held as float64 in shared memory
+CLOCK = ps.COLUMNS[:3]
+
+
+def shards(n, shard_size):
+    '''
+    (start, stop) site ranges of every shard
+    '''
+
+    return [(a, min(a + shard_size, n)) for a in range(0, n, shard_size)]
+
+
+def take(sites, n, start, stop):
+    '''
+    Sites start to stop, parameters shared by every site are kept as they are
+    '''
+
+    return dict((name, value[start:stop] if np.ndim(value) and len(value) == n else value)
+                for name, value in sites.items())
+
+
+def worker(name, shape, sites, forecast_minutes, report_period, tasks, done):
+    '''
+    Forecast shards from tasks into the shared memory block name until None
+    Puts (shard, pid, seconds, error) on done for every shard
+    '''
+
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+        for task in iter(tasks.get, None):
+            shard, (start, stop) = task
+            begin = time.perf_counter()
+            try:
+                result = arrayscheme.forecast(take(sites, shape[1], start, stop),
+                                              forecast_minutes, report_period)
+                for j, c in enumerate(ps.COLUMNS):
+                    out[j, start:stop] = result[c]
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+
+            done.put((shard, os.getpid(), time.perf_counter() - begin, error))
+
+        del out
+    finally:
+        block.close()
+
+
+def run(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+        report_period=ps.DEFAULTS['report_period'], workers=None, shard_size=None):
+    '''
+    Forecast sites, as for arrayscheme.forecast, in worker processes
+
+    Returns (result, stats), result the same dict of (sites, reports) arrays
+    as arrayscheme.forecast and stats a dict with the number of workers and
+    shards and the shards and busy seconds of each worker
+    '''
+
+    n       = len(arrayscheme.site_arrays(sites)['latitude'])
+    reports = len(ps.report_minutes(argparse.Namespace(forecast_minutes=forecast_minutes,
+                                                       report_period=report_period)))
+    workers = workers or os.cpu_count() or 1
+    if shard_size is None:
+        shard_size = max(MIN_SHARD_SIZE, -(-n // (workers * SHARDS_PER_WORKER)))
+
+    shape = (len(ps.COLUMNS), n, reports)
+    block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+
+    try:
+        tasks = multiprocessing.Queue()
+        done  = multiprocessing.Queue()
+        work  = shards(n, shard_size)
+        for task in enumerate(work):
+            tasks.put(task)
+        for i in range(workers):
+            tasks.put(None)
+
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(block.name, shape, sites, forecast_minutes,
+                                                   report_period, tasks, done))
+                     for i in range(workers)]
+        for p in processes:
+            p.start()
+
+        busy = {}
+        try:
+            received = 0
+            while received < len(work):
+                try:
+                    shard, pid, seconds, error = done.get(timeout=POLL)
+                except queue.Empty:
+                    # A worker killed by the OS or a crash never reports its shard
+                    for p in processes:
+                        if p.exitcode not in (None, 0):
+                            raise RuntimeError("worker %d exited with code %d with %d shards outstanding" %
+                                               (p.pid, p.exitcode, len(work) - received))
+                    if not any(p.is_alive() for p in processes):
+                        raise RuntimeError("every worker exited with %d shards outstanding" %
+                                           (len(work) - received))
+                    continue
+
+                received += 1
+                if error is not None:
+                    raise RuntimeError("shard %d failed in worker %d\n%s" % (shard, pid, error))
+                count, total = busy.get(pid, (0, 0.0))
+                busy[pid] = (count + 1, total + seconds)
+        except BaseException:
+            for p in processes:
+                p.terminate()
+            raise
+        finally:
+            for p in processes:
+                p.join()
+
+        out    = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        result = dict((c, out[j].astype(int if c in CLOCK else np.float64))
+                      for j, c in enumerate(ps.COLUMNS))
+        del out
+    finally:
+        block.close()
+        block.unlink()
+
+    stats = {'workers': workers,
+             'shards':  len(work),
+             'busy':    sorted(busy.values(), reverse=True)}
+
+    return result, stats
+
+
+def forecast(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+             report_period=ps.DEFAULTS['report_period'], workers=None, shard_size=None):
+    '''
+    Same as arrayscheme.forecast using worker processes
+    '''
+
+    return run(sites, forecast_minutes, report_period, workers, shard_size)[0]
+
+
+def scaling(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+            report_period=ps.DEFAULTS['report_period'], counts=None):
+    '''
+    Time sites in one process and with each number of workers in counts,
+    by default 1, 2, 4 ... up to the number of cores
+
+    Returns a list of (workers, seconds, speedup, efficiency), workers 0 is
+    arrayscheme.forecast in this process and speedup is relative to it
+    '''
+
+    if counts is None:
+        cores  = os.cpu_count() or 1
+        counts = sorted(set([2**i for i in range(cores.bit_length()) if 2**i <= cores] + [cores]))
+
+    begin = time.perf_counter()
+    expected = arrayscheme.forecast(sites, forecast_minutes, report_period)
+    baseline = time.perf_counter() - begin
+    rows = [(0, baseline, 1.0, 1.0)]
+
+    for workers in counts:
+        begin = time.perf_counter()
+        result = forecast(sites, forecast_minutes, report_period, workers)
+        seconds = time.perf_counter() - begin
+
+        for c in ps.COLUMNS:
+            if not np.array_equal(result[c], expected[c], equal_nan=True):
+                raise AssertionError("%d workers changed %s" % (workers, c))
+
+        rows.append((workers, seconds, baseline / seconds, baseline / seconds / workers))
+
+    return rows
+
+
+def main(args):
+    '''
+    Forecast an ensemble of the command line site with worker processes
+    Optionally print a scaling report and write every member to CSV or .npy file
+    '''
+
+    site = dict((n, v) for n, v in vars(ps.ForecastConfig.from_args(args)).items()
+                if n not in ('forecast_minutes', 'report_period', 'integrator', 'tolerance', 'aggregates'))
+    sites = ensemble.sample(site, args.members, seed=args.seed)
+
+    if args.scaling:
+        print("Workers\tSeconds\tSpeedup\tEfficiency")
+        for row in scaling(sites, args.forecast_minutes, args.report_period):
+            print("%d\t%.3f\t%.2f\t%.2f" % row)
+        print("Cores:\t", os.cpu_count())
+        return 0
+
+    begin = time.perf_counter()
+    result, stats = run(sites, args.forecast_minutes, args.report_period, args.workers, args.shard_size)
+    seconds = time.perf_counter() - begin
+
+    if args.filename is not None:
+        with ps.open_writer(args.filename, ['id'] + ps.COLUMNS) as writer:
+            for i in range(args.members):
+                for row in zip(*[result[c][i] for c in ps.COLUMNS]):
+                    writer.write((i,) + row)
+
+    print("Members:\t", args.members)
+    print("Workers:\t", stats['workers'])
+    print("Shards:\t\t", stats['shards'])
+    print("Seconds:\t", "%.3f" % seconds)
+    print("Busy:\t\t", " ".join("%d/%.3fs" % b for b in stats['busy']))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate perturbed parameter ensemble surface temperature on every core")
+
+    par = parser.add_argument_group('parallel arguments')
+    par.add_argument('-me', '--members',
+            help='Number of ensemble members - default=%(default)s',
+            default=10000, type=ps.int_range(1, None), metavar="[1, None]")
+    par.add_argument('-wo', '--workers',
+            help='Worker processes - default number of cores',
+            default=None, type=ps.int_range(1, None), metavar="[1, None]")
+    par.add_argument('-sh', '--shard_size',
+            help='Members per shard - default about %d shards per worker of at least %d members' %
+                 (SHARDS_PER_WORKER, MIN_SHARD_SIZE),
+            default=None, type=ps.int_range(1, None), metavar="[1, None]")
+    par.add_argument('-se', '--seed',
+            help='Random seed - default=%(default)s',
+            default=None, type=int)
+    par.add_argument('-sc', '--scaling',
+            help='Time one process and 1, 2, 4 ... workers up to the number of cores instead',
+            default=False, action="store_true")
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -3,10 +3,28 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 import os
+import ast
+import json
 import math
+import time
+import struct
 import argparse
+import calendar
+import contextlib
+import collections
 import datetime
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Optional, this file still runs on its own without solargeometry.py
+try:
+    import solargeometry
+except ImportError:
+    solargeometry = None
+
 
 # NOTE Equation and page numbers in the comments refer to
 #      Parameterization Schemes: Keys to Understanding Numerical Weather Prediction Models
@@ -14,14 +32,92 @@ import datetime
 #      by David J. Stensrud http://www.met.psu.edu/people/djs78
 
 
+# Default values for the optional command line arguments
+# Shared with the batched and other non-command line entry points
+DEFAULTS = {
+    'hour':                  12,
+    'minute':                0,
+    'albedo':                0.3,
+    'cloud_fraction':        0,
+    'day_of_solstice':       173,
+    'utc_offset':            0,
+    'report_period':         60,
+    'forecast_minutes':      1,
+    'transmissivity':        0.8,
+    'emissivity':            0.9,
+    'precip_water':          1,
+    'bowen_ratio':           0.9,
+    'resistance':            0,
+    'atmos_temp_constant':   None,
+    'atmos_temp_adjust':     None,
+    'cloud_temp_constant':   None,
+    'cloud_temp_adjust':     None,
+    'integrator':            'euler',
+    'tolerance':             0.01,
+    'year':                  None,
+    'aggregates':            None,
+}
+
+# Columns written to CSV and .npy files
+COLUMNS = ['Day', 'Hour', 'Minute', 'Q_S', 'Q_Ld', 'Q_Lu', 'Q_H', 'Q_E', 'Q_G', 'd_T_s', 'T_s']
+
+# Report period statistics selectable with --aggregates
+AGGREGATES = ['mean', 'min', 'max', 'energy']
+
+# Variables aggregated over every step of a report period, energy is only for the fluxes
+AGGREGATED = COLUMNS[3:9] + ['T_s']
+
+# Valid ranges for numeric arguments, None means unbounded
+RANGES = {
+    'latitude':              (-90.0, 90.0),
+    'longitude':             (-180.0, 180.0),
+    'day_of_year':           (1, 366),
+    'percent_net_radiation': (0, 1),
+    'hour':                  (0, 24),
+    'minute':                (0, 59),
+    'albedo':                (0.0, 1.0),
+    'cloud_fraction':        (0.0, 1.0),
+    'day_of_solstice':       (172, 173),
+    'utc_offset':            (-12, 12),
+    'report_period':         (1, None),
+    'forecast_minutes':      (1, None),
+    'transmissivity':        (0.0, 1.0),
+    'emissivity':            (0.7, 0.99),
+    'precip_water':          (0.0, 7.5),
+    'bowen_ratio':           (-10.0, 10.0),
+    'resistance':            (0, None),
+    'year':                  (1, 9999),
+}
+
+# Active Tracer, see tracing
+# Every trace point checks this first so tracing costs almost nothing when off
+TRACE = None
+
+# Constants shared by the flux functions and euler_kernel
+SIGMA = 5.67 * 10**(-8)  # W m^-2 K^-4 - Stefan-Boltzmann constant
+C_G   = 1.4 * 10**5      # J m^-2 K^-1 - Soil heat capacity
+
+
+def jit(func):
+    '''
+    Compile func with numba if installed, otherwise return func unchanged
+    Compiled code is cached on disk so later runs start quickly
+    '''
+
+    if numba is None:
+        return func
+
+    return numba.njit(cache=True)(func)
+
+
 def float_range(min=None, max=None):
     def check_range(x):
         x = float(x)
 
-        if x < min and min is not None:
+        if min is not None and x < min:
             raise argparse.ArgumentTypeError("%r not in range [%r, %r]" % (x, min, max))
 
-        if x > max and max is not None:
+        if max is not None and x > max:
             raise argparse.ArgumentTypeError("%r not in range [%r, %r]" % (x, min, max))
 
         return x
@@ -33,10 +129,10 @@ def int_range(min=None, max=None):
     def check_range(x):
         x = int(x)
 
-        if x < min and min is not None:
+        if min is not None and x < min:
             raise argparse.ArgumentTypeError("%r not in range [%r, %r]" % (x, min, max))
 
-        if x > max and max is not None:
+        if max is not None and x > max:
             raise argparse.ArgumentTypeError("%r not in range [%r, %r]" % (x, min, max))
 
         return x
@@ -44,24 +140,59 @@ def int_range(min=None, max=None):
     return check_range
 
 
+def aggregate_names(x):
+    '''Comma separated AGGREGATES for --aggregates.'''
+
+    names = [n.strip().lower() for n in x.split(',') if n.strip()]
+
+    for name in names:
+        if name not in AGGREGATES:
+            raise argparse.ArgumentTypeError("%r not one of %s" % (name, ", ".join(AGGREGATES)))
+
+    return names
+
+
+def aggregate_columns(aggregates):
+    '''
+    Extra column names for report period statistics, variable then statistic
+    '''
+
+    return ['%s_%s' % (v, a) for v in AGGREGATED for a in aggregates or []
+            if not (a == 'energy' and v == 'T_s')]
+
+
 # NOTE Could not get argparse.Action to validate both Celsius and Fahrenheit temperatures
 #      because degrees returned None instead of F or C (when using getattr)
 #      Possibly because parse_args() not yet ran
-def temp_range(temp, degrees):
+def temp_errors(temp, degrees):
     '''
-    Validate temperatures within Celsius or Fahrenheit ranges
+    Check temperatures are within Celsius or Fahrenheit ranges
+    Returns a list of error messages which is empty for valid temperatures
     '''
 
     if temp is None:
-        return 0
+        return []
 
     if (temp < -150.0 or temp > 150.0) and degrees.upper() == 'F':
-        print("ERROR: Fahrenheit temperatures must be between -150 and 150 F")
-        print("ERROR: Supplied value %f F" % temp)
-        exit()
+        return ["Fahrenheit temperatures must be between -150 and 150 F",
+                "Supplied value %f F" % temp]
     elif (temp < -100.0 or temp > 66.0) and degrees.upper() == 'C':
-        print("ERROR: Celsius temperatures must be between -100 and 66 C")
-        print("ERROR: Supplied value %f C" % temp)
+        return ["Celsius temperatures must be between -100 and 66 C",
+                "Supplied value %f C" % temp]
+
+    return []
+
+
+def temp_range(temp, degrees):
+    '''
+    Validate temperatures within Celsius or Fahrenheit ranges
+    '''
+
+    errors = temp_errors(temp, degrees)
+
+    if errors:
+        for error in errors:
+            print("ERROR: %s" % error)
         exit()
 
     return 0
@@ -166,7 +297,8 @@ def downwelling_rad(args):
     # Equation 2.8  Page 27
     Q_Ld = e_g * e_a * sigma * T_a**4 + b * e_g * (1 - e_a) * sigma * T_c**4
 
-    print_v("Q_Ld:\t", Q_Ld)
+    if TRACE is not None:
+        TRACE.value(Q_Ld=Q_Ld)
 
     return Q_Ld
 
@@ -185,7 +317,8 @@ def upwelling_rad(args):
     # Equation 2.5  Page 25
     Q_Lu = e_g * sigma * T_g**4
 
-    print_v("Q_Lu:\t", Q_Lu)
+    if TRACE is not None:
+        TRACE.value(Q_Lu=Q_Lu)
 
     return Q_Lu
 
@@ -212,7 +345,8 @@ def sensible_heat_flux(args, N_R):
         T_s = args.surface_temp
         Q_H = rho * c_p * (T_g - T_s) / r_H
 
-    print_v("Q_H:\t", Q_H)
+    if TRACE is not None:
+        TRACE.value(Q_H=Q_H)
 
     return Q_H
 
@@ -225,7 +359,8 @@ def latent_heat_flux(args, Q_H):
     # Based on the definition on Page 22
     Q_E = Q_H / args.bowen_ratio
 
-    print_v("Q_E:\t", Q_E)
+    if TRACE is not None:
+        TRACE.value(Q_E=Q_E)
 
     return Q_E
 
@@ -245,7 +380,8 @@ def ground_heat_flux(args):
     Q_G = K * (T_s - T_g)
     # NOTE This is an approximation
 
-    print_v("Q_G:\t", Q_G)
+    if TRACE is not None:
+        TRACE.value(Q_G=Q_G)
 
     return Q_G
 
@@ -261,7 +397,7 @@ def local_hour(args):
     # h_utc = hour_to_utc(args)
     # Equation 2.4  Page 24
     # h = (h_utc - 12) * math.pi / 12 + lon * math.pi / 180
-    # print_v("h:\t", h)
+    # TRACE.value(h=h)
 
     # See following web page for explanation of each equation
     # https://www.pveducation.org/pvcdrom/properties-of-sunlight/solar-time
@@ -273,12 +409,8 @@ def local_hour(args):
     TC  = 4 * (args.longitude - LSTM) + EoT
     LST = args.hour + args.minute / 60 + TC / 60
     HRA = 15 * (LST - 12)
-    print_v("LSTM:\t", LSTM)
-    print_v("B:\t", B)
-    print_v("EOT:\t", EoT)
-    print_v("TC:\t", TC)
-    print_v("LST:\t", LST)
-    print_v("HRA:\t", HRA)
+    if TRACE is not None:
+        TRACE.value(LSTM=LSTM, B=B, EoT=EoT, TC=TC, LST=LST, HRA=HRA)
 
     return HRA
 
@@ -296,16 +428,35 @@ def declination(args):
 
     # Equation 2.3  Page 24
     delta = 23.45 * math.cos(2 * math.pi * (doy - d_s) / d_y)
-    print_v("delta:\t", delta)
+    if TRACE is not None:
+        TRACE.value(delta=delta)
 
     return delta
 
 
+def table_day(doy):
+    '''
+    Index of day of year in the solargeometry.py tables
+    None without solargeometry.py or for days not in the tables
+    '''
+
+    if solargeometry is None or doy != int(doy) or int(doy) not in solargeometry.DAYS:
+        return None
+
+    return int(doy)
+
+
 def zenith(args):
     '''
     Calculate cosine of zenith angle
+    Uses the solargeometry.py tables, with identical results, unless tracing
     '''
 
+    day = table_day(args.day_of_year)
+    if TRACE is None and day is not None:
+        return solargeometry.cos_zenith(args.latitude, args.longitude, args.utc_offset,
+                                        args.day_of_solstice, day, args.hour, args.minute)
+
     h   = math.radians(local_hour(args))
     lat = math.radians(args.latitude)
     dec = math.radians(declination(args))
@@ -313,7 +464,8 @@ def zenith(args):
     # Equation 2.2  Page 22
     zenith = math.sin(lat) * math.sin(dec) + math.cos(lat) * math.cos(dec) * math.cos(h)
 
-    print_v("zenith:\t", zenith)
+    if TRACE is not None:
+        TRACE.value(zenith=zenith)
 
     return zenith
 
@@ -325,7 +477,8 @@ def hour_to_utc(args):
 
     utc_time = datetime.datetime.strptime(str(args.hour), "%H") + datetime.timedelta(hours=args.utc_offset)
     utc_hour = utc_time.hour
-    print_v("h_utc:\t", utc_hour)
+    if TRACE is not None:
+        TRACE.value(h_utc=utc_hour)
 
     return utc_hour
 
@@ -339,9 +492,11 @@ def elliptical_orbit_ratio(args):
     # https://physics.stackexchange.com/q/177949
     # NOTE This is an approximation
     #      Earth reaches perihelion between 4th & 6th of January depending on year
-    doy   = args.day_of_year
-    angle = math.radians(0.9856 * (doy - 4))
-    eor   = 1 / (1 - 0.01672 * math.cos(angle))
+    day = table_day(args.day_of_year)
+    if day is not None:
+        eor = solargeometry.ELLIPTICAL_ORBIT_RATIO[day]
+    else:
+        eor = 1 / (1 - 0.01672 * math.cos(math.radians(0.9856 * (args.day_of_year - 4))))
 
     return eor
 
@@ -367,22 +522,39 @@ def solar_rad(args):
         # Based on Equation 2.1  Page 23
         Q_S = S * eor**2 * (1 - a) * zen * tau_s
 
-    print_v("Q_S:\t", Q_S)
+    if TRACE is not None:
+        TRACE.value(Q_S=Q_S)
 
     return Q_S
 
 
+def days_in_year(year):
+    '''
+    Number of days in year, 365 when year is None
+    '''
+
+    if year is not None and calendar.isleap(year):
+        return 366
+
+    return 365
+
+
 def inc_mins_hours_days(args):
     '''
     Increment minutes, hours and days in main computation loop
+    Increment year after the last day of the year if year is set
     '''
 
+    year = getattr(args, 'year', None)
+
     if args.minute == 59:
         args.minute = 0
         if args.hour == 23:
             args.hour = 0
-            if args.day_of_year == 365:
+            if args.day_of_year == days_in_year(year):
                 args.day_of_year = 1
+                if year is not None:
+                    args.year = year + 1
             else:
                 args.day_of_year += 1
         else:
@@ -393,93 +565,899 @@ def inc_mins_hours_days(args):
     return 0
 
 
-def write_csv(args, Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, d_T_s, T_s):
+def set_clock(args, start, minutes):
     '''
-    Write to CSV file
+    Set year, day, hour and minute to a number of minutes after start
+    start is a (year, day, hour, minute) tuple and minutes can be fractional
     '''
 
-    if args.filename is not None:
-        line = str(args.day_of_year) + "\t" + str(args.hour) + "\t" + str(args.minute)
-        line = line + "\t" + str(Q_S) + "\t" + str(Q_Ld) + "\t" + str(Q_Lu) + "\t" + str(Q_H)
-        line = line + "\t" + str(Q_E) + "\t" + str(Q_G) + "\t" + str(d_T_s)
-        line = line + "\t" + str(T_s) + "\n"
+    year, day, hour, minute = start
+    days, minute_of_day = divmod(hour * 60 + minute + minutes, 24 * 60)
+    args.hour, args.minute = divmod(minute_of_day, 60)
+    args.hour = int(args.hour)
+
+    # Wrap to day 1 after the last day of the year like inc_mins_hours_days
+    days = int(days)
+    while days > 0:
+        remaining = days_in_year(year) - day
+        if days <= remaining:
+            day += days
+            days = 0
+        else:
+            days -= remaining + 1
+            day = 1
+            if year is not None:
+                year += 1
 
-        header = False
-        if not os.path.exists(args.filename) or os.stat(args.filename).st_size == 0:
-            header = True
+    args.day_of_year = day
+    args.year = year
 
-        with open(args.filename, 'a+') as f:
-            if header is True:
-                f.write("Day\tHour\tMinute\tQ_S\tQ_Ld\tQ_Lu\tQ_H\tQ_E\tQ_G\td_T_s\tT_s\n")
-            f.write(line)
-        f.close()
+    return 0
 
-        return 0
 
+class CSVWriter(object):
+    '''
+    Write rows to a tab separated file keeping one file handle open for the whole run
 
-def main(args):
+    Rows are buffered and written buffer_rows at a time
+    Appends to an existing file, the header is only written to an empty file
     '''
-    Calculate surface temperature at latitude and longitude
-    Update surface temperature and solar hour angle every minute
-    Optionally write to CSV file every args.report_period minutes
+
+    def __init__(self, filename, columns=COLUMNS, buffer_rows=1024):
+        self.columns     = list(columns)
+        self.buffer_rows = buffer_rows
+        self.lines       = []
+        self.f           = open(filename, 'a')
+
+        if self.f.tell() == 0:
+            self.lines.append("\t".join(self.columns) + "\n")
+
+    def write(self, row):
+        self.lines.append("\t".join([str(v) for v in row]) + "\n")
+
+        if len(self.lines) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.lines))
+        self.lines = []
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NpyWriter(object):
+    '''
+    Write rows to a numpy .npy file as a structured array with one field per column
+
+    Day, Hour, Minute and id are 64 bit integers and all other columns 64 bit floats
+    The file can be memory mapped with numpy.load(filename, mmap_mode='r')
+    Appends to an existing file previously written with the same columns
+    Does not require numpy
+    '''
+
+    # NOTE The header is padded so the row count can be rewritten in place
+    #      https://numpy.org/doc/stable/reference/generated/numpy.lib.format.html
+    MAGIC = b'\x93NUMPY\x01\x00'
+
+    # Columns stored as integers
+    INTEGER_COLUMNS = ('id', 'Day', 'Hour', 'Minute')
+
+    def __init__(self, filename, columns=COLUMNS, buffer_rows=1024):
+        self.columns     = list(columns)
+        self.buffer_rows = buffer_rows
+        self.rows        = []
+        self.n_rows      = 0
+
+        types = ['q' if c in self.INTEGER_COLUMNS else 'd' for c in self.columns]
+        self.row_struct = struct.Struct('<' + ''.join(types))
+        self.descr = [(str(c), '<i8' if t == 'q' else '<f8') for c, t in zip(self.columns, types)]
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self.f = open(filename, 'r+b')
+            self.n_rows = self._read_header()
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(filename, 'w+b')
+            self._write_header()
+
+    def _header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%20d,), }" % (self.descr, self.n_rows)
+        # Magic, 2 byte header length, header and newline total a multiple of 64 bytes
+        pad = 64 - (len(self.MAGIC) + 2 + len(header) + 1) % 64
+
+        return (header + " " * pad + "\n").encode('latin1')
+
+    def _write_header(self):
+        header = self._header()
+        self.f.seek(0)
+        self.f.write(self.MAGIC + struct.pack('<H', len(header)) + header)
+
+    def _read_header(self):
+        magic = self.f.read(len(self.MAGIC))
+        size, = struct.unpack('<H', self.f.read(2))
+        header = ast.literal_eval(self.f.read(size).decode('latin1'))
+
+        if magic != self.MAGIC or header['descr'] != self.descr or size != len(self._header()):
+            raise ValueError("%s was not written by NpyWriter with columns %s" % (self.f.name, self.columns))
+
+        return header['shape'][0]
+
+    def write(self, row):
+        self.rows.append(self.row_struct.pack(*row))
+
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(b"".join(self.rows))
+        self.n_rows += len(self.rows)
+        self.rows = []
+        self._write_header()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(filename, columns=COLUMNS, buffer_rows=1024):
+    '''
+    Open NpyWriter for .npy file names and CSVWriter for anything else
+    '''
+
+    if filename.lower().endswith('.npy'):
+        return NpyWriter(filename, columns, buffer_rows)
+
+    return CSVWriter(filename, columns, buffer_rows)
+
+
+class ForecastConfig(object):
+    '''
+    Forecast parameters using the same names, units and defaults as the
+    command line arguments
+
+    Temperatures are in the units given by degrees
+    A config is never modified by run_forecast so it can be reused
+    '''
+
+    def __init__(self, latitude, longitude, day_of_year, ground_temp, surface_temp,
+                 degrees, percent_net_radiation, **kwargs):
+        self.latitude              = latitude
+        self.longitude             = longitude
+        self.day_of_year           = day_of_year
+        self.ground_temp           = ground_temp
+        self.surface_temp          = surface_temp
+        self.degrees               = degrees
+        self.percent_net_radiation = percent_net_radiation
+
+        for name, default in DEFAULTS.items():
+            setattr(self, name, kwargs.pop(name, default))
+
+        if kwargs:
+            raise TypeError("unknown forecast parameters: %s" % ", ".join(sorted(kwargs)))
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        Create config from argparse Namespace or any object with the same attributes
+        '''
+
+        names = ['latitude', 'longitude', 'day_of_year', 'ground_temp', 'surface_temp',
+                 'degrees', 'percent_net_radiation'] + list(DEFAULTS)
+
+        return cls(**dict((n, getattr(args, n)) for n in names if hasattr(args, n)))
+
+    def errors(self):
+        '''
+        Check all parameters
+        Returns a list of error messages which is empty for a valid config
+        '''
+
+        errors = []
+
+        if str(self.degrees).upper() not in ('C', 'F'):
+            errors.append("'degrees' must be C or F not %r" % (self.degrees,))
+            return errors
+
+        for name in ('ground_temp', 'surface_temp'):
+            if getattr(self, name) is None:
+                errors.append("'%s' is required" % name)
+
+        for name, (min, max) in sorted(RANGES.items()):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if (min is not None and value < min) or (max is not None and value > max):
+                errors.append("'%s' %r not in range [%r, %r]" % (name, value, min, max))
+
+        for name in ('ground_temp', 'surface_temp', 'atmos_temp_constant',
+                     'atmos_temp_adjust', 'cloud_temp_constant', 'cloud_temp_adjust'):
+            errors.extend(temp_errors(getattr(self, name), self.degrees))
+
+        if self.atmos_temp_constant is not None and self.atmos_temp_adjust is not None:
+            errors.append("'atmos_temp_constant' and 'atmos_temp_adjust' cannot both be used.")
+
+        if self.cloud_temp_constant is not None and self.cloud_temp_adjust is not None:
+            errors.append("'cloud_temp_constant' and 'cloud_temp_adjust' cannot both be used.")
+
+        if self.percent_net_radiation == 0 and self.resistance == 0:
+            errors.append("'percent net radiation' and 'resistance to heat flux' cannot both be zero.")
+
+        if self.day_of_year == 366 and days_in_year(self.year) != 366:
+            errors.append("'day_of_year' 366 requires 'year' to be a leap year.")
+
+        if self.integrator not in INTEGRATORS:
+            errors.append("'integrator' must be one of %s not %r" % (", ".join(sorted(INTEGRATORS)), self.integrator))
+
+        if self.aggregates:
+            unknown = [a for a in self.aggregates if a not in AGGREGATES]
+            if unknown:
+                errors.append("'aggregates' must be from %s not %r" % (", ".join(AGGREGATES), unknown))
+            if self.integrator != 'euler':
+                errors.append("'aggregates' require the euler integrator.")
+
+        if not self.tolerance > 0:
+            errors.append("'tolerance' %r must be greater than zero." % (self.tolerance,))
+
+        if self.report_period > self.forecast_minutes:
+            errors.append("'report_period' %d cannot be greater than 'forecast_minutes' %d." %
+                          (self.report_period, self.forecast_minutes))
+
+        if self.cloud_fraction == 0 and (self.cloud_temp_constant is not None or self.cloud_temp_adjust is not None):
+            errors.append("'cloud_temp_constant' and 'cloud_temp_adjust' cannot be used when 'cloud_fraction' is zero.")
+
+        return errors
+
+    def validate(self):
+        '''
+        Raise ValueError listing every problem with the config
+        '''
+
+        errors = self.errors()
+
+        if errors:
+            raise ValueError("Invalid forecast config: " + " ".join(errors))
+
+        return self
+
+    def to_state(self):
+        '''
+        Copy parameters to a new mutable Namespace with temperatures in Kelvin
+
+        The Namespace is the args argument of the flux functions
+        '''
+
+        state = argparse.Namespace(**vars(self))
+
+        if self.degrees.upper() == 'C':
+            to_k = c_to_k
+        elif self.degrees.upper() == 'F':
+            to_k = f_to_k
+
+        for name in ('ground_temp', 'surface_temp', 'atmos_temp_constant',
+                     'atmos_temp_adjust', 'cloud_temp_constant', 'cloud_temp_adjust'):
+            setattr(state, name, to_k(getattr(state, name)))
+
+        return state
+
+
+def from_kelvin(state, k):
+    '''
+    Convert Kelvin to the forecast Celsius or Fahrenheit
+    '''
+
+    if state.degrees.upper() == 'C':
+        return k_to_c(k)
+    elif state.degrees.upper() == 'F':
+        return k_to_f(k)
+
+
+class Tracer(object):
+    '''
+    Collect diagnostics while forecasting, activate with tracing
+
+    Counts and times each flux function per evaluation of all the fluxes
+    Keeps intermediate values from every sample_every evaluations in a
+    ring buffer holding the last buffer_size values
+    '''
+
+    # Flux functions timed separately
+    STAGES = ['solar_rad', 'downwelling_rad', 'upwelling_rad',
+              'sensible_heat_flux', 'latent_heat_flux', 'ground_heat_flux']
+
+    def __init__(self, sample_every=1, buffer_size=10000):
+        self.sample_every = sample_every
+        self.values       = collections.deque(maxlen=buffer_size)
+        self.counts       = collections.Counter()
+        self.times        = collections.defaultdict(float)
+        self.evaluations  = 0
+        self.sampling     = False
+        self.elapsed      = 0
+
+    def value(self, **values):
+        if self.sampling:
+            for name, value in sorted(values.items()):
+                self.values.append((self.evaluations, name, value))
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def fluxes(self, args):
+        '''
+        Timed version of fluxes
+        '''
+
+        self.sampling = self.evaluations % self.sample_every == 0
+        self.evaluations += 1
+        self.counts['evaluations'] += 1
+
+        def timed(stage, *a):
+            start = time.perf_counter()
+            result = globals()[stage](*a)
+            self.times[stage] += time.perf_counter() - start
+            return result
+
+        Q_S  = timed('solar_rad', args)
+        Q_Ld = timed('downwelling_rad', args)
+        Q_Lu = timed('upwelling_rad', args)
+        N_R  = Q_S + Q_Ld - Q_Lu
+        self.value(N_R=N_R)
+        Q_H  = timed('sensible_heat_flux', args, N_R)
+        Q_E  = timed('latent_heat_flux', args, Q_H)
+        Q_G  = timed('ground_heat_flux', args)
+
+        return Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G
+
+    def breakdown(self):
+        '''
+        Per stage time breakdown as lines of text
+        '''
+
+        lines = ["%-20s %10s %10s %10s %6s" % ('Stage', 'Calls', 'Total s', 'us/call', '%')]
+        total = max(self.elapsed, 1e-12)
+        other = total - sum(self.times.values())
+
+        for stage in self.STAGES + ['other']:
+            t = other if stage == 'other' else self.times[stage]
+            calls = self.evaluations if stage != 'other' else 0
+            lines.append("%-20s %10d %10.4f %10.2f %6.1f" %
+                         (stage, calls, t, t / calls * 1e6 if calls else 0, 100 * t / total))
+        lines.append("%-20s %10s %10.4f" % ('total', '', total))
+
+        for name, n in sorted(self.counts.items()):
+            lines.append("%-20s %10d" % (name, n))
+
+        return lines
+
+    def write_values(self, filename):
+        '''
+        Write sampled values as JSON lines
+        '''
+
+        with open(filename, 'w') as f:
+            for evaluation, name, value in self.values:
+                f.write(json.dumps({'evaluation': evaluation, 'name': name, 'value': value}) + "\n")
+
+
+@contextlib.contextmanager
+def tracing(tracer=None):
+    '''
+    Trace forecasts run inside a with block
+    Yields the Tracer, a new one unless tracer is given
+    '''
+
+    global TRACE
+
+    if tracer is None:
+        tracer = Tracer()
+
+    previous, TRACE = TRACE, tracer
+    start = time.perf_counter()
+
+    try:
+        yield tracer
+    finally:
+        tracer.elapsed += time.perf_counter() - start
+        TRACE = previous
+
+
+def fluxes(args):
+    '''
+    Calculate all fluxes at the current time and surface temperature
+    '''
+
+    if TRACE is not None:
+        return TRACE.fluxes(args)
+
+    Q_S  = solar_rad(args)                # Incoming solar radiation
+    Q_Ld = downwelling_rad(args)          # Downwelling longwave radiation
+    Q_Lu = upwelling_rad(args)            # Upwelling longwave radiation
+    N_R  = Q_S + Q_Ld - Q_Lu              # Net radiation
+    Q_H  = sensible_heat_flux(args, N_R)  # Sensible heat flux
+    Q_E  = latent_heat_flux(args, Q_H)    # Latent heat flux
+    Q_G  = ground_heat_flux(args)         # Ground heat flux
+
+    return Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G
+
+
+@jit
+def euler_kernel(lat, lon, utc_offset, d_s, a, b, e_g, tau_s, w_p, bowen, pc_nr, r_H, T_g,
+                 atmos_mode, atmos_temp, cloud_mode, cloud_temp,
+                 T_s, year, doy, hour, minute, steps, sum_d_T_s, aggregate):
+    '''
+    Take steps explicit Euler steps of one minute using only numbers
+
+    The same equations in the same order as fluxes and euler_reports so
+    results are identical, with terms that only change with day hoisted out of the loop
+    Temperatures are in Kelvin and year 0 means no year
+    atmos_mode and cloud_mode are 0 for a constant, 1 for an adjustment to the
+    surface temperature and 2 for the surface temperature
+
+    Returns the six fluxes of the last step, sum_d_T_s plus the change in
+    surface temperature, surface temperature, year, day, hour and minute
+    and, if aggregate is true, a tuple of the sums then minimums then maximums
+    of the six fluxes and surface temperature over the steps
     '''
 
+    # "Constants"
+    S   = 1368   # W m^-2 - Solar irradiance
+    rho = 1.225  # kg m^-3 - Density of air at sea level and 15 degrees C
+    c_p = 1004   # J K^-1 kg^-1 - Specific heat at constant pressure
+    K   = 11     # J m^-2 K^-1 s^-1 - Thermal diffusivity of air
+    d_t = 60
+
+    # Terms which only change with site
+    sin_lat = math.sin(math.radians(lat))
+    cos_lat = math.cos(math.radians(lat))
+    e_a     = 0.725 + 0.17 * math.log10(w_p)            # Equation 2.7  Page 26
+    Ld_a    = e_g * e_a * SIGMA                         # Equation 2.8  Page 27
+    Ld_c    = b * e_g * (1 - e_a) * SIGMA
+    Q_Lu    = e_g * SIGMA * T_g**4.0                    # Equation 2.5  Page 25
+    LSTM    = 15 * utc_offset
+
+    Q_S = Q_Ld = Q_H = Q_E = Q_G = 0.0
+    day = -1
+
+    # Running sums, minimums and maximums for aggregate
+    s_S  = s_Ld  = s_Lu = s_H  = s_E  = s_G  = s_T  = 0.0
+    lo_S = lo_Ld = lo_H = lo_E = lo_G = lo_T = math.inf
+    hi_S = hi_Ld = hi_H = hi_E = hi_G = hi_T = -math.inf
+
+    for i in range(steps):
+        # Terms which only change with day
+        if doy != day:
+            day    = doy
+            B      = math.radians(360 * (doy - 81) / 365.25)
+            EoT    = 9.87 * math.sin(2 * B) - 7.53 * math.cos(B) - 1.5 * math.sin(B)
+            TC     = 4 * (lon - LSTM) + EoT
+            dec    = math.radians(23.45 * math.cos(2 * math.pi * (doy - d_s) / 365.25))  # Equation 2.3  Page 24
+            z_sin  = sin_lat * math.sin(dec)
+            z_cos  = cos_lat * math.cos(dec)
+            eor    = 1 / (1 - 0.01672 * math.cos(math.radians(0.9856 * (doy - 4))))
+            S_day  = S * eor**2.0 * (1 - a)
+
+        LST = hour + minute / 60 + TC / 60
+        zen = z_sin + z_cos * math.cos(math.radians(15 * (LST - 12)))  # Equation 2.2  Page 22
+
+        if zen < 0:
+            Q_S = 0.0
+        else:
+            Q_S = S_day * zen * tau_s  # Based on Equation 2.1  Page 23
+
+        if atmos_mode == 0:
+            T_a = atmos_temp
+        elif atmos_mode == 1:
+            T_a = T_s + atmos_temp
+        else:
+            T_a = T_s
+
+        if cloud_mode == 0:
+            T_c = cloud_temp
+        elif cloud_mode == 1:
+            T_c = T_s + cloud_temp
+        else:
+            T_c = T_s
+
+        Q_Ld = Ld_a * T_a**4.0 + Ld_c * T_c**4.0
+        N_R  = Q_S + Q_Ld - Q_Lu
+
+        if pc_nr != 0:
+            Q_H = pc_nr * N_R  # Based on Question 6  Pages 60 and 61
+        else:
+            Q_H = rho * c_p * (T_g - T_s) / r_H  # EXPERIMENTAL  Based on Equation 2.23  Page 31
+
+        Q_E = Q_H / bowen
+        Q_G = K * (T_s - T_g)
+
+        # Based on only equation in question 6  Page 61
+        d_T_s = (Q_S + Q_Ld - Q_Lu - Q_H - Q_E - Q_G) * d_t / C_G
+        sum_d_T_s += d_T_s
+        T_s = T_s + d_T_s
+
+        if aggregate:
+            s_S  += Q_S
+            s_Ld += Q_Ld
+            s_Lu += Q_Lu
+            s_H  += Q_H
+            s_E  += Q_E
+            s_G  += Q_G
+            s_T  += T_s
+            lo_S, hi_S   = min(lo_S, Q_S), max(hi_S, Q_S)
+            lo_Ld, hi_Ld = min(lo_Ld, Q_Ld), max(hi_Ld, Q_Ld)
+            lo_H, hi_H   = min(lo_H, Q_H), max(hi_H, Q_H)
+            lo_E, hi_E   = min(lo_E, Q_E), max(hi_E, Q_E)
+            lo_G, hi_G   = min(lo_G, Q_G), max(hi_G, Q_G)
+            lo_T, hi_T   = min(lo_T, T_s), max(hi_T, T_s)
+
+        # Same as inc_mins_hours_days
+        if minute == 59:
+            minute = 0
+            if hour == 23:
+                hour = 0
+                leap = year != 0 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+                if doy == (366 if leap else 365):
+                    doy = 1
+                    if year != 0:
+                        year += 1
+                else:
+                    doy += 1
+            else:
+                hour += 1
+        else:
+            minute += 1
+
+    # Q_Lu is the same every step
+    stats = (s_S, s_Ld, s_Lu, s_H, s_E, s_G, s_T,
+             lo_S, lo_Ld, Q_Lu, lo_H, lo_E, lo_G, lo_T,
+             hi_S, hi_Ld, Q_Lu, hi_H, hi_E, hi_G, hi_T)
+
+    return Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, sum_d_T_s, T_s, year, doy, hour, minute, stats
+
+
+def temp_mode(constant, adjust):
+    '''
+    euler_kernel mode and temperature for a constant or adjustment
+    '''
+
+    if constant is not None:
+        return 0, float(constant)
+    elif adjust is not None:
+        return 1, float(adjust)
+
+    return 2, 0.0
+
+
+class PeriodStats(object):
+    '''
+    Running count, sums, minimums and maximums of the six fluxes and surface
+    temperature over the steps of one report period
+    Memory use does not depend on report_period
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums  = [0.0] * len(AGGREGATED)
+        self.mins  = [math.inf] * len(AGGREGATED)
+        self.maxs  = [-math.inf] * len(AGGREGATED)
+
+    def add(self, values):
+        '''
+        Include the fluxes and surface temperature of one step
+        '''
+
+        self.count += 1
+        for j, v in enumerate(values):
+            self.sums[j] += v
+            if v < self.mins[j]:
+                self.mins[j] = v
+            if v > self.maxs[j]:
+                self.maxs[j] = v
+
+    def merge(self, count, stats):
+        '''
+        Include count steps summarised by euler_kernel
+        '''
+
+        n = len(AGGREGATED)
+        self.count += count
+        self.sums = [a + b for a, b in zip(self.sums, stats[:n])]
+        self.mins = [min(a, b) for a, b in zip(self.mins, stats[n:2 * n])]
+        self.maxs = [max(a, b) for a, b in zip(self.maxs, stats[2 * n:])]
+
+    def values(self, state, aggregates):
+        '''
+        Values of aggregate_columns(aggregates) for the period
+        Surface temperatures are in the forecast degrees, energy in J m^-2
+        A period without steps, the final report after a full period, is NaN with zero energy
+        '''
+
+        d_t = 60
+        row = []
+        for j, v in enumerate(AGGREGATED):
+            for a in aggregates:
+                if a == 'energy':
+                    if v != 'T_s':
+                        row.append(self.sums[j] * d_t)
+                    continue
+
+                if self.count == 0:
+                    value = math.nan
+                elif a == 'mean':
+                    value = self.sums[j] / self.count
+                elif a == 'min':
+                    value = self.mins[j]
+                else:
+                    value = self.maxs[j]
+                row.append(from_kelvin(state, value) if v == 'T_s' else value)
+
+        return tuple(row)
+
+
+def kernel_reports(args, start=0, sum_d_T_s=0, Q=None, stats=None):
+    '''
+    Same as euler_reports using euler_kernel between reports
+    '''
+
+    site = ((float(args.latitude), float(args.longitude), int(args.utc_offset),
+             int(args.day_of_solstice), float(args.albedo), float(args.cloud_fraction),
+             float(args.emissivity), float(args.transmissivity), float(args.precip_water),
+             float(args.bowen_ratio), float(args.percent_net_radiation), float(args.resistance),
+             float(args.ground_temp)) +
+            temp_mode(args.atmos_temp_constant, args.atmos_temp_adjust) +
+            temp_mode(args.cloud_temp_constant, args.cloud_temp_adjust))
+
+    def advance(steps, sum_d_T_s):
+        result = euler_kernel(*(site + (float(args.surface_temp), args.year or 0, args.day_of_year,
+                                         args.hour, args.minute, steps, sum_d_T_s,
+                                         stats is not None)))
+        (args.surface_temp, year,
+         args.day_of_year, args.hour, args.minute) = result[7:12]
+        args.year = year or None
+
+        if stats is not None:
+            stats.merge(steps, result[12])
+
+        # Compiled code returns 0.0 rather than 0 for night time solar radiation
+        return (result[0] or 0,) + result[1:6], result[6]
+
+    i = start
+    while i < args.forecast_minutes:
+        # Reports follow steps whose index is a multiple of report_period
+        report = i + (-i % args.report_period)
+        if report >= args.forecast_minutes:
+            break
+
+        Q, sum_d_T_s = advance(report - i + 1, sum_d_T_s)
+        i = report + 1
+
+        yield Q, sum_d_T_s, args.surface_temp
+        sum_d_T_s = 0
+        if stats is not None:
+            stats.reset()
+
+    if i < args.forecast_minutes:
+        Q, sum_d_T_s = advance(args.forecast_minutes - i, sum_d_T_s)
+
+    yield Q, sum_d_T_s, args.surface_temp
+
+
+def report_minutes(args):
+    '''
+    Minutes after the start of the forecast of each report
+    '''
+
+    return [i + 1 for i in range(0, args.forecast_minutes, args.report_period)] + [args.forecast_minutes]
+
+
+def euler_reports(args, start=0, sum_d_T_s=0, Q=None, stats=None):
+    '''
+    Update surface temperature every minute using explicit Euler steps
+    Yields fluxes from the last step, change in surface temperature since the
+    last report and surface temperature every report period
+
+    To resume a forecast after start steps, args holds the clock and surface
+    temperature after those steps, sum_d_T_s the change since the last report
+    and Q the fluxes of the last step
+    If stats is a PeriodStats it holds every step since the last report when
+    each report is yielded
+    '''
+
+    # Trace points are only in the flux functions
+    if TRACE is None:
+        for report in kernel_reports(args, start, sum_d_T_s, Q, stats):
+            yield report
+        return
+
     # "Constants"
     c_g = 1.4 * 10**5  # J m^-2 K^-1 - Soil heat capacity
     d_t = 60
-    sum_d_T_s = 0
-
-    if args.degrees.upper() == 'C':
-        args.ground_temp  = c_to_k(args.ground_temp)
-        args.surface_temp = c_to_k(args.surface_temp)
-        args.atmos_temp_constant = c_to_k(args.atmos_temp_constant)
-        args.atmos_temp_adjust   = c_to_k(args.atmos_temp_adjust)
-        args.cloud_temp_constant = c_to_k(args.cloud_temp_constant)
-        args.cloud_temp_adjust   = c_to_k(args.cloud_temp_adjust)
-    elif args.degrees.upper() == 'F':
-        args.ground_temp  = f_to_k(args.ground_temp)
-        args.surface_temp = f_to_k(args.surface_temp)
-        args.atmos_temp_constant = f_to_k(args.atmos_temp_constant)
-        args.atmos_temp_adjust   = f_to_k(args.atmos_temp_adjust)
-        args.cloud_temp_constant = f_to_k(args.cloud_temp_constant)
-        args.cloud_temp_adjust   = f_to_k(args.cloud_temp_adjust)
-
-    for i in range(0, args.forecast_minutes):
-        Q_S  = solar_rad(args)                # Incoming solar radiation
-        Q_Ld = downwelling_rad(args)          # Downwelling longwave radiation
-        Q_Lu = upwelling_rad(args)            # Upwelling longwave radiation
-        N_R  = Q_S + Q_Ld - Q_Lu              # Net radiation
-        print_v("N_R:\t", N_R)
-        Q_H  = sensible_heat_flux(args, N_R)  # Sensible heat flux
-        Q_E  = latent_heat_flux(args, Q_H)    # Latent heat flux
-        Q_G  = ground_heat_flux(args)         # Ground heat flux
+
+    if Q is not None:
+        Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G = Q
+
+    for i in range(start, args.forecast_minutes):
+        Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G = fluxes(args)
 
         # Based on only equation in question 6  Page 61
         d_T_s = (Q_S + Q_Ld - Q_Lu - Q_H - Q_E - Q_G) * d_t / c_g
         sum_d_T_s += d_T_s
-        print_v("d_T_s:\t", d_T_s)  # , "K")
+        if TRACE is not None:
+            TRACE.value(d_T_s=d_T_s)
         args.surface_temp = args.surface_temp + d_T_s
+        if stats is not None:
+            stats.add((Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, args.surface_temp))
 
         inc_mins_hours_days(args)
 
         if i % args.report_period == 0:
-            if args.degrees.upper() == 'C':
-                T_s = k_to_c(args.surface_temp)
-            elif args.degrees.upper() == 'F':
-                T_s = k_to_f(args.surface_temp)
-
-            print_v("T_s:\t", T_s)  # , "F/C")
-            write_csv(args, Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, sum_d_T_s, T_s)
+            yield (Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G), sum_d_T_s, args.surface_temp
             sum_d_T_s = 0
+            if stats is not None:
+                stats.reset()
+
+    yield (Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G), sum_d_T_s, args.surface_temp
+
+
+def rk23_reports(args):
+    '''
+    Update surface temperature using adaptive Bogacki-Shampine 3(2) Runge-Kutta steps
+    Yields fluxes, change in surface temperature since the last report and
+    surface temperature at the same report times as euler_reports
+
+    Steps are lengthened while the estimated error per step is below
+    args.tolerance (K) and shortened near sunrise and sunset
+    Fluxes are reported at the report time instead of one minute before
+    '''
+
+    # "Constants"
+    c_g   = 1.4 * 10**5  # J m^-2 K^-1 - Soil heat capacity
+    h_min = 1            # s - Shortest step, always accepted
+    h_max = 3600         # s - Longest step
+
+    start = (args.year, args.day_of_year, args.hour, args.minute)
+    T_s   = args.surface_temp
+
+    def rate(t, T_s):
+        set_clock(args, start, t / 60)
+        args.surface_temp = T_s
+        Q = fluxes(args)
+        Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G = Q
+
+        # Based on only equation in question 6  Page 61
+        return Q, (Q_S + Q_Ld - Q_Lu - Q_H - Q_E - Q_G) / c_g
 
-    if args.degrees.upper() == 'C':
-        T_s = k_to_c(args.surface_temp)
-    elif args.degrees.upper() == 'F':
-        T_s = k_to_f(args.surface_temp)
+    t = 0
+    h = 60
+    Q, k1 = rate(t, T_s)
+    T_s_report = T_s
 
-    print_v("Sum_dTs:\t", sum_d_T_s)  # , "K")
-    print("T_s:\t", T_s)  # , "F/C")
-    write_csv(args, Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, sum_d_T_s, T_s)
+    for minutes in report_minutes(args):
+        t_report = minutes * 60
+
+        while t < t_report:
+            d_t = min(h, t_report - t)
+
+            _, k2  = rate(t + d_t / 2, T_s + d_t / 2 * k1)
+            _, k3  = rate(t + 3 * d_t / 4, T_s + 3 * d_t / 4 * k2)
+            T_s_new = T_s + d_t * (2 / 9 * k1 + 1 / 3 * k2 + 4 / 9 * k3)
+            Q_new, k4 = rate(t + d_t, T_s_new)
+
+            # Difference between third and embedded second order solutions
+            error = abs(d_t * (-5 / 72 * k1 + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * k4))
+
+            if error <= args.tolerance or d_t <= h_min:
+                t, T_s, Q, k1 = t + d_t, T_s_new, Q_new, k4
+
+            if error > 0:
+                h = d_t * min(5, max(0.2, 0.9 * (args.tolerance / error)**(1 / 3)))
+            else:
+                h = d_t * 5
+            h = max(h_min, min(h_max, h))
+
+        set_clock(args, start, minutes)
+        args.surface_temp = T_s
+        if TRACE is not None:
+            TRACE.value(d_T_s=T_s - T_s_report)
+
+        yield Q, T_s - T_s_report, T_s
+        T_s_report = T_s
+
+
+# Integrators selectable with --integrator
+INTEGRATORS = {
+    'euler': euler_reports,
+    'rk23':  rk23_reports,
+}
+
+
+def iter_forecast(config):
+    '''
+    Calculate surface temperature at latitude and longitude for a ForecastConfig
+    Update surface temperature and solar hour angle every minute or using
+    adaptive steps depending on the integrator
+
+    Lazily yields one tuple of COLUMNS values per report period plus the
+    final values, the same rows main writes to CSV
+    With config.aggregates each row continues with the aggregate_columns values
+    over every step since the previous report
+    Memory use does not depend on forecast_minutes
+    Does not parse arguments, write files or exit
+    '''
+
+    config.validate()
+    args = config.to_state()
+
+    if config.aggregates:
+        stats   = PeriodStats()
+        reports = euler_reports(args, stats=stats)
+    else:
+        reports = INTEGRATORS[args.integrator](args)
+
+    for Q, d_T_s, T_s in reports:
+        T_s = from_kelvin(args, T_s)
+        if TRACE is not None:
+            TRACE.value(T_s=T_s)
+            TRACE.count('reports')
+
+        row = (args.day_of_year, args.hour, args.minute) + Q + (d_T_s, T_s)
+        if config.aggregates:
+            row += stats.values(args, config.aggregates)
+
+        yield row
+
+
+def run_forecast(config):
+    '''
+    Calculate surface temperature at latitude and longitude for a ForecastConfig
+
+    Returns a dict mapping each of COLUMNS, and any aggregate_columns, to a list
+    with one value per report period plus the final values, the same rows main writes to CSV
+    Does not parse arguments, write files or exit
+    '''
+
+    rows = list(iter_forecast(config))
+
+    return dict((c, [row[i] for row in rows]) for i, c in enumerate(COLUMNS + aggregate_columns(config.aggregates)))
+
+
+def main(args):
+    '''
+    Calculate surface temperature at latitude and longitude
+    Optionally write to CSV or .npy file every args.report_period minutes
+    '''
+
+    writer = None
+    if args.filename is not None:
+        writer = open_writer(args.filename, COLUMNS + aggregate_columns(args.aggregates))
+
+    try:
+        for row in iter_forecast(ForecastConfig.from_args(args)):
+            if writer is not None:
+                writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print("T_s:\t", row[len(COLUMNS) - 1])  # , "F/C")
 
     return 0
 
@@ -490,52 +1468,38 @@ def post_parse_args_checks(args):
     # NOTE: Could not get argparse.Action to validate both Celsius and Fahrenheit temperatures
     #       because degrees returned None instead of F or C (when using getattr)
     #       Possibly because parse_args() not yet ran
-    #       So, validation using temp_range after parse_args()
-    temp_range(args.ground_temp,         args.degrees)
-    temp_range(args.surface_temp,        args.degrees)
-    temp_range(args.atmos_temp_constant, args.degrees)
-    temp_range(args.atmos_temp_adjust,   args.degrees)
-    temp_range(args.cloud_temp_constant, args.degrees)
-    temp_range(args.cloud_temp_adjust,   args.degrees)
-
-    if args.percent_net_radiation == 0 and args.resistance == 0:
-        print("\nERROR: 'percent net radiation' and 'resistance to heat flux' cannot both be zero.")
-        print("ERROR: 'percent net radiation' %f" % args.percent_net_radiation)
-        print("ERROR: 'resistance to heat flux' %f\n" % args.resistance)
-        exit()
+    #       So, validation using ForecastConfig.errors after parse_args()
+    errors = ForecastConfig.from_args(args).errors()
 
-    if args.report_period > args.forecast_minutes:
-        print("\nERROR: 'report_period' cannot be greater than 'forecast_minutes'.")
-        print("ERROR: 'report_period' %d" % args.report_period)
-        print("ERROR: 'forecast_minutes' %d\n" % args.forecast_minutes)
-        exit()
-
-    if args.cloud_fraction == 0 and (args.cloud_temp_constant is not None or args.cloud_temp_adjust is not None):
-        print("\nERROR: 'cloud_temp_constant' and 'cloud_temp_adjust' cannot be used when 'cloud_fraction' is zero.")
-        print("ERROR: 'cloud_fraction' %f" % args.cloud_fraction)
-        if args.cloud_temp_constant is not None:
-            print("ERROR: 'cloud_temp_constant' %f\n" % args.cloud_temp_constant)
-        if args.cloud_temp_adjust is not None:
-            print("ERROR: 'cloud_temp_adjust' %f\n" % args.cloud_temp_adjust)
-        exit()
+    if errors:
+        print()
+        for error in errors:
+            print("ERROR: %s" % error)
+        print()
+        exit(1)
 
     return 0
 
 
-if __name__ == '__main__':
+def make_parser(description="Calculate surface temperature at latitude and longitude"):
+    '''
+    Create the command line argument parser
+    Also used by the other command line scripts which add their own arguments
+    '''
+
     parser = argparse.ArgumentParser(
-            description="Calculate surface temperature at latitude and longitude https://github.com/makeyourownmaker/ParametricWeatherModel")
+            description=description + " https://github.com/makeyourownmaker/ParametricWeatherModel")
 
     required = parser.add_argument_group('required arguments')
     required.add_argument('-la', '--latitude',
             help='Latitude (-90 to 90; plus for north, minus for south)',
-            required=True, type=float_range(-90.0, 90.0), metavar="[-90.0, 90.0]")
+            required=True, type=float_range(*RANGES['latitude']), metavar="[-90.0, 90.0]")
     required.add_argument('-lo', '--longitude',
             help='Longitude (-180 to 180; plus for east, minus for west)',
-            required=True, type=float_range(-180.0, 180.0), metavar="[-180.0, 180.0]")
+            required=True, type=float_range(*RANGES['longitude']), metavar="[-180.0, 180.0]")
     required.add_argument('-da', '--day_of_year',
             help='Julian day of year',
-            required=True, type=int_range(0, 365), metavar="[1, 365]")
+            required=True, type=int_range(*RANGES['day_of_year']), metavar="[1, 366]")
     # validation using temp_range after parse_args()
     required.add_argument('-gt', '--ground_temp',
             help='Ground reservoir temperature (Fahrenheit or Celsius)',
@@ -549,53 +1513,72 @@ if __name__ == '__main__':
             required=True, type=str, choices=['C', 'F', 'c', 'f'])
     required.add_argument('-pr', '--percent_net_radiation',
             help='Percent net radiation',
-            required=True, type=float_range(0, 1), metavar="[0, 1]")
+            required=True, type=float_range(*RANGES['percent_net_radiation']), metavar="[0, 1]")
 
     optional = parser._action_groups.pop()
     optional.add_argument('-v',  '--verbose',
-            help='Print additional information - default=%(default)s',
-            default=True, action="store_false")
+            help='Print a time breakdown and counts at the end of the forecast',
+            default=False, action="store_true")
+    optional.add_argument('-ts', '--trace_sample',
+            help='With --verbose keep intermediate values every this many flux evaluations - default=%(default)s',
+            default=60, type=int_range(1, None), metavar="[1, None]")
+    optional.add_argument('-tf', '--trace_file',
+            help='With --verbose write the last 10000 sampled intermediate values to this JSON lines file',
+            default=None, type=str)
     optional.add_argument('-ho', '--hour',
             help='Initial hour of day - default=%(default)s',
-            default=12, type=int, metavar="[0, 24]", choices=range(0, 25))
+            default=DEFAULTS['hour'], type=int, metavar="[0, 24]", choices=range(0, 25))
     optional.add_argument('-mi', '--minute',
             help='Initial minute of hour - default=%(default)s',
-            default=0, type=int, metavar="[0, 59]", choices=range(0, 60))
+            default=DEFAULTS['minute'], type=int, metavar="[0, 59]", choices=range(0, 60))
     optional.add_argument('-al', '--albedo',
             help='Albedo - default=%(default)s',
-            default=0.3, type=float_range(0.0, 1.0), metavar="[0.0, 1.0]")
+            default=DEFAULTS['albedo'], type=float_range(*RANGES['albedo']), metavar="[0.0, 1.0]")
     optional.add_argument('-cf', '--cloud_fraction',
             help='Cloud fraction - default=%(default)s',
-            default=0, type=float_range(0.0, 1.0), metavar="[0.0, 1.0]")
+            default=DEFAULTS['cloud_fraction'], type=float_range(*RANGES['cloud_fraction']), metavar="[0.0, 1.0]")
     optional.add_argument('-ds', '--day_of_solstice',
             help='Day of solstice - default=%(default)s',
-            default=173, type=int, metavar="[172, 173]", choices=range(172, 174))
+            default=DEFAULTS['day_of_solstice'], type=int, metavar="[172, 173]", choices=range(172, 174))
     optional.add_argument('-uo', '--utc_offset',
             help='UTC offset in hours - default=%(default)s',
-            default=0, type=int, metavar="[-12, 12]", choices=range(-12, 13))
+            default=DEFAULTS['utc_offset'], type=int, metavar="[-12, 12]", choices=range(-12, 13))
     optional.add_argument('-rp', '--report_period',
             help='Report period in minutes - default=%(default)s',
-            default=60, type=int_range(1, 61), metavar="[1, 60]")
+            default=DEFAULTS['report_period'], type=int_range(*RANGES['report_period']), metavar="[1, None]")
     optional.add_argument('-fm', '--forecast_minutes',
             help='Forecast period in minutes - default=%(default)s',
-            default=1, type=int_range(1, 1441), metavar="[1, 1440]")
+            default=DEFAULTS['forecast_minutes'], type=int_range(*RANGES['forecast_minutes']), metavar="[1, None]")
     optional.add_argument('-tr', '--transmissivity',
             help='Atmospheric transmissivity - default=%(default)s',
-            default=0.8, type=float_range(0.0, 1.0), metavar="[0.0, 1.0]")
+            default=DEFAULTS['transmissivity'], type=float_range(*RANGES['transmissivity']), metavar="[0.0, 1.0]")
     optional.add_argument('-em', '--emissivity',
             help='Surface emissivity - default=%(default)s',
-            default=0.9, type=float_range(0.7, 0.99), metavar="[0.7, 0.99]")
+            default=DEFAULTS['emissivity'], type=float_range(*RANGES['emissivity']), metavar="[0.7, 0.99]")
     optional.add_argument('-pw', '--precip_water',
             help='Precipitable water in cm - default=%(default)s',
-            default=1, type=float_range(0.0, 7.5), metavar="[0.0, 7.5]")
+            default=DEFAULTS['precip_water'], type=float_range(*RANGES['precip_water']), metavar="[0.0, 7.5]")
     optional.add_argument('-br', '--bowen_ratio',
             help='Bowen ratio - default=%(default)s',
-            default=0.9, type=float_range(-10.0, 10.0), metavar="[-10.0, 10.0]")
+            default=DEFAULTS['bowen_ratio'], type=float_range(*RANGES['bowen_ratio']), metavar="[-10.0, 10.0]")
     optional.add_argument('-fn', '--filename',
-            help='File name for CSV output', type=str)
+            help='File name for CSV output or binary output if ending in .npy', type=str)
     optional.add_argument('-rh', '--resistance',
             help='EXPERIMENTAL: Resistance to heat flux (greater than 0)',
-            default=0, type=float_range(0, None), metavar="[0, None]")
+            default=DEFAULTS['resistance'], type=float_range(*RANGES['resistance']), metavar="[0, None]")
+    optional.add_argument('-yr', '--year',
+            help='Year of the first day, enables leap years - default=%(default)s (365 day years)',
+            default=DEFAULTS['year'], type=int_range(*RANGES['year']), metavar="[1, 9999]")
+    optional.add_argument('-in', '--integrator',
+            help='Time integration method, fixed one minute steps or adaptive steps - default=%(default)s',
+            default=DEFAULTS['integrator'], type=str, choices=sorted(INTEGRATORS))
+    optional.add_argument('-to', '--tolerance',
+            help='Error tolerance per step in K for the rk23 integrator - default=%(default)s',
+            default=DEFAULTS['tolerance'], type=float)
+    optional.add_argument('-ag', '--aggregates',
+            help='Also write these statistics over every step of each report period, comma separated from ' +
+                 ', '.join(AGGREGATES) + ' - default none',
+            default=DEFAULTS['aggregates'], type=aggregate_names, metavar=",".join(AGGREGATES))
 
     mutex1 = parser.add_mutually_exclusive_group()
     # validation using temp_range after parse_args()
@@ -618,10 +1601,21 @@ if __name__ == '__main__':
             nargs='?', default=None, type=float)
 
     parser._action_groups.append(optional)
-    args = parser.parse_args()
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
 
     post_parse_args_checks(args)
 
-    print_v = print if args.verbose else lambda *a, **k: None
+    if args.verbose:
+        with tracing(Tracer(args.trace_sample)) as tracer:
+            main(args)
 
-    main(args)
+        print("\n".join(tracer.breakdown()))
+        if args.trace_file is not None:
+            tracer.write_values(args.trace_file)
+    else:
+        main(args)
@@ -0,0 +1,241 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import math
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme as ar
+
+
+# NOTE Sensitivity of surface temperature to the model parameters in one forecast
+#      Tangent-linear (forward mode) version of the arrayscheme equations, every
+#      flux is calculated along with its derivative with respect to each parameter
+#      and the derivatives are carried through the Euler steps with the temperature
+#      Replaces one finite difference forecast per parameter with a single forecast
+#      Derivatives are in forecast degrees per unit of each parameter, so per degree
+#      for temperatures, and NaN where a parameter is not used
+
+
+# Parameters with derivatives
+PARAMETERS = ['albedo', 'emissivity', 'transmissivity', 'precip_water', 'cloud_fraction',
+              'bowen_ratio', 'percent_net_radiation', 'resistance', 'ground_temp',
+              'surface_temp', 'atmos_temp_constant', 'atmos_temp_adjust',
+              'cloud_temp_constant', 'cloud_temp_adjust']
+
+# Output columns
+COLUMNS = ps.COLUMNS[:3] + ['T_s'] + ['dT_s_d_%s' % p for p in PARAMETERS]
+
+
+def seeds(p, parameters):
+    '''
+    Unit tangents of each parameter, shaped (sites, parameters)
+    Temperatures are in Kelvin so their tangents are dK per forecast degree
+    '''
+
+    n = len(p['latitude'])
+    dK = np.where(p['degrees'] == 'C', 1.0, 5 / 9)
+
+    d = {}
+    for j, name in enumerate(parameters):
+        d[name] = np.zeros((n, len(parameters)))
+        d[name][:, j] = dK if name in ar.TEMP_FIELDS else 1.0
+
+    return d
+
+
+def col(x):
+    '''
+    Per-site values as a column to scale per-parameter tangents
+    '''
+
+    return x[:, None]
+
+
+def temp_tangent(constant, adjust, T_s, d_constant, d_adjust, d_T_s):
+    '''
+    Atmospheric or cloud base temperature and its tangent
+    '''
+
+    use_constant = ~np.isnan(constant)[:, None]
+    use_adjust   = ~np.isnan(adjust)[:, None]
+
+    T = np.where(np.isnan(constant), np.where(np.isnan(adjust), T_s, T_s + adjust), constant)
+    d = np.where(use_constant, d_constant, np.where(use_adjust, d_T_s + d_adjust, d_T_s))
+
+    return T, d
+
+
+def step(p, d, T_s, d_T_s, day, hour, minute):
+    '''
+    Fluxes and change in surface temperature over one time step, as arrayscheme.step,
+    plus the tangent of the change in surface temperature
+    '''
+
+    Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, change = ar.step(p, T_s, day, hour, minute)
+
+    sigma = ar.SIGMA
+
+    # Solar radiation, zero at night
+    zen    = ar.zenith(p, day, hour, minute)
+    eor    = ar.ELLIPTICAL_ORBIT_RATIO[day]
+    is_day = col(zen >= 0)
+    k_S    = ar.S * eor**2 * zen
+    d_Q_S  = is_day * (col(-k_S * p['transmissivity']) * d['albedo'] +
+                       col(k_S * (1 - p['albedo'])) * d['transmissivity'])
+
+    # Downwelling and upwelling longwave radiation
+    e_g = p['emissivity']
+    b   = p['cloud_fraction']
+    e_a = 0.725 + 0.17 * np.log10(p['precip_water'])
+    d_e_a = col(0.17 / (p['precip_water'] * math.log(10))) * d['precip_water']
+
+    T_a, d_T_a = temp_tangent(p['atmos_temp_constant'], p['atmos_temp_adjust'], T_s,
+                              d['atmos_temp_constant'], d['atmos_temp_adjust'], d_T_s)
+    T_c, d_T_c = temp_tangent(p['cloud_temp_constant'], p['cloud_temp_adjust'], T_s,
+                              d['cloud_temp_constant'], d['cloud_temp_adjust'], d_T_s)
+
+    d_Q_Ld = (col(e_a * sigma * T_a**4 + b * (1 - e_a) * sigma * T_c**4) * d['emissivity'] +
+              col(e_g * sigma * T_a**4 - b * e_g * sigma * T_c**4) * d_e_a +
+              col(e_g * (1 - e_a) * sigma * T_c**4) * d['cloud_fraction'] +
+              col(4 * e_g * e_a * sigma * T_a**3) * d_T_a +
+              col(4 * b * e_g * (1 - e_a) * sigma * T_c**3) * d_T_c)
+
+    T_g = p['ground_temp']
+    d_Q_Lu = col(sigma * T_g**4) * d['emissivity'] + col(4 * e_g * sigma * T_g**3) * d['ground_temp']
+
+    # Sensible heat flux using percent of net radiation or resistance
+    N_R   = Q_S + Q_Ld - Q_Lu
+    d_N_R = d_Q_S + d_Q_Ld - d_Q_Lu
+    pc_nr = p['percent_net_radiation']
+    r_H   = p['resistance']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_Q_H = np.where(col(pc_nr != 0),
+                         col(N_R) * d['percent_net_radiation'] + col(pc_nr) * d_N_R,
+                         col(ar.RHO * ar.C_P / r_H) * (d['ground_temp'] - d_T_s) -
+                         col(ar.RHO * ar.C_P * (T_g - T_s) / r_H**2) * d['resistance'])
+
+    # Latent and ground heat flux
+    beta = p['bowen_ratio']
+    d_Q_E = d_Q_H / col(beta) - col(Q_H / beta**2) * d['bowen_ratio']
+    d_Q_G = ar.K * (d_T_s - d['ground_temp'])
+
+    d_change = (d_Q_S + d_Q_Ld - d_Q_Lu - d_Q_H - d_Q_E - d_Q_G) * ar.D_T / ar.C_G
+
+    return (Q_S, Q_Ld, Q_Lu, Q_H, Q_E, Q_G, change), d_change
+
+
+def unused(p, parameters):
+    '''
+    Mask shaped (sites, parameters) of parameters which do not affect each site
+    '''
+
+    mask = dict((name, np.zeros(len(p['latitude']), dtype=bool)) for name in parameters)
+
+    for name in ('atmos_temp_constant', 'atmos_temp_adjust', 'cloud_temp_constant', 'cloud_temp_adjust'):
+        mask[name] = np.isnan(p[name])
+
+    # The sensible heat flux uses percent of net radiation unless it is zero, then resistance
+    mask['percent_net_radiation'] = p['percent_net_radiation'] == 0
+    mask['resistance']            = p['percent_net_radiation'] != 0
+
+    return np.column_stack([mask[name] for name in parameters])
+
+
+def iter_sensitivities(sites, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+                       report_period=ps.DEFAULTS['report_period'], parameters=PARAMETERS):
+    '''
+    Surface temperature and its derivatives with respect to parameters for many sites
+
+    sites is the same as for arrayscheme.iter_forecast
+    Lazily yields a dict with Day, Hour, Minute and T_s arrays with one value per
+    site and a 'dT_s' array shaped (sites, parameters), every report period plus
+    the final values, the same report times as parametricscheme.iter_forecast
+    '''
+
+    p = ar.site_arrays(sites)
+    d = seeds(p, PARAMETERS)
+
+    # Forecast degrees per Kelvin
+    per_K = np.where(p['degrees'] == 'C', 1.0, 9 / 5)[:, None]
+    mask  = unused(p, PARAMETERS)
+    index = [PARAMETERS.index(name) for name in parameters]
+
+    T_s   = p['surface_temp'].copy()
+    d_T_s = d['surface_temp'].copy()
+    year, day, hour, mins = p['year'], p['day_of_year'], p['hour'], p['minute']
+
+    def report():
+        dT = np.where(mask, np.nan, per_K * d_T_s)
+        return {'Day': day, 'Hour': hour, 'Minute': mins,
+                'T_s': ar.from_kelvin(p, T_s), 'dT_s': dT[:, index]}
+
+    for i in range(0, forecast_minutes):
+        fluxes, d_change = step(p, d, T_s, d_T_s, day, hour, mins)
+        T_s   = T_s + fluxes[6]
+        d_T_s = d_T_s + d_change
+
+        year, day, hour, mins = ar.inc_mins_hours_days(year, day, hour, mins)
+
+        if i % report_period == 0:
+            yield report()
+
+    yield report()
+
+
+def sensitivities(config, parameters=PARAMETERS):
+    '''
+    Derivatives of surface temperature for a ForecastConfig
+
+    Returns a dict mapping Day, Hour, Minute and T_s to lists and each
+    parameter to a list of dT_s/dparameter, one value per report period
+    plus the final values
+    '''
+
+    config.validate()
+
+    site = dict((n, v) for n, v in vars(config).items()
+                if n not in ('forecast_minutes', 'report_period', 'integrator', 'tolerance'))
+
+    result = dict((c, []) for c in ps.COLUMNS[:3] + ['T_s'] + list(parameters))
+
+    for row in iter_sensitivities(site, config.forecast_minutes, config.report_period, parameters):
+        for c in ps.COLUMNS[:3] + ['T_s']:
+            result[c].append(row[c][0].item())
+        for j, name in enumerate(parameters):
+            result[name].append(row['dT_s'][0, j].item())
+
+    return result
+
+
+def main(args):
+    '''
+    Forecast the command line site with sensitivities
+    Optionally write them to CSV or .npy file every args.report_period minutes
+    '''
+
+    result = sensitivities(ps.ForecastConfig.from_args(args))
+
+    if args.filename is not None:
+        with ps.open_writer(args.filename, COLUMNS) as writer:
+            for row in zip(*[result[c] for c in ps.COLUMNS[:3] + ['T_s'] + PARAMETERS]):
+                writer.write(row)
+
+    print("T_s:\t", result['T_s'][-1])
+    for name in PARAMETERS:
+        print("dT_s/d%-22s %s" % (name + ':', result[name][-1]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature and its sensitivity to each parameter at latitude and longitude")
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
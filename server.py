@@ -0,0 +1,399 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+
+import parametricscheme as ps
+import batch
+
+
+# NOTE Long-lived forecast service, avoids interpreter startup and argparse for every forecast
+#      POST /forecast with a JSON object using the long command line option names
+#      returns {"cached": ..., "forecast": {column: [values]}} with the CSV output columns
+#      GET /metrics returns request counts, cache hit rate, batch sizes and latencies
+#      Requests arriving within the batch window are run together with batch.run_chunk,
+#      identical requests share one forecast and finished forecasts are kept in an LRU cache
+#      Only the python standard library is needed, numpy is used for batches if installed
+
+
+# Longest request body accepted
+MAX_BODY = 1 << 20
+
+# Longest forecast accepted, forecasts run one batch at a time so one long
+# forecast holds up every request behind it
+MAX_MINUTES = 7 * 1440
+
+# Latencies kept for the metrics percentiles
+LATENCY_SAMPLES = 10000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def normalize(config):
+    '''
+    Cache key for a ForecastConfig, equal for requests with the same forecast
+    '''
+
+    params = vars(config).copy()
+    params['degrees'] = str(params['degrees']).upper()
+
+    return tuple(sorted(params.items()))
+
+
+class LRUCache(object):
+    '''
+    Least recently used cache holding at most size items
+    '''
+
+    def __init__(self, size=1024):
+        self.size  = size
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Metrics(object):
+    '''
+    Request counts and latencies
+    '''
+
+    def __init__(self):
+        self.started   = time.time()
+        self.counts    = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def report(self, cache_size):
+        '''
+        Metrics as a JSON serialisable dict, latencies in milliseconds
+        '''
+
+        c = self.counts
+        lookups = c['hits'] + c['misses']
+        latency = sorted(self.latencies)
+
+        def percentile(q):
+            return 1e3 * latency[min(len(latency) - 1, int(q / 100 * len(latency)))] if latency else None
+
+        return {'uptime_s':        time.time() - self.started,
+                'requests':        c['requests'],
+                'errors':          c['errors'],
+                'cache_hits':      c['hits'],
+                'cache_misses':    c['misses'],
+                'cache_hit_rate':  c['hits'] / lookups if lookups else None,
+                'cache_size':      cache_size,
+                'coalesced':       c['coalesced'],
+                'batches':         c['batches'],
+                'forecasts':       c['forecasts'],
+                'mean_batch_size': c['forecasts'] / c['batches'] if c['batches'] else None,
+                'latency_ms':      dict(('p%d' % q, percentile(q)) for q in (50, 90, 99)),
+                'latency_max_ms':  1e3 * latency[-1] if latency else None}
+
+
+def run(chunk):
+    '''
+    Forecast a list of (cache key, ForecastConfig) as one batch
+    Returns a dict mapping cache keys to dicts of COLUMNS lists
+    '''
+
+    results = dict((key, dict((c, []) for c in ps.COLUMNS)) for key, config in chunk)
+
+    for row in batch.run_chunk(chunk):
+        result = results[row[0]]
+        for c, v in zip(ps.COLUMNS, row[1:]):
+            result[c].append(v)
+
+    return results
+
+
+def compute(chunk):
+    '''
+    Forecast a list of (cache key, ForecastConfig)
+    Returns a dict mapping cache keys to dicts of COLUMNS lists, or to the
+    exception raised by that forecast
+
+    If the batch fails each forecast runs on its own, so one failing forecast
+    does not fail the others batched with it
+    '''
+
+    try:
+        return run(chunk)
+    except Exception:
+        pass
+
+    results = {}
+    for key, config in chunk:
+        try:
+            results.update(run([(key, config)]))
+        except Exception as e:
+            results[key] = e
+
+    return results
+
+
+class ForecastService(object):
+    '''
+    Coalesces concurrent forecast requests into batches and caches the results
+
+    Requests wait at most window seconds, or less once max_batch forecasts are
+    waiting, then all waiting forecasts run together in a worker thread
+    Forecasts longer than max_minutes are rejected
+    '''
+
+    def __init__(self, cache_size=1024, window=0.005, max_batch=1000, max_minutes=MAX_MINUTES):
+        self.cache       = LRUCache(cache_size)
+        self.metrics     = Metrics()
+        self.window      = window
+        self.max_batch   = max_batch
+        self.max_minutes = max_minutes
+        self.executor  = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending   = collections.OrderedDict()
+        self.inflight  = {}
+        self.timer     = None
+
+    async def forecast(self, params):
+        '''
+        Forecast for a dict of command line parameters
+        Returns (result, cached) or raises ValueError with one argument per error
+        '''
+
+        scenario_id, config, errors = batch.validate(0, params)
+        if errors:
+            raise ValueError(*errors)
+        if config.forecast_minutes > self.max_minutes:
+            raise ValueError("'forecast_minutes' %d is more than the server maximum %d" %
+                             (config.forecast_minutes, self.max_minutes))
+
+        key = normalize(config)
+
+        result = self.cache.get(key)
+        if result is not None:
+            self.metrics.counts['hits'] += 1
+            return result, True
+
+        self.metrics.counts['misses'] += 1
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.metrics.counts['coalesced'] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[key] = future
+            self.pending[key]  = config
+
+            if len(self.pending) >= self.max_batch:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+        return await asyncio.shield(future), False
+
+    def flush(self):
+        '''
+        Start running every waiting forecast as one batch
+        '''
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        chunk = list(self.pending.items())
+        self.pending = collections.OrderedDict()
+
+        self.metrics.counts['batches']   += 1
+        self.metrics.counts['forecasts'] += len(chunk)
+
+        task = asyncio.get_running_loop().run_in_executor(self.executor, compute, chunk)
+        task.add_done_callback(lambda t: self.finish(chunk, t))
+
+    def finish(self, chunk, task):
+        '''
+        Cache finished forecasts and wake up their requests
+        '''
+
+        error   = task.exception()
+        results = task.result() if error is None else {}
+
+        for key, config in chunk:
+            future = self.inflight.pop(key)
+            result = results.get(key, error)
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                self.cache.put(key, result)
+                future.set_result(result)
+
+    async def handle(self, method, path, body):
+        '''
+        Answer one HTTP request
+        Returns (status, JSON serialisable response)
+        '''
+
+        if path == '/metrics':
+            if method != 'GET':
+                return 405, {'errors': ["use GET for /metrics"]}
+            return 200, self.metrics.report(len(self.cache))
+
+        if path != '/forecast':
+            return 404, {'errors': ["unknown path %s" % path]}
+        if method != 'POST':
+            return 405, {'errors': ["use POST for /forecast"]}
+
+        start = time.perf_counter()
+        self.metrics.counts['requests'] += 1
+
+        try:
+            params = json.loads(body.decode('utf-8'))
+            if not isinstance(params, dict):
+                raise ValueError("request must be a JSON object")
+            result, cached = await self.forecast(params)
+        except ValueError as e:
+            self.metrics.counts['errors'] += 1
+            return 400, {'errors': [str(a) for a in e.args]}
+        except Exception as e:
+            self.metrics.counts['errors'] += 1
+            return 500, {'errors': ["%s: %s" % (type(e).__name__, e)]}
+
+        self.metrics.latencies.append(time.perf_counter() - start)
+
+        return 200, {'cached': cached, 'forecast': result}
+
+    async def serve_connection(self, reader, writer):
+        '''
+        Read HTTP/1.1 requests from one connection until it closes
+        '''
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+
+                method, path, version = line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, response = 413, {'errors': ["request body over %d bytes" % MAX_BODY]}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.handle(method, path, body)
+                    keep_alive = (headers.get('connection', '').lower() != 'close' and
+                                  version == 'HTTP/1.1')
+
+                data = json.dumps(response).encode('utf-8')
+                writer.write(("HTTP/1.1 %d %s\r\n"
+                              "Content-Type: application/json\r\n"
+                              "Content-Length: %d\r\n"
+                              "Connection: %s\r\n\r\n" %
+                              (status, REASONS[status], len(data),
+                               'keep-alive' if keep_alive else 'close')).encode('latin-1') + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def start(service, host='127.0.0.1', port=8080, socket=None):
+    '''
+    Start serving on a TCP port or a Unix socket
+    Returns the asyncio server
+    '''
+
+    if socket is not None:
+        return await asyncio.start_unix_server(service.serve_connection, path=socket)
+
+    return await asyncio.start_server(service.serve_connection, host, port)
+
+
+async def serve(args):
+    '''
+    Serve forecasts until interrupted
+    '''
+
+    service = ForecastService(args.cache_size, args.window / 1000, args.max_batch, args.max_minutes)
+    server  = await start(service, args.host, args.port, args.socket)
+
+    print("Serving on:\t", args.socket or "http://%s:%d" % (args.host, args.port))
+
+    async with server:
+        await server.serve_forever()
+
+
+def make_parser():
+    '''
+    Create the command line argument parser
+    '''
+
+    parser = argparse.ArgumentParser(
+            description="Serve forecasts over HTTP https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-ho', '--host',
+            help='Host to listen on - default=%(default)s',
+            default='127.0.0.1', type=str)
+    parser.add_argument('-po', '--port',
+            help='TCP port to listen on - default=%(default)s',
+            default=8080, type=ps.int_range(0, 65535), metavar="[0, 65535]")
+    parser.add_argument('-so', '--socket',
+            help='Unix socket to listen on instead of a TCP port',
+            default=None, type=str)
+    parser.add_argument('-cs', '--cache_size',
+            help='Forecasts kept in the cache - default=%(default)s',
+            default=1024, type=ps.int_range(0, None), metavar="[0, None]")
+    parser.add_argument('-wi', '--window',
+            help='Milliseconds to wait for other requests to batch with - default=%(default)s',
+            default=5.0, type=ps.float_range(0.0, None), metavar="[0.0, None]")
+    parser.add_argument('-mb', '--max_batch',
+            help='Forecasts run together at most - default=%(default)s',
+            default=1000, type=ps.int_range(1, None), metavar="[1, None]")
+    parser.add_argument('-mm', '--max_minutes',
+            help='Longest forecast_minutes accepted - default=%(default)s',
+            default=MAX_MINUTES, type=ps.int_range(1, None), metavar="[1, None]")
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        sys.exit(0)
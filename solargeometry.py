@@ -0,0 +1,119 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import math
+from functools import lru_cache
+
+
+# NOTE Precomputed solar geometry for the scheme in parametricscheme.py
+#      Declination, equation of time and elliptical orbit ratio only change with
+#      day of year so they are tabulated once for every day instead of every minute
+#      Sine and cosine of latitude only change with site so they are cached
+#      Values are computed with the same expressions as parametricscheme.py
+#      so cos_zenith returns exactly the same values as parametricscheme.zenith
+#      No external dependencies
+
+
+# Days covered by the tables, 0 and 366 included for the extremes of day_of_year validation
+DAYS = range(0, 367)
+
+# Valid day_of_solstice values
+SOLSTICES = (172, 173)
+
+# Maximum number of sites with cached latitude terms
+SITE_CACHE_SIZE = 4096
+
+
+def equation_of_time(doy):
+    '''
+    Calculate equation of time in minutes
+    '''
+
+    # Same approximation as parametricscheme.local_hour
+    # https://www.pveducation.org/pvcdrom/properties-of-sunlight/solar-time
+    B   = math.radians(360 * (doy - 81) / 365.25)
+    EoT = 9.87 * math.sin(2 * B) - 7.53 * math.cos(B) - 1.5 * math.sin(B)
+
+    return EoT
+
+
+def declination(doy, d_s):
+    '''
+    Calculate declination angle in radians
+    '''
+
+    # Equation 2.3  Page 24
+    delta = 23.45 * math.cos(2 * math.pi * (doy - d_s) / 365.25)
+
+    return math.radians(delta)
+
+
+def elliptical_orbit_ratio(doy):
+    '''
+    Calculate elliptical orbit ratio
+    '''
+
+    # Same approximation as parametricscheme.elliptical_orbit_ratio
+    angle = math.radians(0.9856 * (doy - 4))
+    eor   = 1 / (1 - 0.01672 * math.cos(angle))
+
+    return eor
+
+
+# Per-day tables indexed by day of year
+EOT = [equation_of_time(doy) for doy in DAYS]
+ELLIPTICAL_ORBIT_RATIO = [elliptical_orbit_ratio(doy) for doy in DAYS]
+
+# Per-day tables indexed by day of solstice then day of year
+SIN_DECLINATION = dict((d_s, [math.sin(declination(doy, d_s)) for doy in DAYS]) for d_s in SOLSTICES)
+COS_DECLINATION = dict((d_s, [math.cos(declination(doy, d_s)) for doy in DAYS]) for d_s in SOLSTICES)
+
+
+@lru_cache(maxsize=SITE_CACHE_SIZE)
+def latitude_terms(latitude):
+    '''
+    Calculate sine and cosine of latitude
+    '''
+
+    lat = math.radians(latitude)
+
+    return math.sin(lat), math.cos(lat)
+
+
+def time_correction(longitude, utc_offset, doy):
+    '''
+    Calculate time correction factor in minutes
+    '''
+
+    LSTM = 15 * utc_offset
+    TC   = 4 * (longitude - LSTM) + EOT[doy]
+
+    return TC
+
+
+def hour_angle(longitude, utc_offset, doy, hour, minute):
+    '''
+    Calculate hour angle in degrees
+    '''
+
+    TC  = time_correction(longitude, utc_offset, doy)
+    LST = hour + minute / 60 + TC / 60
+    HRA = 15 * (LST - 12)
+
+    return HRA
+
+
+def cos_zenith(latitude, longitude, utc_offset, day_of_solstice, doy, hour, minute):
+    '''
+    Calculate cosine of zenith angle from the precomputed tables
+    '''
+
+    sin_lat, cos_lat = latitude_terms(latitude)
+    h = math.radians(hour_angle(longitude, utc_offset, doy, hour, minute))
+
+    # Equation 2.2  Page 22
+    zenith = (sin_lat * SIN_DECLINATION[day_of_solstice][doy] +
+              cos_lat * COS_DECLINATION[day_of_solstice][doy] * math.cos(h))
+
+    return zenith
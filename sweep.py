@@ -0,0 +1,234 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import time
+import itertools
+
+import numpy as np
+
+import parametricscheme as ps
+import arrayscheme
+import grid
+
+
+# NOTE Parameter sweeps which share the solar geometry of each site
+#      Scenarios differing only in albedo, transmissivity, emissivity, percent net
+#      radiation, Bowen ratio etc see the same sun, so they are grouped by the
+#      parameters below and the clear sky insolation of unit albedo and transmissivity,
+#      S eor^2 and the cosine of the zenith angle, is calculated once per group for a
+#      day of steps at a time and broadcast to every scenario in the group
+#      Q_S is then formed with the same operations in the same order as
+#      arrayscheme.solar_rad so results are identical to an arrayscheme batch
+
+
+# Parameters which determine the solar geometry at every step
+GEOMETRY = ['latitude', 'longitude', 'day_of_year', 'hour', 'minute',
+            'utc_offset', 'day_of_solstice', 'year']
+
+# Minutes of solar geometry calculated at a time
+CHUNK_MINUTES = 1440
+
+
+def cartesian(base, axes):
+    '''
+    Scenario dicts for every combination of axes values
+    base maps ForecastConfig parameters to values shared by all scenarios
+    axes maps parameter names to lists of values, the last varying fastest
+    Raises ValueError for invalid scenarios
+    '''
+
+    names     = list(axes)
+    scenarios = []
+    for values in itertools.product(*[axes[n] for n in names]):
+        scenario = dict(base, **dict(zip(names, values)))
+        ps.ForecastConfig(**scenario).validate()
+        scenarios.append(scenario)
+
+    return scenarios
+
+
+def plan(scenarios):
+    '''
+    Group scenarios by GEOMETRY
+
+    scenarios is a list of per-scenario dicts, Namespaces or ForecastConfigs or
+    a dict of arrayscheme site parameters
+    Returns (p, sites, index) with p the arrayscheme.site_arrays of all
+    scenarios, sites the site_arrays of one scenario per group and index the
+    group of each scenario
+    '''
+
+    sites = scenarios if isinstance(scenarios, dict) else arrayscheme.stack(scenarios)
+    p     = arrayscheme.site_arrays(sites)
+
+    # Year is NaN without one, and NaN never equals itself
+    keys = np.column_stack([np.where(np.isnan(p[n]), -1, p[n]) if n == 'year' else p[n] for n in GEOMETRY])
+    keys, first, index = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+    return p, dict((n, v[first]) for n, v in p.items()), index.ravel()
+
+
+def saved(n_scenarios, n_sites):
+    '''
+    Fraction of the solar geometry calculations saved by grouping
+    '''
+
+    return 1 - n_sites / n_scenarios
+
+
+def clocks(g, minutes):
+    '''
+    (year, day, hour, minute) arrays shaped (times, sites) of each group
+    minutes after its start, wrapping years like inc_mins_hours_days
+    '''
+
+    days, minute_of_day = np.divmod(g['hour'] * 60 + g['minute'] + minutes[:, None], 1440)
+    hour, minute = np.divmod(minute_of_day, 60)
+    day  = g['day_of_year'] + days
+    year = np.broadcast_to(g['year'], day.shape).copy()
+
+    wrap = day > arrayscheme.days_in_year(year)
+    while wrap.any():
+        day  = np.where(wrap, day - arrayscheme.days_in_year(year), day)
+        year = np.where(wrap, year + 1, year)
+        wrap = day > arrayscheme.days_in_year(year)
+
+    return year, day, hour, minute
+
+
+def geometry(g, first, steps):
+    '''
+    Clear sky insolation, cosine of the zenith angle and clock of each group
+    for steps steps from first, arrays shaped (steps, sites) except the clocks
+    which have one more row for the clock after the last step
+    '''
+
+    year, day, hour, minute = clocks(g, np.arange(first, first + steps + 1))
+    p = dict((n, g[n]) for n in ('utc_offset', 'longitude', 'sin_lat', 'cos_lat', 'solstice'))
+
+    # Same operations as arrayscheme.solar_rad
+    insolation = arrayscheme.S * arrayscheme.ELLIPTICAL_ORBIT_RATIO[day[:-1]]**2
+    zen        = arrayscheme.zenith(p, day[:-1], hour[:-1], minute[:-1])
+
+    return insolation, zen, (day, hour, minute)
+
+
+def iter_forecast(scenarios, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+                  report_period=ps.DEFAULTS['report_period'], chunk_minutes=CHUNK_MINUTES):
+    '''
+    Same rows as arrayscheme.iter_forecast with the solar geometry of each
+    group of scenarios calculated once, chunk_minutes at a time
+    Memory use does not depend on forecast_minutes
+    '''
+
+    p, g, index = plan(scenarios)
+    n = len(p['latitude'])
+
+    T_s = p['surface_temp'].copy()
+    sum_d_T_s = np.zeros(n)
+
+    def report(fluxes, k):
+        row = dict(zip(ps.COLUMNS[3:10], fluxes[:6] + (sum_d_T_s,)))
+        row['Day']    = clock[0][k][index]
+        row['Hour']   = clock[1][k][index]
+        row['Minute'] = clock[2][k][index]
+        row['T_s']    = arrayscheme.from_kelvin(p, T_s)
+        return row
+
+    for first in range(0, forecast_minutes, chunk_minutes):
+        steps = min(chunk_minutes, forecast_minutes - first)
+        insolation, zen, clock = geometry(g, first, steps)
+
+        for k in range(steps):
+            z = zen[k][index]
+
+            # Based on Equation 2.1  Page 23
+            Q_S = np.where(z < 0, 0.0, insolation[k][index] * (1 - p['albedo']) * z * p['transmissivity'])
+
+            fluxes = arrayscheme.step(p, T_s, None, None, None, Q_S)
+            sum_d_T_s = sum_d_T_s + fluxes[6]
+            T_s = T_s + fluxes[6]
+
+            if (first + k) % report_period == 0:
+                yield report(fluxes, k + 1)
+                sum_d_T_s = np.zeros(n)
+
+    yield report(fluxes, steps)
+
+
+def forecast(scenarios, forecast_minutes=ps.DEFAULTS['forecast_minutes'],
+             report_period=ps.DEFAULTS['report_period']):
+    '''
+    Same dict of (scenarios, reports) arrays as arrayscheme.forecast
+    '''
+
+    rows = list(iter_forecast(scenarios, forecast_minutes, report_period))
+
+    return dict((c, np.stack([row[c] for row in rows], axis=1)) for c in ps.COLUMNS)
+
+
+def main(args):
+    '''
+    Forecast every combination of the swept parameters around the command line site
+    Optionally compare with an independent arrayscheme batch and write every scenario
+    to CSV or .npy file
+    '''
+
+    site = dict((n, v) for n, v in vars(ps.ForecastConfig.from_args(args)).items()
+                if n not in ('integrator', 'tolerance', 'aggregates'))
+    axes = grid.pairs(args.sweep, lambda values: [grid.number(v) for v in values.split(',')])
+    for name in axes:
+        if name not in arrayscheme.FIELDS:
+            raise ValueError("'%s' can not be swept" % name)
+
+    scenarios = cartesian(site, axes)
+    p, g, index = plan(scenarios)
+
+    begin = time.perf_counter()
+    result = forecast(scenarios, args.forecast_minutes, args.report_period)
+    seconds = time.perf_counter() - begin
+
+    if args.filename is not None:
+        with ps.open_writer(args.filename, ['id'] + ps.COLUMNS) as writer:
+            for i in range(len(scenarios)):
+                for row in zip(*[result[c][i] for c in ps.COLUMNS]):
+                    writer.write((i,) + row)
+
+    print("Scenarios:\t", len(scenarios))
+    print("Sites:\t\t", len(g['latitude']))
+    print("Geometry saved:\t", "%.3f" % saved(len(scenarios), len(g['latitude'])))
+    print("Seconds:\t", "%.3f" % seconds)
+
+    if args.compare:
+        begin = time.perf_counter()
+        expected = arrayscheme.forecast(arrayscheme.stack(scenarios), args.forecast_minutes, args.report_period)
+        independent = time.perf_counter() - begin
+
+        same = all(np.array_equal(result[c], expected[c], equal_nan=True) for c in ps.COLUMNS)
+        print("Independent:\t", "%.3f" % independent)
+        print("Time saved:\t", "%.3f" % (1 - seconds / independent))
+        print("Identical:\t", same)
+
+        if not same:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ps.make_parser("Calculate surface temperature for every combination of swept parameters")
+
+    sw = parser.add_argument_group('sweep arguments')
+    sw.add_argument('-sw', '--sweep',
+            help='Values of a parameter using the long option name, for example albedo=0.1,0.2,0.3',
+            action='append', metavar='NAME=V1,V2,...')
+    sw.add_argument('-co', '--compare',
+            help='Also run every scenario as an independent arrayscheme batch and check the results',
+            default=False, action="store_true")
+
+    args = parser.parse_args()
+
+    ps.post_parse_args_checks(args)
+
+    main(args)
@@ -0,0 +1,299 @@
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import os
+import sys
+import math
+import heapq
+import argparse
+import itertools
+
+import parametricscheme as ps
+
+
+# NOTE Scores forecasts against observations without loading either into memory
+#      Forecast files and observation archives are read row by row, each must be in
+#      time order for every site with sites in order, as written by parametricscheme.py
+#      and batch.py, and they are joined on site, day, hour and minute in a merge join
+#      Errors are accumulated with running means so memory only grows with the
+#      number of sites, lead times and hours, never with the number of rows
+
+
+# Summary columns
+COLUMNS = ['Group', 'Key', 'Count', 'Bias', 'MAE', 'RMSE']
+
+
+class Scores(object):
+    '''
+    Running count, bias, mean absolute error and mean squared error of forecast - observed
+    Means are updated incrementally so long archives do not lose precision
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.bias  = 0.0
+        self.mae   = 0.0
+        self.mse   = 0.0
+
+    def add(self, error):
+        self.count += 1
+        self.bias  += (error - self.bias) / self.count
+        self.mae   += (abs(error) - self.mae) / self.count
+        self.mse   += (error * error - self.mse) / self.count
+
+    @property
+    def rmse(self):
+        return math.sqrt(self.mse)
+
+
+def site_key(site):
+    '''
+    Sort key of a site, numbers in numeric order before names
+    '''
+
+    try:
+        return (0, float(site), '')
+    except ValueError:
+        return (1, 0.0, site)
+
+
+def read_header(filename):
+    '''
+    Column names and delimiter, tab if the header contains one otherwise comma
+    '''
+
+    with io.open(filename) as f:
+        header = f.readline()
+
+    delimiter = '\t' if '\t' in header else ','
+
+    return [c.strip() for c in header.split(delimiter)], delimiter
+
+
+def read_rows(filename, variable, site=None, year=None):
+    '''
+    Lazily yields (key, site, lead, value) for every row of a forecast or
+    observation file, key is (site key, year, day, hour, minute)
+
+    The site is the id or Site column, otherwise site, otherwise the file name
+    without extension.  The year is the Year column, otherwise year plus one
+    whenever the day goes back, counting from 0 without a year.  lead is minutes
+    after the start of each site's rows, one minute before the first row
+    A row at the same time as the previous row of its site, such as the final
+    row of a forecast repeating the last report, is skipped
+    Raises ValueError for rows out of order
+    '''
+
+    if site is None:
+        site = os.path.splitext(os.path.basename(filename))[0]
+
+    columns, delimiter = read_header(filename)
+    for name in ('Day', 'Hour', 'Minute', variable):
+        if name not in columns:
+            raise ValueError("%s has no %s column" % (filename, name))
+
+    i_site = next((columns.index(c) for c in ('id', 'Site') if c in columns), None)
+    i_year = columns.index('Year') if 'Year' in columns else None
+    index  = [columns.index(c) for c in ('Day', 'Hour', 'Minute', variable)]
+    calendar_years = i_year is not None or year is not None
+
+    with io.open(filename) as f:
+        f.readline()
+
+        name, last_key = None, None
+        for number, line in enumerate(f, 2):
+            if not line.strip():
+                continue
+
+            values = line.rstrip('\r\n').split(delimiter)
+            try:
+                day, hour, minute = int(values[index[0]]), int(values[index[1]]), int(values[index[2]])
+            except ValueError:
+                day, hour, minute = [int(float(values[i])) for i in index[:3]]
+
+            if i_site is not None and values[i_site].strip() != name:
+                name = values[i_site].strip()
+                site_order, last = site_key(name), None
+            elif i_site is None and name is None:
+                name = site
+                site_order, last = site_key(name), None
+
+            if i_year is not None:
+                Y = int(float(values[i_year]))
+            elif last is None:
+                Y = year or 0
+            else:
+                Y = last[0] + (day < last[1])
+
+            if last is None:
+                lead = 1
+            else:
+                # Whole days from the last row, through the end of each year in between
+                days = day - last[1]
+                if Y != last[0]:
+                    days += sum(ps.days_in_year(y if calendar_years else None) for y in range(last[0], Y))
+                lead += days * 1440 + (hour - last[2]) * 60 + minute - last[3]
+            last = (Y, day, hour, minute)
+
+            key = (site_order, Y, day, hour, minute)
+            if last_key is not None and key < last_key:
+                raise ValueError("%s line %d is out of order, rows must be sorted by site then time" %
+                                 (filename, number))
+            if key == last_key:
+                continue
+            last_key = key
+
+            value = values[index[3]].strip()
+            if value not in ('', 'nan', 'NaN'):
+                yield key, name, lead, float(value)
+
+
+def merge(streams):
+    '''
+    Merge streams of read_rows rows sorted by key into one
+    '''
+
+    if len(streams) == 1:
+        return streams[0]
+
+    return heapq.merge(*streams, key=lambda row: row[0])
+
+
+def groups(rows):
+    '''
+    Lazily yields (key, list of rows) for runs of rows with the same key
+    '''
+
+    for key, run in itertools.groupby(rows, key=lambda row: row[0]):
+        yield key, list(run)
+
+
+def merge_join(forecasts, observations):
+    '''
+    Lazily yields (site, lead, hour, forecast - observed) for every forecast and
+    observation with the same site and time, both sorted by key
+    '''
+
+    f_groups = groups(forecasts)
+    o_groups = groups(observations)
+    f = next(f_groups, None)
+    o = next(o_groups, None)
+
+    while f is not None and o is not None:
+        if f[0] < o[0]:
+            f = next(f_groups, None)
+        elif o[0] < f[0]:
+            o = next(o_groups, None)
+        else:
+            for key, site, lead, value in f[1]:
+                for observed in o[1]:
+                    yield site, lead, key[3], value - observed[3]
+            f = next(f_groups, None)
+            o = next(o_groups, None)
+
+
+def verify(forecast_files, observation_files, variable='T_s', year=None):
+    '''
+    Scores of forecasts against observations
+
+    forecast_files is a list of file names or (site, file name) pairs
+    Returns a dict mapping 'all' to Scores and 'site', 'lead' and 'hour' to
+    dicts of Scores for each site, lead time in minutes and hour of day
+    '''
+
+    # Calendar years are only compared when the observations have them
+    if any('Year' in read_header(f)[0] for f in observation_files):
+        if year is None:
+            raise ValueError("the observations have a Year column so the forecast start year is needed")
+    else:
+        year = None
+
+    streams = []
+    for item in forecast_files:
+        site, filename = item if isinstance(item, tuple) else (None, item)
+        streams.append(read_rows(filename, variable, site, year))
+
+    forecasts    = merge(streams)
+    observations = merge([read_rows(f, variable) for f in observation_files])
+
+    scores = {'all': Scores(), 'site': {}, 'lead': {}, 'hour': {}}
+    for site, lead, hour, error in merge_join(forecasts, observations):
+        scores['all'].add(error)
+        for group, key in (('site', site), ('lead', lead), ('hour', hour)):
+            if key not in scores[group]:
+                scores[group][key] = Scores()
+            scores[group][key].add(error)
+
+    return scores
+
+
+def summary(scores):
+    '''
+    Summary table rows of COLUMNS values
+    '''
+
+    rows = [('all', '', scores['all'])]
+    rows += [('site', k, scores['site'][k]) for k in sorted(scores['site'], key=site_key)]
+    rows += [('lead', k, scores['lead'][k]) for k in sorted(scores['lead'])]
+    rows += [('hour', k, scores['hour'][k]) for k in sorted(scores['hour'])]
+
+    return [(group, key, s.count, s.bias, s.mae, s.rmse) for group, key, s in rows]
+
+
+def main(args):
+    '''
+    Score forecast files against observation archives and print or write the summary
+    '''
+
+    forecast_files = [tuple(f.split('=', 1)) if '=' in f else f for f in args.forecasts]
+    try:
+        scores = verify(forecast_files, args.observations, args.variable, args.year)
+    except ValueError as e:
+        print("ERROR: %s" % e)
+        return 1
+
+    if scores['all'].count == 0:
+        print("No forecasts matched any observations")
+        return 1
+
+    rows = summary(scores)
+
+    if args.filename is not None:
+        with ps.CSVWriter(args.filename, COLUMNS) as writer:
+            for row in rows:
+                writer.write(row)
+
+    s = scores['all']
+    print("Pairs:\t\t", s.count)
+    print("Bias:\t\t", s.bias)
+    print("MAE:\t\t", s.mae)
+    print("RMSE:\t\t", s.rmse)
+    print("Sites:\t\t", len(scores['site']))
+    print("Lead times:\t", len(scores['lead']))
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Score forecasts against observations "
+                        "https://github.com/makeyourownmaker/ParametricWeatherModel")
+
+    parser.add_argument('-fc', '--forecasts',
+            help='Forecast files written by parametricscheme.py or batch.py, optionally SITE=FILE',
+            required=True, nargs='+')
+    parser.add_argument('-ob', '--observations',
+            help='Observation files with Site, Day, Hour, Minute, the variable and optionally Year columns',
+            required=True, nargs='+')
+    parser.add_argument('-va', '--variable',
+            help='Variable compared, in the same units in both - default=%(default)s',
+            default='T_s', type=str)
+    parser.add_argument('-yr', '--year',
+            help='Year the forecasts start, needed when the observations have a Year column',
+            default=None, type=ps.int_range(*ps.RANGES['year']), metavar="[1, 9999]")
+    parser.add_argument('-fn', '--filename',
+            help='File name for the tab separated summary table', type=str)
+
+    sys.exit(main(parser.parse_args()))